@@ -0,0 +1,83 @@
+"""Compare memory use and throughput of the list based ocs_feed.Block with
+the array backed ocs_feed.ColumnarBlock.
+
+Each run fills a block with ``--samples`` samples of ``--channels`` float
+channels, in chunks of ``--chunk`` samples, then encodes it for publishing.
+Memory is the amount retained by the block once filled, with each chunk
+created and released as an Agent would.
+
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from ocs.ocs_feed import Block, ColumnarBlock
+
+
+def iter_chunks(n_samples, n_channels, chunk, as_arrays):
+    t0 = time.time()
+    for i in range(0, n_samples, chunk):
+        n = min(chunk, n_samples - i)
+        t = t0 + (i + np.arange(n)) * 1e-3
+        data = {'channel_%03i' % c: np.random.normal(size=n)
+                for c in range(n_channels)}
+        if not as_arrays:
+            t = t.tolist()
+            data = {k: v.tolist() for k, v in data.items()}
+        yield {'timestamps': t, 'data': data}
+
+
+def measure_memory(block_class, keys, *chunk_args):
+    tracemalloc.start()
+    block = block_class('test', keys)
+    for c in iter_chunks(*chunk_args):
+        block.extend(c)
+    del c
+    mem, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return mem
+
+
+def measure_time(block_class, keys, chunks):
+    block = block_class('test', keys)
+
+    t0 = time.perf_counter()
+    for c in chunks:
+        block.extend(c)
+    t_fill = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    block.encoded()
+    t_encode = time.perf_counter() - t0
+    return t_fill, t_encode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--chunk', type=int, default=200)
+    args = parser.parse_args()
+
+    keys = ['channel_%03i' % c for c in range(args.channels)]
+    n_points = args.samples * args.channels
+    print(f'{args.samples} samples x {args.channels} channels, '
+          f'chunks of {args.chunk}')
+    print(f'{"block":<14} {"input":<7} {"fill [Mpts/s]":>14} '
+          f'{"encode [s]":>11} {"memory [MB]":>12}')
+
+    for label, as_arrays in [('lists', False), ('arrays', True)]:
+        chunk_args = (args.samples, args.channels, args.chunk, as_arrays)
+        chunks = list(iter_chunks(*chunk_args))
+        for block_class in [Block, ColumnarBlock]:
+            mem = measure_memory(block_class, keys, *chunk_args)
+            t_fill, t_encode = measure_time(block_class, keys, chunks)
+            print(f'{block_class.__name__:<14} {label:<7} '
+                  f'{n_points / t_fill / 1e6:>14.2f} {t_encode:>11.3f} '
+                  f'{mem / 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Microbenchmark of recorded message validation in ocs_feed.Feed.
+
+Simulates an Agent sampling ``--channels`` channels at ``--rate`` Hz, either
+publishing every sample on its own or publishing one second of data at a time.
+Compares checking every field name and sample on each message (what
+publish_message used to do) against Feed.verify_message, which caches
+verified block structures and checks numpy arrays by dtype.
+
+"""
+import argparse
+import time
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from ocs.ocs_feed import Feed
+
+
+def verify_uncached(message):
+    for k, v in message['data'].items():
+        Feed.verify_data_field_string(k)
+        Feed.verify_message_data_type(v)
+
+
+def make_messages(rate, n_channels, per_sample, as_arrays):
+    keys = ['channel_%03i' % c for c in range(n_channels)]
+    t0 = time.time()
+    if per_sample:
+        return [{'block_name': 'test',
+                 'timestamp': t0 + i / rate,
+                 'data': {k: float(i) for k in keys}}
+                for i in range(rate)]
+
+    t = t0 + np.arange(rate) / rate
+    data = {k: np.random.normal(size=rate) for k in keys}
+    if not as_arrays:
+        t = t.tolist()
+        data = {k: v.tolist() for k, v in data.items()}
+    return [{'block_name': 'test', 'timestamps': t, 'data': data}]
+
+
+def bench(func, messages, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for m in messages:
+            func(m)
+    return (time.perf_counter() - t0) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    feed = Feed(MagicMock(), 'bench', record=True)
+
+    print(f'{args.rate} Hz, {args.channels} channels; '
+          'time to validate one second of data')
+    print(f'{"publishing":<24} {"uncached [ms]":>14} {"cached [ms]":>12}')
+    cases = [('per sample', True, False),
+             ('1 s chunks, lists', False, False),
+             ('1 s chunks, arrays', False, True)]
+    for label, per_sample, as_arrays in cases:
+        messages = make_messages(args.rate, args.channels, per_sample,
+                                 as_arrays)
+        t_old = bench(verify_uncached, messages, args.repeat)
+        t_new = bench(feed.verify_message, messages, args.repeat)
+        print(f'{label:<24} {t_old * 1e3:>14.2f} {t_new * 1e3:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Benchmark of frame building in the HK Aggregator.
+
+Simulates one hour of data from a provider sampling ``--channels`` channels
+at ``--rate`` Hz, split into frames of ``--frame-length`` seconds, and
+reports how many frames per second can be built (cast to G3 types), and how
+long a 1 hour file takes. Compares list based blocks cast one G3Time at a
+time (how Provider.to_frame used to work) against ColumnarBlock buffers cast
+with the numpy path in g3_cast.
+
+"""
+import argparse
+import time
+
+import numpy as np
+
+import so3g  # noqa: F401
+from spt3g import core
+
+from ocs.agents.aggregator.drivers import fill_frame
+from ocs.ocs_feed import Block, ColumnarBlock
+
+
+def list_cast(data, time=False):
+    # g3_cast for lists, as it was before the numpy path was added
+    dtype = type(data[0])
+    if not all(isinstance(d, dtype) for d in data):
+        raise TypeError("Data list contains varying types!")
+    if time:
+        return core.G3VectorTime(list(map(
+            lambda t: core.G3Time(t * core.G3Units.s), data)))
+    return core.G3VectorDouble(data)
+
+
+def fill_frame_lists(frame, blocks):
+    for block_name, timestamps, data in blocks:
+        m = core.G3TimesampleMap()
+        m.times = list_cast(timestamps, time=True)
+        for key, ts in data.items():
+            m[key] = list_cast(ts)
+        frame['blocks'].append(m)
+    return frame
+
+
+def make_block(block_class, keys, rate, frame_length, t0):
+    block = block_class('test', keys)
+    # Data arrives in 1 s chunks, as from a Feed with buffer_time=1
+    for i in range(frame_length):
+        t = t0 + i + np.arange(rate) / rate
+        chunk = {'timestamps': t,
+                 'data': {k: np.random.normal(size=rate) for k in keys}}
+        if block_class is Block:
+            chunk = {'timestamps': t.tolist(),
+                     'data': {k: v.tolist() for k, v in chunk['data'].items()}}
+        block.extend(chunk)
+    return block
+
+
+def bench(block_class, fill, keys, args):
+    n_frames = 3600 // args.frame_length
+    block = make_block(block_class, keys, args.rate, args.frame_length,
+                       time.time())
+    blocks = [('test', block.timestamps, block.data)]
+
+    t0 = time.perf_counter()
+    for _ in range(n_frames):
+        frame = core.G3Frame(core.G3FrameType.Housekeeping)
+        frame['blocks'] = core.G3VectorFrameObject()
+        fill(frame, blocks)
+    dt = time.perf_counter() - t0
+    return n_frames / dt, dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate', type=int, default=200)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--frame-length', type=int, default=60)
+    args = parser.parse_args()
+
+    keys = ['channel_%03i' % c for c in range(args.channels)]
+
+    print(f'{args.rate} Hz, {args.channels} channels, '
+          f'{args.frame_length} s frames')
+    print(f'{"blocks":<24} {"frames/s":>10} {"1 h file [s]":>13}')
+    for label, block_class, fill in [
+            ('lists, per-sample cast', Block, fill_frame_lists),
+            ('columnar, numpy cast', ColumnarBlock, fill_frame)]:
+        fps, dt = bench(block_class, fill, keys, args)
+        print(f'{label:<24} {fps:>10.1f} {dt:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Benchmark of compressed HK file writing.
+
+Writes ``--frames`` housekeeping data frames, each holding ``--frame-length``
+seconds of ``--channels`` channels sampled at ``--rate`` Hz, with each of the
+compression options the Aggregator supports. Reports write throughput (of
+uncompressed data), CPU time and the resulting file size.
+
+The data is a slow random walk plus white noise, quantized like a typical
+readout, which compresses much like real housekeeping data.
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import so3g  # noqa: F401
+from spt3g import core
+
+from ocs.agents.aggregator.drivers import FILE_EXTENSIONS, frame_size
+
+
+def make_frames(n_frames, n_channels, rate, frame_length):
+    n = rate * frame_length
+    frames = []
+    t0 = time.time()
+    level = np.random.uniform(1, 300, n_channels)
+    for i in range(n_frames):
+        m = core.G3TimesampleMap()
+        t = t0 + i * frame_length + np.arange(n) / rate
+        m.times = core.G3VectorTime((t * core.G3Units.s).astype(np.int64))
+        for c in range(n_channels):
+            walk = level[c] + np.cumsum(np.random.normal(0, 1e-3, n))
+            level[c] = walk[-1]
+            data = np.round(walk + np.random.normal(0, 1e-4, n), 4)
+            m['channel_%03i' % c] = core.G3VectorDouble(data)
+        frame = core.G3Frame(core.G3FrameType.Housekeeping)
+        frame['blocks'] = core.G3VectorFrameObject([m])
+        frames.append(frame)
+    return frames
+
+
+def bench(frames, filename):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    writer = core.G3Writer(filename)
+    for frame in frames:
+        writer(frame)
+    writer(core.G3Frame(core.G3FrameType.EndProcessing))
+    del writer
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--rate', type=int, default=10)
+    parser.add_argument('--frame-length', type=int, default=60)
+    args = parser.parse_args()
+
+    frames = make_frames(args.frames, args.channels, args.rate,
+                         args.frame_length)
+    raw_bytes = sum(frame_size(f) for f in frames)
+
+    print(f'{args.frames} frames, {raw_bytes / 1e6:.1f} MB uncompressed')
+    print(f'{"compression":<12} {"MB/s":>8} {"CPU [s]":>8} '
+          f'{"size [MB]":>10} {"ratio":>6}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for compression, ext in FILE_EXTENSIONS.items():
+            filename = os.path.join(tmpdir, 'bench' + ext)
+            wall, cpu = bench(frames, filename)
+            size = os.path.getsize(filename)
+            print(f'{str(compression):<12} {raw_bytes / wall / 1e6:>8.1f} '
+                  f'{cpu:>8.2f} {size / 1e6:>10.2f} '
+                  f'{raw_bytes / size:>6.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark of line protocol formatting in the InfluxDB Publisher.
+
+Formats ``--points`` points, from a feed with ``--channels`` float channels
+published in 1 s messages at ``--rate`` Hz, and reports points per second
+for the per-point formatter (how Publisher.format_data used to work) and the
+columnar format_lines. Checks that both give the same lines.
+
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ocs.agents.influxdb_publisher.drivers import (
+    Publisher, format_lines, timestamp2influxtime)
+from ocs.ocs_feed import expand_timestamps
+
+
+def format_points(data, feed):
+    # Publisher.format_data for the line protocol, before format_lines
+    measurement = feed['agent_address']
+    feed_tag = feed['feed_name']
+    lines = []
+    for bk, bv in data.items():
+        grouped_data_points = []
+        times = expand_timestamps(bv['timestamps'])
+        for i in range(len(times)):
+            grouped_dict = {}
+            for data_key, data_value in bv['data'].items():
+                grouped_dict[data_key] = data_value[i]
+            grouped_data_points.append(grouped_dict)
+
+        for fields, time_ in zip(grouped_data_points, times):
+            fields_line = []
+            for mk, mv in fields.items():
+                fields_line.append(Publisher._format_field_line(mk, mv))
+            measurement_line = ','.join(fields_line)
+            t_line = timestamp2influxtime(time_, protocol='line')
+            lines.append(f"{measurement},feed={feed_tag} {measurement_line} {t_line}")
+    return lines
+
+
+def make_messages(n_points, channels, rate):
+    keys = ['channel_%03i' % c for c in range(channels)]
+    t0 = time.time()
+    messages = []
+    for i in range(max(1, n_points // rate)):
+        t = t0 + i + np.arange(rate) / rate
+        messages.append({'temps': {
+            'block_name': 'temps',
+            'timestamps': t.tolist(),
+            'data': {k: np.random.normal(size=rate).tolist() for k in keys}}})
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=10**6)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--rate', type=int, default=200)
+    args = parser.parse_args()
+
+    feed = {'agent_address': 'observatory.fake-data1',
+            'feed_name': 'false_temperatures'}
+    messages = make_messages(args.points, args.channels, args.rate)
+    n = sum(len(m['temps']['timestamps']) for m in messages)
+
+    print(f'{n} points, {args.channels} channels, {args.rate} points/message')
+    print(f'{"formatter":<12} {"time [s]":>9} {"points/s":>12}')
+    results = {}
+    for label, fmt in [('per-point', format_points),
+                       ('columnar', format_lines)]:
+        t0 = time.perf_counter()
+        lines = []
+        for m in messages:
+            lines.extend(fmt(m, feed))
+        dt = time.perf_counter() - t0
+        results[label] = lines
+        print(f'{label:<12} {dt:>9.2f} {n / dt:>12.0f}')
+
+    assert results['per-point'] == results['columnar']
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
+import os
 import time
-import queue
 import argparse
 import txaio
 
@@ -8,8 +8,9 @@ from twisted.internet import reactor
 from os import environ
 from ocs import ocs_agent, site_config
 from ocs.base import OpCode
+from ocs.ocs_feed import FeedQueue
 
-from ocs.agents.aggregator.drivers import Aggregator
+from ocs.agents.aggregator.drivers import Aggregator, ShardAssignment
 
 # For logging
 txaio.use_twisted()
@@ -31,27 +32,82 @@ class AggregatorAgent:
     Attributes:
         time_per_file (int):
             Time (sec) before files should be rotated.
+        max_file_bytes (int):
+            Size (bytes) at which files are rotated, or None for no limit.
+        max_file_frames (int):
+            Number of frames at which files are rotated, or None for no limit.
+        align_files (bool):
+            If True, files are rotated on multiples of time_per_file on the
+            wall clock.
+        durability (str):
+            Durability mode of the writer, one of 'none', 'flush' or 'fsync'.
+        flush_bytes (int):
+            Bytes written before the writer flushes, or None.
+        flush_interval (float):
+            Time (sec) after a write before the writer flushes, or None.
+        file_index (bool):
+            If True, an index is written alongside each file.
+        journal (bool):
+            If True, incoming data is journaled so it can be recovered after
+            a crash.
+        journal_sync (float):
+            Time (sec) between syncs of the journal to disk.
+        compression (str):
+            Compression for new files, 'gzip', 'bz2' or None.
         data_dir (path):
-            Path to the base directory where data should be written.
+            Path to the base directory where data should be written. When
+            sharding, this is the shard's subdirectory of ``--data-dir``.
+        shard (ShardAssignment):
+            Subset of providers this instance records, or None if it records
+            all of them.
         aggregate (bool):
            Specifies if the agent is currently aggregating data.
-        incoming_data (queue.Queue):
+        incoming_data (FeedQueue):
             Thread-safe queue where incoming (data, feed) pairs are stored before
-            being passed to the Aggregator.
-        loop_time (float):
-            Time between iterations of the run loop.
+            being passed to the Aggregator. A None is put on the queue to wake
+            the record process when it is asked to stop. Its size is bounded
+            by --queue-max-messages and --queue-max-bytes.
     """
 
+    SHARD_PUBLISH_INTERVAL = 10.
+
     def __init__(self, agent, args):
         self.agent: ocs_agent.OCSAgent = agent
         self.log = agent.log
 
         self.time_per_file = int(args.time_per_file)
+        self.max_file_bytes = args.max_file_bytes
+        self.max_file_frames = args.max_file_frames
+        self.align_files = args.align_files
+        self.durability = args.durability
+        self.flush_bytes = args.flush_bytes
+        self.flush_interval = args.flush_interval
+        self.file_index = not args.no_file_index
+        self.journal = args.journal
+        self.journal_sync = args.journal_sync
+        self.compression = args.compression
+        if self.compression == 'none':
+            self.compression = None
         self.data_dir = args.data_dir
 
+        self.shard = None
+        if args.shard_count > 1 or args.shard_patterns:
+            self.shard = ShardAssignment(args.shard_index,
+                                         count=args.shard_count,
+                                         patterns=args.shard_patterns)
+            self.data_dir = os.path.join(self.data_dir, self.shard.name)
+        self._shard_published = None
+
         self.aggregate = False
-        self.incoming_data = queue.Queue()
-        self.loop_time = 1
+        spill_dir = args.queue_spill_dir
+        if spill_dir is None:
+            spill_dir = os.path.join(self.data_dir, '.spill')
+        self.incoming_data = FeedQueue(
+            max_messages=args.queue_max_messages,
+            max_bytes=args.queue_max_bytes,
+            policy=args.queue_policy,
+            spill_dir=spill_dir,
+            spill_max_bytes=args.queue_spill_max_bytes)
 
         # SUBSCRIBES TO ALL FEEDS!!!!
         # If this ends up being too much data, we can add a tag '.record'
@@ -60,6 +116,11 @@ class AggregatorAgent:
                                       'observatory..feeds.',
                                       options={'match': 'wildcard'})
 
+        if self.shard is not None:
+            # Lets the registry report which providers each instance takes
+            self.agent.register_feed('aggregator_shard', record=False,
+                                     max_messages=1)
+
         record_on_start = (args.initial_state == 'record')
         self.agent.register_process('record',
                                     self.record, self._stop_record,
@@ -76,9 +137,23 @@ class AggregatorAgent:
         if not feed['record'] or not self.aggregate:
             return
 
+        if self.shard is not None and not self.shard.accepts(feed['address']):
+            return
+
         self.incoming_data.put((data, feed))
         self.log.debug("Enqueued {d} from Feed {f}", d=data, f=feed)
 
+    def _publish_shard(self, now):
+        """Publishes the shard assignment, at most every
+        SHARD_PUBLISH_INTERVAL seconds."""
+        if self.shard is None:
+            return
+        if (self._shard_published is not None
+                and now - self._shard_published < self.SHARD_PUBLISH_INTERVAL):
+            return
+        self._shard_published = now
+        self.agent.publish_to_feed('aggregator_shard', self.shard.encoded())
+
     @ocs_agent.param('test_mode', default=False, type=bool)
     def record(self, session: ocs_agent.OpSession, params):
         """record(test_mode=False)
@@ -107,7 +182,43 @@ class AggregatorAgent:
                          "last_refresh": 1602089118.8223345,
                          "sessid": "1602088932.335811",
                          "stale": false,
-                         "last_block_received": "temps"}}}
+                         "last_block_received": "temps"}},
+                 "pipeline": {
+                    "ingest": {"count": 120, "total_time": 0.21,
+                               "last_time": 0.0016, "max_time": 0.012},
+                    "build": {"count": 4, "total_time": 0.08,
+                              "last_time": 0.019, "max_time": 0.025,
+                              "queue_depth": 0},
+                    "write": {"count": 5, "total_time": 0.03,
+                              "last_time": 0.006, "max_time": 0.009,
+                              "queue_depth": 0}},
+                 "scheduling": {"last_lag": 0.0011, "max_lag": 0.0043,
+                                "scheduled": 2},
+                 "incoming_queue": {
+                    "depth": 0, "bytes": 0, "high_water": 14,
+                    "high_water_bytes": 3584, "dropped": 0,
+                    "feeds": {
+                        "observatory.fake-data1.feeds.false_temperatures": {
+                            "queued": 0, "dropped": 0, "high_water": 7}}}}
+
+            The "pipeline" entry reports the time spent in each stage of the
+            Aggregator's write pipeline, and the number of frames waiting on
+            the frame building and writing stages. The "scheduling" entry
+            reports how late (in seconds) the last and latest provider frame
+            or stale deadlines were handled, and the number of providers
+            scheduled.
+
+            The "incoming_queue" entry reports the depth of the queue of
+            incoming messages, its high-water marks and the number of
+            messages dropped, in total and per feed; see
+            :meth:`ocs.ocs_feed.FeedQueue.stats`.
+
+            When sharding, the session data also includes the shard
+            assignment, which is also published on the "aggregator_shard"
+            feed for the registry::
+
+                "shard": {"name": "shard-1", "index": 1, "count": 4,
+                          "patterns": null}
 
         """
         session.set_status('starting')
@@ -118,7 +229,17 @@ class AggregatorAgent:
                 self.incoming_data,
                 self.time_per_file,
                 self.data_dir,
-                session=session
+                session=session,
+                max_file_bytes=self.max_file_bytes,
+                max_file_frames=self.max_file_frames,
+                align_files=self.align_files,
+                durability=self.durability,
+                flush_bytes=self.flush_bytes,
+                flush_interval=self.flush_interval,
+                file_index=self.file_index,
+                journal=self.journal,
+                journal_sync=self.journal_sync,
+                compression=self.compression,
             )
         except PermissionError:
             self.log.error("Unable to intialize Aggregator due to permission "
@@ -127,9 +248,18 @@ class AggregatorAgent:
             return False, "Aggregation not started"
 
         session.set_status('running')
+        # In test mode, process whatever is already queued without waiting
+        timeout = 0 if params['test_mode'] else None
         while self.aggregate:
-            time.sleep(self.loop_time)
-            aggregator.run()
+            if self.shard is not None and timeout is None:
+                aggregator.run(timeout=self.SHARD_PUBLISH_INTERVAL)
+            else:
+                aggregator.run(timeout=timeout)
+
+            session.data['incoming_queue'] = self.incoming_data.stats()
+            if self.shard is not None:
+                self._publish_shard(time.time())
+                session.data['shard'] = self.shard.encoded()
 
             if params['test_mode']:
                 break
@@ -142,6 +272,7 @@ class AggregatorAgent:
         if OpCode(session.op_code) in [OpCode.STARTING, OpCode.RUNNING]:
             session.set_status('stopping')
             self.aggregate = False
+            self.incoming_data.put(None)
             return True, "Stopping aggregation"
         elif OpCode(session.op_code) == OpCode.STOPPING:
             return True, "record process status is already 'stopping'"
@@ -163,6 +294,75 @@ def make_parser(parser=None):
                              "idle or record")
     pgroup.add_argument('--time-per-file', default='3600',
                         help="Time per file in seconds. Defaults to 1 hr")
+    pgroup.add_argument('--max-file-bytes', type=int, default=None,
+                        help="If set, also rotate files once they reach "
+                             "this size in bytes.")
+    pgroup.add_argument('--max-file-frames', type=int, default=None,
+                        help="If set, also rotate files once they contain "
+                             "this many frames.")
+    pgroup.add_argument('--align-files', action='store_true',
+                        help="Rotate files on multiples of --time-per-file "
+                             "on the wall clock (e.g. on the hour), and name "
+                             "them by the start of that period.")
+    pgroup.add_argument('--durability', default='flush',
+                        choices=['none', 'flush', 'fsync'],
+                        help="How hard to try to get data onto disk. 'none' "
+                             "only flushes when files are closed, 'flush' "
+                             "flushes written data to the OS, and 'fsync' "
+                             "also waits for it to reach the disk.")
+    pgroup.add_argument('--flush-bytes', type=int, default=None,
+                        help="Flush after this many bytes are written. If "
+                             "neither this or --flush-interval are set, "
+                             "flush whenever the writer is idle.")
+    pgroup.add_argument('--flush-interval', type=float, default=None,
+                        help="Flush this many seconds after data is "
+                             "written.")
+    pgroup.add_argument('--no-file-index', action='store_true',
+                        help="Don't write an index (.g3.idx) alongside "
+                             "each file.")
+    pgroup.add_argument('--journal', action='store_true',
+                        help="Journal incoming data, so that data not yet "
+                             "written to a frame can be recovered if the "
+                             "agent crashes. This doubles the data written "
+                             "to the data directory.")
+    pgroup.add_argument('--journal-sync', type=float, default=1.,
+                        help="Time in seconds between syncs of the journal "
+                             "to disk, which is the most data lost in a "
+                             "crash.")
+    pgroup.add_argument('--compression', default='none',
+                        choices=['none', 'gzip', 'bz2'],
+                        help="Compress files, which get a .g3.gz or .g3.bz2 "
+                             "extension.")
+    pgroup.add_argument('--shard-count', type=int, default=1,
+                        help="Split providers between this many aggregator "
+                             "instances by a hash of their feed address.")
+    pgroup.add_argument('--shard-index', type=int, default=0,
+                        help="Index of this instance's shard, from 0 to "
+                             "--shard-count - 1. Files are written to a "
+                             "shard-<index> subdirectory of --data-dir.")
+    pgroup.add_argument('--shard-patterns', nargs='+', default=None,
+                        help="Instead of hashing, record only feeds whose "
+                             "address matches one of these patterns "
+                             "(e.g. 'observatory.LS*.feeds.*').")
+    pgroup.add_argument('--queue-max-messages', type=int, default=0,
+                        help="Maximum number of incoming messages waiting to "
+                             "be processed. If 0, no limit.")
+    pgroup.add_argument('--queue-max-bytes', type=int, default=0,
+                        help="Maximum estimated size in bytes of incoming "
+                             "messages waiting to be processed. If 0, no "
+                             "limit.")
+    pgroup.add_argument('--queue-policy', default='drop_oldest',
+                        choices=['drop_oldest', 'coalesce', 'spill'],
+                        help="What to do with incoming messages once the "
+                             "queue is full: drop the oldest, replace the "
+                             "latest message queued from the same feed, or "
+                             "spill them to disk.")
+    pgroup.add_argument('--queue-spill-dir', default=None,
+                        help="Directory to spill incoming messages to. "
+                             "Defaults to .spill in the data directory.")
+    pgroup.add_argument('--queue-spill-max-bytes', type=int, default=int(1e9),
+                        help="Maximum size in bytes of spilled messages. The "
+                             "oldest are dropped beyond this.")
 
     return parser
 
@@ -1,13 +1,24 @@
 import os
 import binascii
+import fnmatch
+import heapq
+import itertools
+import json
+import queue
+import threading
 import time
 
+from collections import deque
 from typing import Dict
 
+import msgpack
+
+import numpy as np
 import txaio
 txaio.use_twisted()
 
-from ocs.ocs_feed import Block, Feed
+from ocs.ocs_feed import (ColumnarBlock, Feed, decode_feed_data,
+                          expand_timestamps)
 
 import so3g
 from spt3g import core
@@ -26,9 +37,25 @@ _g3_list_casts = {
     float: core.G3VectorDouble,
     bool: core.G3VectorBool,
 }
+# Casts for numpy arrays, by dtype kind
+_g3_array_casts = {
+    'U': core.G3VectorString,
+    'i': core.G3VectorInt,
+    'u': core.G3VectorInt,
+    'f': core.G3VectorDouble,
+    'b': core.G3VectorBool,
+}
 
 LOG = txaio.make_logger()
 
+#: File extension for each compression option. G3Writer compresses files
+#: based on their extension.
+FILE_EXTENSIONS = {
+    None: '.g3',
+    'gzip': '.g3.gz',
+    'bz2': '.g3.bz2',
+}
+
 
 def g3_cast(data, time=False):
     """
@@ -42,8 +69,12 @@ def g3_cast(data, time=False):
     convert to G3Time or G3VectorTime with the assumption that ``data`` consists
     of unix timestamps.
 
+    1-d numpy arrays of bool, int or float are copied into the G3Vector
+    straight from the array buffer, and timestamps are converted to G3Time
+    ticks in a single vectorized operation.
+
     Args:
-        data (int, str, float, or list):
+        data (int, str, float, list, or numpy.ndarray):
             Generic data to be converted to a corresponding G3Type.
         time (bool, optional):
             If True, will assume data contains unix timestamps and try to cast
@@ -53,6 +84,9 @@ def g3_cast(data, time=False):
         g3_data:
             Corresponding G3 datatype.
     """
+    if isinstance(data, np.ndarray):
+        return _g3_cast_array(data, time=time)
+
     is_list = isinstance(data, list)
     if is_list:
         dtype = type(data[0])
@@ -65,6 +99,9 @@ def g3_cast(data, time=False):
                         "be one of {}".format(dtype, _g3_casts.keys()))
     if is_list:
         if time:
+            if dtype in (int, float):
+                return _g3_cast_array(np.asarray(data, dtype=np.float64),
+                                      time=True)
             return core.G3VectorTime(list(map(
                 lambda t: core.G3Time(t * core.G3Units.s), data)))
         else:
@@ -78,6 +115,29 @@ def g3_cast(data, time=False):
             return cast(data)
 
 
+def _g3_cast_array(data, time=False):
+    """Casts a 1-d numpy array to a G3Vector, see :func:`g3_cast`."""
+    kind = data.dtype.kind
+    if data.ndim != 1 or kind not in _g3_array_casts:
+        raise TypeError("g3_cast does not support arrays of dtype {} and "
+                        "shape {}".format(data.dtype, data.shape))
+    if time:
+        if kind not in 'iuf':
+            raise TypeError("Timestamps must be numeric, not {}".format(
+                data.dtype))
+        # Truncates to integer ticks, as G3Time does
+        ticks = (data.astype(np.float64) * core.G3Units.s).astype(np.int64)
+        return core.G3VectorTime(ticks)
+    if kind == 'U':
+        return core.G3VectorString(data.tolist())
+    if (kind == 'u' and data.dtype.itemsize >= 8 and len(data)
+            and data.max() > np.iinfo(np.int64).max):
+        # Would wrap around in G3VectorInt, so cast element by element,
+        # which raises an OverflowError instead
+        return g3_cast(data.tolist())
+    return _g3_array_casts[kind](data)
+
+
 def generate_id(hksess):
     """
     Generates a unique session id based on the start_time, process_id,
@@ -98,19 +158,37 @@ def generate_id(hksess):
     return agg_session_id
 
 
-def make_filename(base_dir, make_subdirs=True):
+def make_filename(base_dir, make_subdirs=True, align=None, compression=None):
     """
     Creates a new filename based on the time and base_dir.
     If make_subdirs is True, all subdirectories will be automatically created.
     I don't think there's any reason that this shouldn't be true...
 
+    If a file with the name already exists, a suffix ``_N`` is added to the
+    name so that it isn't overwritten.
+
     Args:
         base_dir (path):
             Base path where data should be written.
         make_subdirs (bool):
             True if func should automatically create non-existing subdirs.
+        align (float, optional):
+            If set, the file is named by the start of the current period of
+            ``align`` seconds on the wall clock (e.g. the start of the hour
+            for 3600) rather than by the current time.
+        compression (str, optional):
+            Compression the file will be written with, 'gzip' or 'bz2'.
+            Sets the file extension to '.g3.gz' or '.g3.bz2', which is what
+            tells the G3Writer to compress the file.
     """
+    if compression not in FILE_EXTENSIONS:
+        raise ValueError("compression must be one of {}".format(
+            list(FILE_EXTENSIONS)))
+    ext = FILE_EXTENSIONS[compression]
+
     start_time = time.time()
+    if align:
+        start_time = start_time // align * align
 
     subdir = os.path.join(base_dir, "{:.5}".format(str(start_time)))
 
@@ -127,10 +205,30 @@ def make_filename(base_dir, make_subdirs=True):
                                     .format(subdir))
 
     time_string = int(start_time)
-    filename = os.path.join(subdir, "{}.g3".format(time_string))
+    filename = os.path.join(subdir, "{}{}".format(time_string, ext))
+    n = 1
+    while os.path.exists(filename):
+        filename = os.path.join(subdir, "{}_{}{}".format(time_string, n, ext))
+        n += 1
     return filename
 
 
+def _fsync_file(path):
+    """Waits for the OS to write a file's data to the storage device."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def frame_size(frame):
+    """Returns the size (bytes) a frame takes up when written to a G3 file.
+    The frame is serialized to find this, but the serialization is cached by
+    the frame, so it is reused when the frame is written."""
+    return len(frame.__getstate__()[1])
+
+
 class Provider:
     """
     Stores data for a single provider (OCS Feed).
@@ -151,7 +249,9 @@ class Provider:
     Attributes:
 
         blocks (dict):
-            All blocks that are written by provider.
+            All blocks that are written by provider. These are
+            :class:`ocs.ocs_feed.ColumnarBlock` objects, so that data is
+            held in typed numpy buffers that can be cast to G3 types quickly.
         frame_start_time (float):
             Start time of current frame
         fresh_time (float):
@@ -177,6 +277,10 @@ class Provider:
 
         self.blocks = {}
 
+        # Field renames for each (block_name, frozenset(field_names)) seen,
+        # or None if no renames are needed.
+        self._field_name_maps = {}
+
         # When set to True, provider will be written and removed next agg cycle
         self.frame_start_time = None
 
@@ -196,16 +300,37 @@ class Provider:
         """Refresh provider"""
         self.last_refresh = time.time()
 
-    def stale(self):
-        """Returns true if provider is stale and should be removed"""
-        return (time.time() - self.last_refresh) > self.fresh_time
+    def stale(self, now=None):
+        """Returns true if provider is stale and should be removed
+
+        Args:
+            now (float, optional): Current time. Defaults to time.time().
+        """
+        if now is None:
+            now = time.time()
+        return (now - self.last_refresh) >= self.fresh_time
 
-    def new_frame_time(self):
-        """Returns true if its time for a new frame to be written"""
+    def new_frame_time(self, now=None):
+        """Returns true if its time for a new frame to be written
+
+        Args:
+            now (float, optional): Current time. Defaults to time.time().
+        """
         if self.frame_start_time is None:
             return False
 
-        return (time.time() - self.frame_start_time) > self.frame_length
+        if now is None:
+            now = time.time()
+        return (now - self.frame_start_time) >= self.frame_length
+
+    def next_deadline(self):
+        """Returns the next time (unix timestamp) at which the provider will
+        need attention, either because its frame is due to be written or
+        because it will go stale."""
+        deadline = self.last_refresh + self.fresh_time
+        if self.frame_start_time is not None:
+            deadline = min(deadline, self.frame_start_time + self.frame_length)
+        return deadline
 
     def empty(self):
         """Returns true if all blocks are empty"""
@@ -215,29 +340,50 @@ class Provider:
 
         return True
 
-    def _verify_provider_data(self, data):
-        """Check the provider data for invalid field names. Meant to be used in
-        combination with Provider._rebuild_invalid_data().
+    def _field_name_map(self, block_name, field_names):
+        """Work out the field renames needed for a block's field names to
+        follow the field name rules. Each rename is logged.
 
         Args:
-            data (dict): data dictionary passed to Provider.save_to_block()
+            block_name (str): name of the block the fields belong to
+            field_names (iterable): field names in the block
 
         Returns:
-            bool: True if all field names valid. False if any invalid names found
+            dict: Map from each field name to its new name, or None if all
+                  field names are valid.
 
         """
-        verified = True
-        for block_name, block_dict in data.items():
-            for field_name, field_values in block_dict['data'].items():
-                try:
-                    Feed.verify_data_field_string(field_name)
-                except ValueError:
-                    self.log.error("data field name '{field}' is "
-                                   + "invalid, removing invalid characters.",
-                                   field=field_name)
-                    verified = False
+        invalid = []
+        for field_name in field_names:
+            try:
+                Feed.verify_data_field_string(field_name)
+            except ValueError:
+                invalid.append(field_name)
+
+        if not invalid:
+            return None
+
+        name_map = {}
+        new_field_names = set()
+        for field_name in field_names:
+            new_field_name = Feed.enforce_field_name_rules(field_name)
+
+            # Catch instance where rule enforcement strips all characters
+            if not new_field_name:
+                new_field_name = Feed.enforce_field_name_rules("invalid_field_" + field_name)
+
+            new_field_name = Provider._check_for_duplicate_names(new_field_name,
+                                                                 new_field_names)
+            name_map[field_name] = new_field_name
+            new_field_names.add(new_field_name)
 
-        return verified
+        for field_name in invalid:
+            self.log.error("data field name '{field}' in block '{block}' is "
+                           + "invalid, renaming to '{new}'.",
+                           field=field_name, block=block_name,
+                           new=name_map[field_name])
+
+        return name_map
 
     @staticmethod
     def _check_for_duplicate_names(field_name, name_list):
@@ -262,7 +408,7 @@ class Provider:
 
         Args:
             field_name (str): field name to check against name_lsit
-            name_list (list): list of field names already in a Block
+            name_list (list or set): field names already in a Block
 
         Returns:
             str: A new field name that is not already in name_list
@@ -278,43 +424,6 @@ class Provider:
 
         return field_name
 
-    def _rebuild_invalid_data(self, data):
-        """Rebuild an invalid data dictionary.
-
-        Args:
-            data (dict): data dictionary passed to Provider.save_to_block().
-
-        Returns:
-            dict: A rebuilt data dictionary with invalid characters stripped
-                  from the field names, limited to 255 characters in length.
-
-        """
-        new_data = {}
-        for block_name, block_dict in data.items():
-            new_data[block_name] = {}
-            # rebuild block_dict
-            for k, v in block_dict.items():
-                if k == 'data':
-                    new_data[block_name]['data'] = {}
-                    new_field_names = []
-                    for field_name, field_values in block_dict['data'].items():
-                        new_field_name = Feed.enforce_field_name_rules(field_name)
-
-                        # Catch instance where rule enforcement strips all characters
-                        if not new_field_name:
-                            new_field_name = Feed.enforce_field_name_rules("invalid_field_" + field_name)
-
-                        new_field_name = Provider._check_for_duplicate_names(new_field_name,
-                                                                             new_field_names)
-
-                        new_data[block_name]['data'][new_field_name] = field_values
-
-                        new_field_names.append(new_field_name)
-                else:
-                    new_data[block_name][k] = v
-
-        return new_data
-
     def save_to_block(self, data):
         """Saves a list of data points into blocks. A block will be created
         for any new block_name.
@@ -334,32 +443,49 @@ class Provider:
             outer data dictionary, and again under the 'block_name' value.
             These must match -- in this instance both the word 'test'.
 
+        Invalid field names are renamed to follow the field name rules. The
+        renames needed are worked out (and logged) once for each block name
+        and set of field names, and reused for later data with the same
+        structure.
+
         Args:
             data (dict): data dictionary from incoming data queue
 
         """
         self.refresh()
 
+        # Expand compacted timestamps, into new dicts so the caller's data
+        # (which may also be journaled) is left as it was
+        data = {k: dict(b, timestamps=expand_timestamps(b['timestamps'],
+                                                        as_array=True))
+                for k, b in data.items()}
+
         if self.frame_start_time is None:
             # Get min frame time out of all blocks
             self.frame_start_time = time.time()
             for _, b in data.items():
-                if b['timestamps']:
+                if len(b['timestamps']):
                     self.frame_start_time = min(self.frame_start_time, b['timestamps'][0])
 
         self.log.debug('data passed to block: {d}', d=data)
-        verified = self._verify_provider_data(data)
-
-        if not verified:
-            self.log.info('rebuilding data containing invalid field name')
-            data = self._rebuild_invalid_data(data)
-            self.log.debug('data after rebuild: {d}', d=data)
 
         for key, block in data.items():
+            schema = (key, frozenset(block['data']))
+            try:
+                name_map = self._field_name_maps[schema]
+            except KeyError:
+                name_map = self._field_name_map(key, block['data'])
+                self._field_name_maps[schema] = name_map
+
+            if name_map is not None:
+                block = dict(block)
+                block['data'] = {name_map[k]: v
+                                 for k, v in block['data'].items()}
+
             try:
                 b = self.blocks[key]
             except KeyError:
-                self.blocks[key] = Block(
+                self.blocks[key] = ColumnarBlock(
                     key, block['data'].keys(),
                 )
                 b = self.blocks[key]
@@ -374,16 +500,25 @@ class Provider:
 
         self.frame_start_time = None
 
-    def to_frame(self, hksess=None, clear=False):
+    def frame_data(self, hksess=None, clear=False):
         """
-        Returns a G3Frame based on the provider's blocks.
+        Returns what's needed to build a G3Frame of the provider's data,
+        without doing any of the casting to G3 types. This lets frames be
+        built in another thread with :func:`fill_frame`.
 
         Args:
             hksess (optional):
                 If provided, the frame will be based off of hksession's data frame.
                 If the data will be put into a clean frame.
             clear (bool):
-                Clears provider data if True.
+                Clears provider data if True. The returned block data is not
+                copied, but stays valid since clearing gives the blocks new
+                buffers.
+
+        Returns:
+            tuple: (frame, blocks), where frame is the G3Frame, with the
+            provider info but no data, and blocks is a list of (block_name,
+            timestamps, data) for each non-empty block.
         """
 
         if hksess is not None:
@@ -394,37 +529,229 @@ class Provider:
         frame['address'] = self.address
         frame['provider_session_id'] = self.sessid
 
-        block_names = []
-        for block_name, block in self.blocks.items():
-            if not block.timestamps:
-                continue
-            try:
-                m = core.G3TimesampleMap()
-                m.times = g3_cast(block.timestamps, time=True)
-                for key, ts in block.data.items():
-                    m[key] = g3_cast(ts)
-            except Exception as e:
-                self.log.warn("Error received when casting timestream! {e}",
-                              e=e)
-                continue
-            frame['blocks'].append(m)
-            block_names.append(block_name)
-
-        if 'block_names' in frame:
-            frame['block_names'].extend(block_names)
-        else:
-            frame['block_names'] = core.G3VectorString(block_names)
+        blocks = [(block_name, block.timestamps, dict(block.data))
+                  for block_name, block in self.blocks.items()
+                  if not block.empty()]
 
         if clear:
             self.clear()
-        return frame
+        return frame, blocks
+
+    def to_frame(self, hksess=None, clear=False):
+        """
+        Returns a G3Frame based on the provider's blocks.
+
+        Args:
+            hksess (optional):
+                If provided, the frame will be based off of hksession's data frame.
+                If the data will be put into a clean frame.
+            clear (bool):
+                Clears provider data if True.
+        """
+        frame, blocks = self.frame_data(hksess, clear=clear)
+        return fill_frame(frame, blocks)
+
+
+def fill_frame(frame, blocks):
+    """
+    Casts provider block data to G3 types and adds it to a frame, as returned
+    by :meth:`Provider.frame_data`. Blocks that fail to cast are logged and
+    skipped.
+
+    Args:
+        frame (core.G3Frame):
+            Frame to fill.
+        blocks (list):
+            List of (block_name, timestamps, data) tuples.
+
+    Returns:
+        core.G3Frame: The filled frame.
+    """
+    block_names = []
+    for block_name, timestamps, data in blocks:
+        try:
+            m = core.G3TimesampleMap()
+            m.times = g3_cast(timestamps, time=True)
+            for key, ts in data.items():
+                m[key] = g3_cast(ts)
+        except Exception as e:
+            LOG.warn("Error received when casting timestream! {e}",
+                     e=e)
+            continue
+        frame['blocks'].append(m)
+        block_names.append(block_name)
+
+    if 'block_names' in frame:
+        frame['block_names'].extend(block_names)
+    else:
+        frame['block_names'] = core.G3VectorString(block_names)
+
+    return frame
+
+
+class StageStats:
+    """
+    Timing statistics for one stage of the Aggregator pipeline.
+
+    Attributes:
+        count (int):
+            Number of items processed.
+        total_time (float):
+            Total time (seconds) spent processing items.
+        last_time (float):
+            Time spent on the last item.
+        max_time (float):
+            Longest time spent on an item.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.
+        self.last_time = None
+        self.max_time = 0.
+
+    def record(self, duration):
+        self.count += 1
+        self.total_time += duration
+        self.last_time = duration
+        self.max_time = max(self.max_time, duration)
+
+    def encoded(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'last_time': self.last_time,
+            'max_time': self.max_time,
+        }
+
+
+class FileIndex:
+    """
+    Sidecar index of a G3 file written by the aggregator, stored next to it
+    with an ``.idx`` extension. It lets readers find which providers, blocks
+    and fields a file holds, the time they cover, and where each data frame
+    is in the file, without reading the file itself.
+
+    The index is a JSON lines file, updated as frames are written. It
+    starts with a header line::
+
+        {"type": "header", "version": 1, "file": "1602089117.g3"}
+
+    followed by a line for each data frame, giving its byte offset and size
+    in the file and the span of each of its blocks (for compressed files,
+    the offset and size are in the uncompressed stream)::
+
+        {"type": "frame", "offset": 1460, "size": 310,
+         "address": "observatory.fake-data1.feeds.false_temperatures",
+         "blocks": [{"name": "temps", "fields": ["channel_00"],
+                     "start": 1602089117.0, "end": 1602089176.9}]}
+
+    When the file is closed a summary of all providers is added::
+
+        {"type": "summary", "frames": 60,
+         "providers": {"observatory.fake-data1.feeds.false_temperatures":
+            {"blocks": {"temps": {"fields": ["channel_00"],
+                                  "start": 1602089117.0,
+                                  "end": 1602092716.9}}}}}
+
+    This class should only be accessed via a single thread.
+
+    Args:
+        g3_file (path):
+            Path of the G3 file being indexed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, g3_file):
+        self.path = g3_file + '.idx'
+        self.frames = 0
+        self.providers = {}
+        self._file = open(self.path, 'w')
+        self._write({'type': 'header', 'version': self.VERSION,
+                     'file': os.path.basename(g3_file)})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+    def add_frame(self, frame, offset, size):
+        """Adds a data frame, written at byte ``offset`` in the G3 file, to
+        the index."""
+        address = frame['address']
+        prov = self.providers.setdefault(address, {'blocks': {}})
+
+        blocks = []
+        for name, m in zip(frame['block_names'], frame['blocks']):
+            if len(m.times) == 0:
+                continue
+            start = m.times[0].time / core.G3Units.s
+            end = m.times[-1].time / core.G3Units.s
+            fields = sorted(m.keys())
+            blocks.append({'name': name, 'fields': fields,
+                           'start': start, 'end': end})
+
+            b = prov['blocks'].setdefault(
+                name, {'fields': [], 'start': start, 'end': end})
+            b['fields'] = sorted(set(b['fields']).union(fields))
+            b['start'] = min(b['start'], start)
+            b['end'] = max(b['end'], end)
+
+        self.frames += 1
+        self._write({'type': 'frame', 'offset': offset, 'size': size,
+                     'address': address, 'blocks': blocks})
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Writes the summary and closes the index."""
+        self._write({'type': 'summary', 'frames': self.frames,
+                     'providers': self.providers})
+        self._file.close()
+
+
+def read_file_index(path):
+    """
+    Reads an index written by :class:`FileIndex`.
+
+    Args:
+        path (path):
+            Path of the index, or of the G3 file it belongs to.
+
+    Returns:
+        tuple: (frames, summary), where frames is the list of frame records
+        and summary is the summary record, or None if the file is still
+        being written (or was not closed cleanly).
+    """
+    if not path.endswith('.idx'):
+        path = path + '.idx'
+
+    frames = []
+    summary = None
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partly written last line
+                break
+            if record['type'] == 'header':
+                if record['version'] > FileIndex.VERSION:
+                    raise ValueError("Unsupported index version {}".format(
+                        record['version']))
+            elif record['type'] == 'frame':
+                frames.append(record)
+            elif record['type'] == 'summary':
+                summary = record
+    return frames, summary
 
 
 class G3FileRotator(core.G3Module):
     """
     G3 module which handles file rotation.
     After time_per_file has elapsed, the rotator will end that file and create
-    a new file with the `filename` function.
+    a new file with the `filename` function. Files can also be rotated once
+    they reach a size or number of frames.
     It will write the last_session and last_status frame to any new file if they
     exist.
 
@@ -435,12 +762,38 @@ class G3FileRotator(core.G3Module):
             time (seconds) before a new file should be written
         filename (callable):
             function that generates new filenames.
+        max_bytes (int, optional):
+            If set, rotate once the file has reached this size (before any
+            compression).
+        max_frames (int, optional):
+            If set, rotate once this many frames have been written to the
+            file.
+        align (bool, optional):
+            If True, rotate on multiples of time_per_file on the wall clock
+            (e.g. on the hour if time_per_file is 3600), rather than
+            time_per_file after the file was started.
+        fsync (bool, optional):
+            If True, flush() and close_file() also fsync the file.
+        index (bool, optional):
+            If True, write a :class:`FileIndex` alongside each file.
 
     Attributes:
         filename (function):
             Function to call to create new filename on rotation
         file_start_time (int):
             Start time for current file
+        rotate_time (float):
+            Time at which the current file will be rotated.
+        file_bytes (int):
+            Bytes written to the current file, before any compression.
+        file_frames (int):
+            Frames written to the current file.
+        unflushed_bytes (int):
+            Bytes written since the last flush.
+        last_flush (float):
+            Time of the last flush.
+        file_index (FileIndex):
+            Index of the current file, if index is True.
         writer (core.G3Writer):
             G3Writer object for current file. None if no file is open.
         last_session (core.G3Frame):
@@ -453,12 +806,24 @@ class G3FileRotator(core.G3Module):
             Path to the current file being written.
     """
 
-    def __init__(self, time_per_file, filename):
+    def __init__(self, time_per_file, filename, max_bytes=None,
+                 max_frames=None, align=False, fsync=False, index=False):
         self.time_per_file = time_per_file
         self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.align = align
+        self.fsync = fsync
+        self.index = index
+        self.file_index = None
         self.log = txaio.make_logger()
 
         self.file_start_time = None
+        self.rotate_time = None
+        self.file_bytes = 0
+        self.file_frames = 0
+        self.unflushed_bytes = 0
+        self.last_flush = time.time()
         self.writer = None
         self.last_session = None
         self.last_status = None
@@ -467,18 +832,80 @@ class G3FileRotator(core.G3Module):
     def close_file(self):
         if self.writer is not None:
             self.writer(core.G3Frame(core.G3FrameType.EndProcessing))
+            # Dropping the writer closes the file
             self.writer = None
+            if self.file_index is not None:
+                self.file_index.close()
+                self.file_index = None
+            if self.fsync:
+                _fsync_file(self.current_file)
+            self.unflushed_bytes = 0
+            self.last_flush = time.time()
 
     def flush(self):
-        """Flushes current g3 file to disk"""
+        """Flushes current g3 file to disk. If fsync is set, this also waits
+        for the data to reach the storage device.
+
+        Compressed (.g3.gz and .g3.bz2) files can't be flushed by the
+        G3Writer, so their data only reaches disk when the file is closed.
+        """
         if self.writer is not None:
-            self.writer.Flush()
+            if not self.compressed:
+                self.writer.Flush()
+                if self.fsync:
+                    _fsync_file(self.current_file)
+            if self.file_index is not None:
+                self.file_index.flush()
+        self.unflushed_bytes = 0
+        self.last_flush = time.time()
+
+    @property
+    def compressed(self):
+        """True if the current file is compressed."""
+        return (self.current_file is not None
+                and self.current_file.endswith(('.gz', '.bz2')))
+
+    def _open_file(self):
+        self.current_file = self.filename()
+        self.log.info("Creating file: {}".format(self.current_file))
+        self.writer = core.G3Writer(self.current_file)
+        if self.index:
+            self.file_index = FileIndex(self.current_file)
+        self.file_start_time = time.time()
+        self.file_bytes = 0
+        self.file_frames = 0
+
+        if self.align:
+            period = self.time_per_file
+            self.rotate_time = (self.file_start_time // period + 1) * period
+        else:
+            self.rotate_time = self.file_start_time + self.time_per_file
+
+    def _write(self, frame):
+        size = frame_size(frame)
+        if (self.file_index is not None
+                and frame['hkagg_type'] == so3g.HKFrameType.data):
+            self.file_index.add_frame(frame, self.file_bytes, size)
+        self.file_bytes += size
+        self.unflushed_bytes += size
+        self.file_frames += 1
+        self.writer(frame)
+
+    def _full(self):
+        """Returns True if the current file has reached its size or frame
+        limit."""
+        if self.max_bytes and self.file_bytes >= self.max_bytes:
+            return True
+        if self.max_frames and self.file_frames >= self.max_frames:
+            return True
+        return False
 
     def Process(self, frames):
         """
         Writes frame to current file. If file has not been started
         or time_per_file has elapsed, file is closed and a new file is created
-        by `filename` function passed to constructor
+        by `filename` function passed to constructor. The file is also
+        closed as soon as it reaches max_bytes or max_frames.
         """
         for frame in frames:
             ftype = frame['hkagg_type']
@@ -488,28 +915,293 @@ class G3FileRotator(core.G3Module):
             elif ftype == so3g.HKFrameType.status:
                 self.last_status = frame
 
+            if self.writer is not None and time.time() > self.rotate_time:
+                self.close_file()
+
             if self.writer is None:
-                self.current_file = self.filename()
-                self.log.info("Creating file: {}".format(self.current_file))
-                self.writer = core.G3Writer(self.current_file)
-                self.file_start_time = time.time()
+                self._open_file()
 
                 if ftype in [so3g.HKFrameType.data, so3g.HKFrameType.status]:
                     if self.last_session is not None:
-                        self.writer(self.last_session)
+                        self._write(self.last_session)
 
                 if ftype == so3g.HKFrameType.data:
                     if self.last_status is not None:
-                        self.writer(self.last_status)
+                        self._write(self.last_status)
+
+            self._write(frame)
 
-            self.writer(frame)
+            if self._full():
+                self.close_file()
 
-        if (time.time() - self.file_start_time) > self.time_per_file:
+        if self.writer is not None and time.time() > self.rotate_time:
             self.close_file()
 
         return frames
 
 
+class ShardAssignment:
+    """
+    Subset of providers handled by one of several aggregator instances
+    sharing the site's feeds.
+
+    By default providers are split between ``count`` shards by a hash of
+    their feed address, so each instance takes a deterministic subset
+    without needing to know about the others. If ``patterns`` are given,
+    the shard instead takes the feeds whose address matches any of the
+    (fnmatch style) patterns, and ``count`` is ignored. Patterns should not
+    overlap between instances, or the matching feeds will be written by
+    each of them.
+
+    Args:
+        index (int):
+            Index of this shard.
+        count (int, optional):
+            Number of shards providers are split between by hash.
+        patterns (list, optional):
+            Feed address patterns, e.g. ``observatory.LSA*.feeds.*``.
+
+    Attributes:
+        name (str):
+            Name of the shard, used as the subdirectory of ``data_dir`` its
+            files are written to.
+    """
+
+    def __init__(self, index, count=1, patterns=None):
+        self.index = index
+        self.count = count
+        self.patterns = list(patterns) if patterns else None
+        if self.patterns is None and not 0 <= index < count:
+            raise ValueError("Shard index {} is not in range for {} shards"
+                             .format(index, count))
+        self.name = 'shard-{}'.format(index)
+        self._accepts = {}
+
+    def accepts(self, address):
+        """Returns True if the feed at ``address`` belongs to this shard."""
+        accepted = self._accepts.get(address)
+        if accepted is None:
+            if self.patterns is not None:
+                accepted = any(fnmatch.fnmatchcase(address, p)
+                               for p in self.patterns)
+            else:
+                h = binascii.crc32(bytes(address, 'utf8'))
+                accepted = (h % self.count == self.index)
+            self._accepts[address] = accepted
+        return accepted
+
+    def encoded(self):
+        return {
+            'name': self.name,
+            'index': self.index,
+            'count': None if self.patterns is not None else self.count,
+            'patterns': self.patterns,
+        }
+
+
+class Journal:
+    """
+    Write-ahead journal of data taken in by the Aggregator, so that data
+    which hasn't been written to disk in a frame yet can be recovered if the
+    aggregator dies.
+
+    Each incoming message is appended as a msgpack record to the current
+    journal segment, a file in ``directory``. Records are numbered, and once
+    a provider's frame has been written to disk a checkpoint record notes
+    the last record number it covered. Segments are started every
+    ``segment_time`` seconds, and deleted once all of the records in them
+    are checkpointed. On startup, records that were never checkpointed can
+    be read back with :meth:`replay`.
+
+    The journal is synced to disk at most every ``sync_interval`` seconds,
+    so at most that much data is lost in a crash.
+
+    This class should only be accessed via a single thread.
+
+    Args:
+        directory (path):
+            Directory to keep journal segments in. Created if needed.
+        sync_interval (float, optional):
+            Time (sec) between syncs to disk.
+        segment_time (float, optional):
+            Time (sec) before a new segment is started.
+
+    Attributes:
+        dirty (bool):
+            True if records have been written since the last sync.
+        last_sync (float):
+            Time of the last sync.
+    """
+
+    def __init__(self, directory, sync_interval=1., segment_time=60.):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.segment_time = segment_time
+
+        # Segments left by a previous run, to be replayed
+        self._old_segments = sorted(
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if f.endswith('.msgpack'))
+
+        self._seq = 0
+        self._record = 0
+        for path in self._old_segments:
+            seq = int(os.path.basename(path).split('.')[0])
+            self._seq = max(self._seq, seq + 1)
+
+        # (path, {(address, sessid): last record}) of closed segments
+        self._segments = deque()
+        self._checkpoints = {}
+        self._file = None
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+        self.dirty = False
+        self.last_sync = time.time()
+        self._new_segment()
+
+    def _new_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._segments.append((self._path, self._contents))
+        self._path = os.path.join(self.directory,
+                                  '{:012d}.msgpack'.format(self._seq))
+        self._seq += 1
+        self._contents = {}
+        self._file = open(self._path, 'ab')
+        self._segment_start = time.time()
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            # A record cut off by a crash ends the iteration
+            yield from msgpack.Unpacker(f, raw=False)
+
+    def replay(self):
+        """
+        Reads back the records left by a previous run that were never
+        checkpointed. Once they have been appended to this journal again,
+        the old segments should be removed with :meth:`discard_old`.
+
+        Returns:
+            list: (feed, data) pairs, in the order they were received.
+        """
+        checkpoints = {}
+        records = []
+        for path in self._old_segments:
+            for rec in self._read(path):
+                if rec[0] == 'c':
+                    _, address, sessid, n = rec
+                    key = (address, sessid)
+                    checkpoints[key] = max(checkpoints.get(key, -1), n)
+                else:
+                    records.append(rec)
+                    self._record = max(self._record, rec[1] + 1)
+
+        replay = []
+        for _, n, feed, data in records:
+            key = (feed['address'], feed['session_id'])
+            if n > checkpoints.get(key, -1):
+                replay.append((feed, data))
+        return replay
+
+    def discard_old(self):
+        """Removes segments left by a previous run."""
+        for path in self._old_segments:
+            os.remove(path)
+        self._old_segments = []
+
+    @property
+    def next_record(self):
+        """Record number that the next appended message will get, unless
+        it's numbered by the caller."""
+        return self._record
+
+    def append(self, feed, data, n=None):
+        """
+        Appends a message to the journal.
+
+        Args:
+            feed (dict):
+                Feed the data came from. Only the fields needed to replay
+                the data are kept.
+            data (dict):
+                Data from the feed, as it was received.
+            n (int, optional):
+                Record number of the message, if numbered by the caller
+                (see :attr:`next_record`). Records must be appended in
+                order.
+
+        Returns:
+            int: Record number of the message.
+        """
+        if n is None:
+            n = self._record
+        self._record = n + 1
+        feed = {'address': feed['address'],
+                'session_id': feed['session_id'],
+                'agg_params': feed['agg_params']}
+        self._file.write(self._packer.pack(['d', n, feed, data]))
+        self._contents[(feed['address'], feed['session_id'])] = n
+        self.dirty = True
+        return n
+
+    def checkpoint(self, address, sessid, n):
+        """Notes that records up to ``n`` from a provider have been written
+        to disk."""
+        self._file.write(self._packer.pack(['c', address, sessid, n]))
+        key = (address, sessid)
+        self._checkpoints[key] = max(self._checkpoints.get(key, -1), n)
+        self.dirty = True
+
+    def next_sync(self):
+        """Returns the time of the next sync, or None if there is nothing to
+        sync."""
+        if not self.dirty:
+            return None
+        return self.last_sync + self.sync_interval
+
+    def sync(self, force=False):
+        """
+        Syncs the journal to disk if sync_interval has passed (or force is
+        True), starts a new segment if segment_time has passed, and removes
+        segments that are fully checkpointed.
+        """
+        now = time.time()
+        if self.dirty and (force or now >= self.last_sync + self.sync_interval):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.dirty = False
+            self.last_sync = now
+
+        if now - self._segment_start >= self.segment_time and self._contents:
+            self._new_segment()
+
+        while self._segments:
+            path, contents = self._segments[0]
+            for key, n in contents.items():
+                if self._checkpoints.get(key, -1) < n:
+                    return
+            os.remove(path)
+            self._segments.popleft()
+
+    def close(self, remove=False):
+        """
+        Closes the journal.
+
+        Args:
+            remove (bool):
+                If True, all segments are removed. Should only be used once
+                everything journaled has been written to disk.
+        """
+        self._file.close()
+        if remove:
+            for path, _ in self._segments:
+                os.remove(path)
+            os.remove(self._path)
+            self._segments.clear()
+
+
 class Aggregator:
     """Data aggregator. This manages a collection of providers, and contains
     methods to write them to disk.
@@ -517,6 +1209,23 @@ class Aggregator:
     This class should only be accessed by a single thread. Data can be passed
     to it by appending it to the referenced `incoming_data` queue.
 
+    Writing to disk is done by a pipeline of three stages, linked by bounded
+    queues, so a slow disk doesn't stall ingestion and casting large frames
+    doesn't stall the disk:
+
+    1. Ingestion, in the thread calling :meth:`run`, moves incoming data into
+       providers and queues up the frames due to be written.
+    2. A frame building thread casts provider data to G3 types.
+    3. A writer thread passes the frames to the G3FileRotator, which is only
+       ever used from this thread once the pipeline has started.
+
+    If a queue fills up, the stage feeding it blocks until there is room.
+
+    If the journal is on, a journal thread appends incoming data to it and
+    syncs it to disk, so that slow journal I/O doesn't stall ingestion
+    either. Its queue is unbounded, since the messages waiting in it are also
+    held by the providers until written.
+
     Args:
         incoming_data (queue.Queue):
             A thread-safe queue of (data, feed) pairs.
@@ -527,6 +1236,43 @@ class Aggregator:
         session (OpSession, optional):
             Session object of current agent process. If not specified, session
             data will not be written.
+        queue_size (int, optional):
+            Maximum number of frames waiting in each of the pipeline queues.
+        max_file_bytes (int, optional):
+            If set, rotate files once they reach this size.
+        max_file_frames (int, optional):
+            If set, rotate files once they contain this many frames.
+        align_files (bool, optional):
+            If True, rotate files on multiples of time_per_file on the wall
+            clock, and name them by the start of that period.
+        durability (str, optional):
+            How hard the writer tries to get data onto disk. 'none' leaves it
+            to the G3Writer's buffering (data is only flushed when files are
+            closed), 'flush' flushes the G3Writer to the OS, and 'fsync' also
+            waits for the OS to write it to the storage device. Defaults to
+            'flush'. Compressed files can only be written out when they are
+            closed, so with compression this is always 'none'.
+        flush_bytes (int, optional):
+            Flush once this many bytes have been written since the last
+            flush.
+        flush_interval (float, optional):
+            Flush once this long (sec) has passed since the last flush, if
+            anything has been written. If neither flush_bytes nor
+            flush_interval are set, the writer flushes whenever it has no
+            more frames waiting.
+        file_index (bool, optional):
+            If True (the default), write a :class:`FileIndex` alongside each
+            file.
+        journal (bool, optional):
+            If True, keep a :class:`Journal` of incoming data in
+            ``data_dir/.journal``, and replay data left there by a previous
+            run that didn't make it to disk. Defaults to False. Data is
+            only dropped from the journal once it's been flushed to disk,
+            which with ``durability='none'`` is when its file is closed.
+        journal_sync (float, optional):
+            Time (sec) between syncs of the journal to disk.
+        compression (str, optional):
+            Compress files with 'gzip' or 'bz2'. Defaults to no compression.
 
     Attributes:
         log (txaio.Logger):
@@ -546,11 +1292,46 @@ class Aggregator:
             If true, a status frame will be written next time providers are
             written to disk. This is set to True whenever a provider is added
             or removed.
+        schedule_lag (float):
+            Time between the last provider deadline handled and when it was
+            handled.
+        max_schedule_lag (float):
+            Largest schedule_lag seen.
+        frame_queue (queue.Queue):
+            Queue of (frame, blocks) waiting for the frame building stage. If
+            blocks is None the frame is ready to be written.
+        write_queue (queue.Queue):
+            Queue of frames waiting for the writer stage.
+        journal_queue (queue.Queue):
+            Queue of messages waiting to be journaled, if the journal is on.
+        stats (dict):
+            StageStats for the 'ingest', 'build', 'write', 'flush' and
+            'journal' stages.
     """
 
-    def __init__(self, incoming_data, time_per_file, data_dir, session=None):
+    DURABILITY = ['none', 'flush', 'fsync']
+
+    def __init__(self, incoming_data, time_per_file, data_dir, session=None,
+                 queue_size=100, max_file_bytes=None, max_file_frames=None,
+                 align_files=False, durability='flush', flush_bytes=None,
+                 flush_interval=None, file_index=True, journal=False,
+                 journal_sync=1., compression=None):
+        if compression not in FILE_EXTENSIONS:
+            raise ValueError("compression must be one of {}".format(
+                list(FILE_EXTENSIONS)))
+        if durability not in self.DURABILITY:
+            raise ValueError("durability must be one of {}".format(
+                self.DURABILITY))
         self.log = txaio.make_logger()
 
+        if compression is not None and durability != 'none':
+            self.log.info("Compressed files are only written to disk when "
+                          "closed, using durability 'none'")
+            durability = 'none'
+        self.durability = durability
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
         self.hksess = so3g.hk.HKSessionHelper(description="HK data",
                                               hkagg_version=HKAGG_VERSION)
         self.hksess.start_time = time.time()
@@ -558,9 +1339,16 @@ class Aggregator:
 
         self.incoming_data = incoming_data
 
+        align = time_per_file if align_files else None
         self.writer = G3FileRotator(
             time_per_file,
-            lambda: make_filename(data_dir, make_subdirs=True),
+            lambda: make_filename(data_dir, make_subdirs=True, align=align,
+                                  compression=compression),
+            max_bytes=max_file_bytes,
+            max_frames=max_file_frames,
+            align=align_files,
+            fsync=(durability == 'fsync'),
+            index=file_index,
         )
         self.writer.Process([self.hksess.session_frame()])
 
@@ -571,33 +1359,291 @@ class Aggregator:
         self.write_status = False
         self.session = session
 
-    def process_incoming_data(self):
+        # Heap of (deadline, pid) at which each provider next needs a frame
+        # written or a stale check. Entries are invalidated lazily: only the
+        # one matching self._scheduled[pid] is live, others are skipped.
+        self._deadlines = []
+        self._scheduled = {}
+        self.schedule_lag = None
+        self.max_schedule_lag = 0.
+
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            'ingest': StageStats(),
+            'build': StageStats(),
+            'write': StageStats(),
+            'flush': StageStats(),
+            'journal': StageStats(),
+        }
+        self._stage_error = None
+        self._closed = False
+
+        # Last journal record saved by each provider, and (address, sessid,
+        # record) of frames that have been written to disk.
+        self._journal_records = {}
+        self._written = deque()
+        self._pending_written = []
+        self.journal = None
+        self.journal_queue = queue.Queue()
+        self._journal_thread = None
+        if journal:
+            self.journal = Journal(os.path.join(data_dir, '.journal'),
+                                   sync_interval=journal_sync)
+            replay = self.journal.replay()
+            self._journal_seq = itertools.count(self.journal.next_record)
+            if replay:
+                self.log.info("Replaying {n} messages from journal",
+                              n=len(replay))
+            for feed, data in replay:
+                self._ingest(data, feed)
+            # The journal thread isn't running yet, so journal the replayed
+            # data here, before the old segments are removed
+            while not self.journal_queue.empty():
+                self._journal_item(self.journal_queue.get())
+            self.journal.sync(force=True)
+            self.journal.discard_old()
+            self._journal_thread = threading.Thread(
+                target=self._run_journal, name='agg-journal', daemon=True)
+            self._journal_thread.start()
+
+        self._threads = [
+            threading.Thread(target=self._build_frames, name='agg-build',
+                             daemon=True),
+            threading.Thread(target=self._write_frames, name='agg-write',
+                             daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _build_frames(self):
+        """Frame building stage. Runs in its own thread."""
+        while True:
+            item = self.frame_queue.get()
+            if item is None:
+                self.write_queue.put(None)
+                return
+            frame, blocks, written = item
+            if blocks is not None:
+                t0 = time.time()
+                frame = fill_frame(frame, blocks)
+                self.stats['build'].record(time.time() - t0)
+            self.write_queue.put((frame, written))
+
+    def _flush_due(self):
+        """Returns True if the writer should be flushed, based on the
+        durability mode and flush budgets."""
+        if self.durability == 'none' or not self.writer.unflushed_bytes:
+            return False
+        if self.flush_bytes is None and self.flush_interval is None:
+            return self.write_queue.empty()
+        if self.flush_bytes is not None and \
+                self.writer.unflushed_bytes >= self.flush_bytes:
+            return True
+        if self.flush_interval is not None and \
+                time.time() - self.writer.last_flush >= self.flush_interval:
+            return True
+        return False
+
+    def _flush_wait(self):
+        """Returns how long the writer thread can wait for a frame before a
+        flush is due, or None to wait indefinitely."""
+        if (self.durability == 'none' or self.flush_interval is None
+                or not self.writer.unflushed_bytes):
+            return None
+        return max(0, self.writer.last_flush + self.flush_interval
+                   - time.time())
+
+    def _write_frames(self):
+        """Writer stage. Runs in its own thread, and is the only user of
+        self.writer once the pipeline has started."""
+        while True:
+            try:
+                item = self.write_queue.get(timeout=self._flush_wait())
+            except queue.Empty:
+                item = frame = written = False
+            else:
+                frame, written = item if item is not None else (None, None)
+            try:
+                if frame is None:
+                    self.writer.close_file()
+                    self._written.extend(self._pending_written)
+                    return
+                t0 = time.time()
+                if frame is not False:
+                    n_before = len(self._pending_written)
+                    last_flush = self.writer.last_flush
+                    self.writer.Process([frame])
+                    if written is not None:
+                        self._pending_written.append(written)
+                if self.durability == 'none':
+                    # Nothing is flushed until a file is closed, so frames
+                    # are only safe (and can be checkpointed in the journal)
+                    # once their file has been closed
+                    if (frame is not False
+                            and self.writer.last_flush != last_flush):
+                        n = n_before if self.writer.unflushed_bytes \
+                            else len(self._pending_written)
+                        self._written.extend(self._pending_written[:n])
+                        self._pending_written = self._pending_written[n:]
+                elif self._flush_due():
+                    self.writer.flush()
+                    self._written.extend(self._pending_written)
+                    self._pending_written = []
+                    self.stats['flush'].record(time.time() - t0)
+                if frame is not False:
+                    self.stats['write'].record(time.time() - t0)
+            except Exception as e:
+                self.log.error("Error writing frame: {e}", e=e)
+                self._stage_error = e
+                if frame is None:
+                    return
+
+    def _queue_frame(self, frame, blocks=None, prov=None):
+        """Passes a frame (and, if not yet filled, its block data) into the
+        pipeline. If the frame holds a provider's data, the provider is
+        passed so the journal can be checkpointed once it's written."""
+        if self._stage_error is not None:
+            raise RuntimeError("Aggregator pipeline failed") from self._stage_error
+        written = None
+        if prov is not None and prov.prov_id in self._journal_records:
+            written = (prov.address, prov.sessid,
+                       self._journal_records[prov.prov_id])
+        self.frame_queue.put((frame, blocks, written))
+
+    def _journal_item(self, item):
+        """Appends a (feed, data, record number) item from the journal_queue
+        to the journal."""
+        t0 = time.time()
+        self.journal.append(*item)
+        self.stats['journal'].record(time.time() - t0)
+
+    def _checkpoint_journal(self, force=False):
+        """Checkpoints frames that have been written, and syncs the
+        journal."""
+        while self._written:
+            self.journal.checkpoint(*self._written.popleft())
+        self.journal.sync(force=force)
+
+    def _run_journal(self):
+        """Journal stage. Runs in its own thread, and is the only user of
+        self.journal once the pipeline has started."""
+        while True:
+            next_sync = self.journal.next_sync()
+            if next_sync is None:
+                # Wake up anyway to checkpoint written frames
+                next_sync = time.time() + self.journal.sync_interval
+            try:
+                item = self.journal_queue.get(
+                    timeout=max(0, next_sync - time.time()))
+            except queue.Empty:
+                item = False
+            # None stops the thread, and an Event asks for a sync (see
+            # _sync_journal)
+            sync = item is None or isinstance(item, threading.Event)
+            try:
+                if isinstance(item, tuple):
+                    self._journal_item(item)
+                self._checkpoint_journal(force=sync)
+                if item is None:
+                    return
+            except Exception as e:
+                self.log.error("Error writing journal: {e}", e=e)
+                self._stage_error = e
+                if item is None:
+                    return
+            finally:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _sync_journal(self, timeout=None):
+        """Waits for the journal thread to journal everything queued so
+        far, checkpoint written frames and sync the journal to disk."""
+        if self._journal_thread is None:
+            return
+        done = threading.Event()
+        self.journal_queue.put(done)
+        done.wait(timeout)
+
+    def pipeline_status(self):
+        """Returns a dict of stage timing and queue depths, for session.data."""
+        status = {k: v.encoded() for k, v in self.stats.items()}
+        status['build']['queue_depth'] = self.frame_queue.qsize()
+        status['write']['queue_depth'] = self.write_queue.qsize()
+        status['journal']['queue_depth'] = self.journal_queue.qsize()
+        return status
+
+    def process_incoming_data(self, timeout=0):
         """
         Takes all data from the incoming_data queue, and puts them into
         provider blocks.
-        """
-        while not self.incoming_data.empty():
-
-            data, feed = self.incoming_data.get()
-            agg_params = feed['agg_params']
-
-            if agg_params.get('exclude_aggregator', False):
-                continue
 
-            address = feed['address']
-            sessid = feed['session_id']
-
-            pid = self.pids.get((address, sessid))
-            if pid is None:
-                prov_kwargs = {}
-                for key in ['frame_length', 'fresh_time']:
-                    if key in agg_params:
-                        prov_kwargs[key] = agg_params[key]
-
-                pid = self.add_provider(address, sessid, **prov_kwargs)
+        Args:
+            timeout (float, optional):
+                Time (sec) to wait for data if the queue is empty. If None,
+                wait until data arrives. Once something has arrived the rest
+                of the queue is drained without waiting. A None on the queue
+                stops the drain early, and can be used to wake up a waiting
+                caller.
 
-            prov = self.providers[pid]
-            prov.save_to_block(data)
+        Returns:
+            float: Time (sec) spent processing data, not counting the wait.
+        """
+        block = timeout is None or timeout > 0
+        t0 = None
+        while True:
+            try:
+                item = self.incoming_data.get(block=block, timeout=timeout)
+            except queue.Empty:
+                break
+            if t0 is None:
+                t0 = time.time()
+            block = False
+
+            if item is None:
+                break
+
+            data, feed = item
+            self._ingest(data, feed)
+
+        if t0 is None:
+            return 0.
+        return time.time() - t0
+
+    def _ingest(self, data, feed):
+        """Puts data from a feed into its provider's blocks, adding the
+        provider if needed, and journals it."""
+        agg_params = feed['agg_params']
+
+        if agg_params.get('exclude_aggregator', False):
+            return
+
+        try:
+            decoded = decode_feed_data(data, as_arrays=True)
+        except ValueError as e:
+            self.log.error("Could not decode data from {f}: {e}",
+                           f=feed['address'], e=e)
+            return
+
+        address = feed['address']
+        sessid = feed['session_id']
+
+        pid = self.pids.get((address, sessid))
+        if pid is None:
+            prov_kwargs = {}
+            for key in ['frame_length', 'fresh_time']:
+                if key in agg_params:
+                    prov_kwargs[key] = agg_params[key]
+
+            pid = self.add_provider(address, sessid, **prov_kwargs)
+
+        prov = self.providers[pid]
+        prov.save_to_block(decoded)
+        if self.journal is not None:
+            n = next(self._journal_seq)
+            self.journal_queue.put((feed, data, n))
+            self._journal_records[pid] = n
+        self._schedule(prov)
 
     def add_provider(self, prov_address, prov_sessid, **prov_kwargs):
         """
@@ -624,6 +1670,7 @@ class Aggregator:
 
         self.pids[(prov_address, prov_sessid)] = pid
         self.write_status = True
+        self._schedule(self.providers[pid])
         return pid
 
     def remove_provider(self, prov):
@@ -638,33 +1685,76 @@ class Aggregator:
         addr, sessid = prov.address, prov.sessid
 
         if not prov.empty():
-            self.writer.Process([prov.to_frame(self.hksess, clear=False)])
+            self._queue_frame(*prov.frame_data(self.hksess, clear=False),
+                              prov=prov)
 
         self.log.info("Removing provider {}".format(prov.address))
         self.hksess.remove_provider(pid)
         del self.providers[pid]
         del self.pids[(addr, sessid)]
+        self._scheduled.pop(pid, None)
+        self._journal_records.pop(pid, None)
         self.write_status = True
 
-    def remove_stale_providers(self):
+    def _schedule(self, prov):
+        """Makes sure the deadline heap will wake us for the provider's next
+        deadline. If the provider already has an earlier deadline scheduled
+        it is kept, and the provider is rescheduled once that passes."""
+        deadline = prov.next_deadline()
+        scheduled = self._scheduled.get(prov.prov_id)
+        if scheduled is not None and scheduled <= deadline:
+            return
+        self._scheduled[prov.prov_id] = deadline
+        heapq.heappush(self._deadlines, (deadline, prov.prov_id))
+
+    def _due_providers(self, now):
+        """Pops all providers with deadlines at or before ``now`` off of the
+        deadline heap. They must be rescheduled with _schedule once handled.
         """
-        Loops through all providers and check if they've gone stale. If they
+        due = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, pid = heapq.heappop(self._deadlines)
+            if self._scheduled.get(pid) != deadline:
+                continue
+            del self._scheduled[pid]
+            due.append(self.providers[pid])
+
+            self.schedule_lag = now - deadline
+            self.max_schedule_lag = max(self.max_schedule_lag,
+                                        self.schedule_lag)
+        return due
+
+    def remove_stale_providers(self, providers=None, now=None):
+        """
+        Loops through providers and check if they've gone stale. If they
         have, write their remaining data to disk (they shouldn't have any)
         and delete them.
+
+        Args:
+            providers (list, optional):
+                Providers to check. Defaults to all providers.
+            now (float, optional):
+                Current time. Defaults to time.time().
         """
+        if providers is None:
+            providers = list(self.providers.values())
+        if now is None:
+            now = time.time()
+
         stale_provs = []
 
-        for pid, prov in self.providers.items():
-            if prov.stale():
+        for prov in providers:
+            if prov.stale(now):
                 self.log.info("Provider {} went stale".format(prov.address))
                 stale_provs.append(prov)
 
         for prov in stale_provs:
             self.remove_provider(prov)
 
-    def write_to_disk(self, clear=True, write_all=False):
+    def write_to_disk(self, clear=True, write_all=False, providers=None,
+                      now=None):
         """
-        Loop through all providers, and write their data to the frame_queue
+        Loop through providers, and write their data to the frame_queue
         if they have surpassed their frame_time, or if write_all is True.
 
         Args:
@@ -673,40 +1763,95 @@ class Aggregator:
             write_all (bool):
                 If true all providers are written to disk regardless of whether
                 frame_time has passed.
+            providers (list, optional):
+                Providers to check. Defaults to all providers.
+            now (float, optional):
+                Current time. Defaults to time.time().
         """
-
-        frames = []
+        if providers is None:
+            providers = list(self.providers.values())
+        if now is None:
+            now = time.time()
 
         if self.write_status:
-            frames.append(self.hksess.status_frame())
+            self._queue_frame(self.hksess.status_frame())
             self.write_status = False
 
-        for pid, prov in self.providers.items():
+        for prov in providers:
             if prov.empty():
                 continue
-            if write_all or prov.new_frame_time():
-                frames.append(prov.to_frame(self.hksess, clear=clear))
-
-        self.writer.Process(frames)
-
-    def run(self):
+            if write_all or prov.new_frame_time(now):
+                self._queue_frame(*prov.frame_data(self.hksess, clear=clear),
+                                  prov=prov)
+
+    def next_deadline(self):
+        """Returns the earliest time (unix timestamp) at which a provider
+        will need a frame written or a stale check, or None if there are no
+        providers."""
+        while self._deadlines:
+            deadline, pid = self._deadlines[0]
+            if self._scheduled.get(pid) == deadline:
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+
+    def run(self, timeout=0):
         """
         Main run iterator for the aggregator. This processes all incoming data,
         removes stale providers, and writes active providers to disk.
+
+        Args:
+            timeout (float, optional):
+                Maximum time (sec) to wait for incoming data. If None, wait
+                until data arrives or the next provider deadline. The wait
+                is always cut short by the next provider deadline.
         """
-        self.process_incoming_data()
-        self.remove_stale_providers()
-        self.write_to_disk()
-        self.writer.flush()
+        deadline = self.next_deadline()
+        if deadline is not None:
+            wait = max(0, deadline - time.time())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        busy = self.process_incoming_data(timeout=timeout)
+
+        t0 = time.time()
+        # Only providers with a deadline that has passed need checking
+        due = self._due_providers(t0)
+        self.remove_stale_providers(due, now=t0)
+        due = [prov for prov in due if prov.prov_id in self.providers]
+        self.write_to_disk(providers=due, now=t0)
+        for prov in due:
+            self._schedule(prov)
+        self.stats['ingest'].record(busy + time.time() - t0)
+
         if self.session is not None:
             self.session.data = {
                 'current_file': self.writer.current_file,
-                'providers': {}
+                'providers': {},
+                'pipeline': self.pipeline_status(),
+                'scheduling': {
+                    'last_lag': self.schedule_lag,
+                    'max_lag': self.max_schedule_lag,
+                    'scheduled': len(self._scheduled),
+                },
             }
             for addr, prov in self.provider_archive.items():
                 self.session.data['providers'][addr] = prov.encoded()
 
     def close(self):
-        """Flushes all remaining providers and closes file."""
-        self.write_to_disk(write_all=True)
-        self.writer.close_file()
+        """Flushes all remaining providers, waits for the pipeline to write
+        them, and closes file. If everything was written the journal is
+        removed."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.write_to_disk(write_all=True)
+        finally:
+            self.frame_queue.put(None)
+            for t in self._threads:
+                t.join()
+
+            if self._journal_thread is not None:
+                self.journal_queue.put(None)
+                self._journal_thread.join()
+                self.journal.close(remove=self._stage_error is None)
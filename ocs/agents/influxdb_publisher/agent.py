@@ -1,5 +1,4 @@
 import time
-import queue
 import argparse
 import txaio
 
@@ -7,8 +6,9 @@ from os import environ
 
 from ocs import ocs_agent, site_config
 from ocs.base import OpCode
+from ocs.ocs_feed import FeedQueue
 
-from ocs.agents.influxdb_publisher.drivers import Publisher
+from ocs.agents.influxdb_publisher.drivers import InfluxDBV2Driver, Publisher
 
 # For logging
 txaio.use_twisted()
@@ -33,9 +33,10 @@ class InfluxDBAgent:
             Path to the base directory where data should be written.
         aggregate (bool):
            Specifies if the agent is currently aggregating data.
-        incoming_data (queue.Queue):
+        incoming_data (FeedQueue):
             Thread-safe queue where incoming (data, feed) pairs are stored
-            before being passed to the Publisher.
+            before being passed to the Publisher. Its size is bounded by
+            --queue-max-messages and --queue-max-bytes.
         loop_time (float):
             Time between iterations of the run loop.
     """
@@ -46,7 +47,12 @@ class InfluxDBAgent:
         self.args = args
 
         self.aggregate = False
-        self.incoming_data = queue.Queue()
+        self.incoming_data = FeedQueue(
+            max_messages=args.queue_max_messages,
+            max_bytes=args.queue_max_bytes,
+            policy=args.queue_policy,
+            spill_dir=args.queue_spill_dir,
+            spill_max_bytes=args.queue_spill_max_bytes)
         self.loop_time = 1
 
         self.agent.subscribe_on_start(self._enqueue_incoming_data,
@@ -74,6 +80,25 @@ class InfluxDBAgent:
 
         self.incoming_data.put((data, feed))
 
+    def _make_driver(self):
+        """Returns the driver selected by --driver, or None for the default
+        v1 driver."""
+        if self.args.driver != 'v2':
+            return None
+        token = self.args.token or environ.get('INFLUXDB_TOKEN')
+        if not token:
+            raise ValueError("The v2 driver needs a token, from --token or "
+                             "the INFLUXDB_TOKEN environment variable")
+        if not self.args.org:
+            raise ValueError("The v2 driver needs an organization, from "
+                             "--org")
+        return InfluxDBV2Driver(self.args.host,
+                                self.args.org,
+                                self.args.bucket or self.args.database,
+                                token,
+                                port=self.args.port,
+                                gzip=self.args.gzip)
+
     @ocs_agent.param('test_mode', default=False, type=bool)
     def record(self, session: ocs_agent.OpSession, params):
         """record()
@@ -86,6 +111,36 @@ class InfluxDBAgent:
             test_mode (bool, optional): Run the record Process loop only once.
                 This is meant only for testing. Default is False.
 
+        Notes:
+            The state of the queue of incoming messages (see
+            :meth:`ocs.ocs_feed.FeedQueue.stats`) and of the writer (see
+            :meth:`ocs.agents.influxdb_publisher.drivers.WritePipeline.status`)
+            are returned in the session data::
+
+                >>> response.session['data']
+                {"incoming_queue": {
+                    "depth": 0, "bytes": 0, "high_water": 14,
+                    "high_water_bytes": 3584, "dropped": 0,
+                    "feeds": {
+                        "observatory.fake-data1.feeds.false_temperatures": {
+                            "queued": 0, "dropped": 0, "high_water": 7}}},
+                 "writer": {
+                    "pending_chunks": 0, "pending_points": 0,
+                    "written_points": 8400, "dropped_points": 0,
+                    "failed_requests": 2, "backoff": 0.0,
+                    "batch_bytes": 1250000, "points_per_sec": 840.0,
+                    "bytes_per_sec": 92400.0,
+                    "latency": {
+                        "buckets": [0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0,
+                                    30.0],
+                        "counts": [0, 12, 30, 2, 0, 0, 0, 0, 0],
+                        "last": 0.021, "max": 0.12}}}
+
+            Rates are averaged over the last 10 seconds. The latency
+            histogram counts write requests by how long they took, with
+            each bucket counting requests up to its upper edge (in
+            seconds), and the last counting anything slower.
+
         """
         session.set_status('starting')
         self.aggregate = True
@@ -97,6 +152,15 @@ class InfluxDBAgent:
                               port=self.args.port,
                               protocol=self.args.protocol,
                               gzip=self.args.gzip,
+                              n_writers=self.args.writers,
+                              max_pending_points=self.args.max_pending_points,
+                              spill_dir=self.args.spill_dir,
+                              spill_max_bytes=self.args.spill_max_bytes,
+                              max_backoff=self.args.max_backoff,
+                              batch_bytes=self.args.batch_bytes,
+                              max_batch_bytes=self.args.max_batch_bytes,
+                              target_latency=self.args.target_latency,
+                              driver=self._make_driver(),
                               )
 
         session.set_status('running')
@@ -104,11 +168,14 @@ class InfluxDBAgent:
             time.sleep(self.loop_time)
             self.log.debug(f"Approx. queue size: {self.incoming_data.qsize()}")
             publisher.run()
+            session.data = {'incoming_queue': self.incoming_data.stats(),
+                            'writer': publisher.writer.status()}
 
             if params['test_mode']:
                 break
 
         publisher.close()
+        session.data['writer'] = publisher.writer.status()
 
         return True, "Aggregation has ended"
 
@@ -150,6 +217,64 @@ def make_parser(parser=None):
                         type=bool,
                         default=False,
                         help="Use gzip content encoding to compress requests.")
+    pgroup.add_argument('--driver', default='v1', choices=['v1', 'v2'],
+                        help="InfluxDB write API to use: 'v1' for InfluxDB "
+                             "1.x, or 'v2' for InfluxDB 2.x, which needs "
+                             "--org and a token, and only supports the line "
+                             "protocol.")
+    pgroup.add_argument('--org', default=None,
+                        help="Organization to write to, for the v2 driver.")
+    pgroup.add_argument('--bucket', default=None,
+                        help="Bucket to write to, for the v2 driver. "
+                             "Defaults to --database. It must already "
+                             "exist.")
+    pgroup.add_argument('--token', default=None,
+                        help="API token for the v2 driver. Defaults to the "
+                             "INFLUXDB_TOKEN environment variable.")
+    pgroup.add_argument('--writers', type=int, default=2,
+                        help="Number of concurrent writes to InfluxDB.")
+    pgroup.add_argument('--max-pending-points', type=int, default=1000000,
+                        help="Maximum number of points held in memory "
+                             "waiting to be written, for instance while "
+                             "InfluxDB is down.")
+    pgroup.add_argument('--spill-dir', default=None,
+                        help="Directory to spill points to beyond "
+                             "--max-pending-points, to be written once "
+                             "InfluxDB recovers. If not set, the oldest "
+                             "points are dropped instead.")
+    pgroup.add_argument('--spill-max-bytes', type=int, default=int(1e9),
+                        help="Maximum size in bytes of spilled points.")
+    pgroup.add_argument('--max-backoff', type=float, default=60.,
+                        help="Longest time in seconds between retries of "
+                             "failed writes.")
+    pgroup.add_argument('--batch-bytes', type=int, default=int(1e6),
+                        help="Initial size in bytes of each write request. "
+                             "This adapts to how long requests take.")
+    pgroup.add_argument('--max-batch-bytes', type=int, default=int(8e6),
+                        help="Largest size in bytes of each write request.")
+    pgroup.add_argument('--target-latency', type=float, default=1.,
+                        help="Time in seconds write requests should take. "
+                             "Requests are made smaller if they take longer, "
+                             "and larger if they take less than half this.")
+    pgroup.add_argument('--queue-max-messages', type=int, default=0,
+                        help="Maximum number of incoming messages waiting to "
+                             "be published. If 0, no limit.")
+    pgroup.add_argument('--queue-max-bytes', type=int, default=0,
+                        help="Maximum estimated size in bytes of incoming "
+                             "messages waiting to be published. If 0, no "
+                             "limit.")
+    pgroup.add_argument('--queue-policy', default='drop_oldest',
+                        choices=['drop_oldest', 'coalesce', 'spill'],
+                        help="What to do with incoming messages once the "
+                             "queue is full: drop the oldest, replace the "
+                             "latest message queued from the same feed, or "
+                             "spill them to --queue-spill-dir.")
+    pgroup.add_argument('--queue-spill-dir', default=None,
+                        help="Directory to spill incoming messages to, "
+                             "required for the 'spill' policy.")
+    pgroup.add_argument('--queue-spill-max-bytes', type=int, default=int(1e9),
+                        help="Maximum size in bytes of spilled messages. The "
+                             "oldest are dropped beyond this.")
 
     return parser
 
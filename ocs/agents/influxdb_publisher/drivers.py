@@ -1,10 +1,20 @@
+import json
+import threading
 import time
+import zlib
+import numpy as np
+import requests
 import txaio
 
+from collections import deque
+
 from datetime import datetime, timezone
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout as RequestsTimeout
+
+from ocs.ocs_feed import _SpillRing, decode_feed_data, expand_timestamps
 
 # For logging
 txaio.use_twisted()
@@ -31,6 +41,854 @@ def timestamp2influxtime(time, protocol):
     return influx_t
 
 
+def _escape_measurement(name):
+    """Escape a measurement name for line protocol."""
+    return (name.replace('\\', '\\\\').replace(',', r'\,')
+            .replace(' ', r'\ ').replace('\n', r'\n'))
+
+
+def _escape_tag(value):
+    """Escape a tag key or value, or a field key, for line protocol."""
+    return _escape_measurement(value).replace('=', r'\=')
+
+
+def _escape_string(value):
+    """Escape a string field value for line protocol (without quotes)."""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _format_field_value(value):
+    """Format a field value for line protocol."""
+    # Strings must be in quotes for line protocol
+    if isinstance(value, str):
+        return f'"{_escape_string(value)}"'
+    # Don't append 'i' to bool, which is a subclass of int
+    if isinstance(value, int) and not isinstance(value, bool):
+        return f"{value}i"
+    return f"{value}"
+
+
+# %-style format of each type of field value, matching _format_field_value
+_FIELD_FORMATS = {
+    float: '%s',
+    int: '%si',
+    bool: '%s',
+    str: '"%s"',
+}
+
+# Line templates made by _line_template, keyed on the feed and its fields
+_LINE_TEMPLATES = {}
+_MAX_LINE_TEMPLATES = 10000
+
+
+def _line_template(address, feed_name, fields):
+    """Get the %-style line template for a block of a feed.
+
+    The measurement, tag and field keys are escaped once, when a template is
+    first made for the feed and field set, and then the template is reused
+    for every later message from the feed, so formatting a line only
+    formats its values and timestamp.
+
+    Args:
+        address (str):
+            agent_address of the feed, the measurement.
+        feed_name (str):
+            Name of the feed, the 'feed' tag.
+        fields (tuple):
+            (key, format) of each field of the block, where the format is a
+            value of _FIELD_FORMATS.
+
+    Returns:
+        str: Template to be applied to a tuple of the field values and the
+        timestamp in ns.
+
+    """
+    cache_key = (address, feed_name, fields)
+    template = _LINE_TEMPLATES.get(cache_key)
+    if template is None:
+        prefix = '{},feed={} '.format(_escape_measurement(address),
+                                      _escape_tag(feed_name))
+        field_set = ','.join('{}={}'.format(_escape_tag(key).replace('%', '%%'),
+                                            fmt)
+                             for key, fmt in fields)
+        template = prefix.replace('%', '%%') + field_set + ' %d'
+        if len(_LINE_TEMPLATES) >= _MAX_LINE_TEMPLATES:
+            _LINE_TEMPLATES.clear()
+        _LINE_TEMPLATES[cache_key] = template
+    return template
+
+
+def format_lines(data, feed):
+    """Format the data from an OCS feed as InfluxDB line protocol.
+
+    This is the columnar equivalent of ``Publisher.format_data(data, feed,
+    'line')``, and gives the same lines. Rather than building a dict per
+    sample, each block is formatted with a single line template, looked up
+    by the feed and the format of each field (see ``_line_template``), and
+    applied to the columns of the block. Timestamps are converted to integer
+    nanoseconds in one numpy operation.
+
+    Measurement, tag and field keys are escaped as required by the line
+    protocol, as are quotes and backslashes in string field values.
+
+    Args:
+        data (dict):
+            data from the OCS Feed subscription. Columns can be lists or
+            numpy arrays.
+        feed (dict):
+            feed from the OCS Feed subscription.
+
+    Returns:
+        list: Line protocol strings, one per sample.
+
+    """
+    address = feed['agent_address']
+    feed_name = feed['feed_name']
+
+    lines = []
+    for block in data.values():
+        times = expand_timestamps(block['timestamps'], as_array=True)
+        if len(times) == 0:
+            continue
+        # Same truncation as timestamp2influxtime
+        t_ns = (np.asarray(times, dtype=np.float64) * 1e9).astype(np.int64)
+
+        fields = []
+        columns = []
+        for key, values in block['data'].items():
+            if isinstance(values, np.ndarray):
+                values = values.tolist()
+            types = set(map(type, values))
+            fmt = _FIELD_FORMATS.get(types.pop()) if len(types) == 1 else None
+            if fmt is None:
+                # Mixed (or unusual) types are formatted one at a time
+                fmt = '%s'
+                values = list(map(_format_field_value, values))
+            elif fmt is _FIELD_FORMATS[str]:
+                values = list(map(_escape_string, values))
+            fields.append((key, fmt))
+            columns.append(values)
+
+        template = _line_template(address, feed_name, tuple(fields))
+        lines.extend(map(template.__mod__, zip(*columns, t_ns.tolist())))
+
+    return lines
+
+
+def points_bytes(points):
+    """Size (bytes) of a request writing points, exact for line protocol
+    and approximate for json."""
+    if points and isinstance(points[0], str):
+        return sum(map(len, points)) + len(points)
+    return len(json.dumps(points))
+
+
+class InfluxDBDriver:
+    """
+    Interface between the Publisher and a version of the InfluxDB write API.
+
+    A driver makes sure the server is reachable and ready for data, and
+    creates clients for the writer threads of a :class:`WritePipeline`. A
+    client has a ``write_points(points, protocol)`` method, which raises
+    requests' ``ConnectionError`` or ``Timeout`` if the server can't be
+    reached, :class:`influxdb.exceptions.InfluxDBServerError` for errors
+    worth retrying, and :class:`influxdb.exceptions.InfluxDBClientError`
+    (with the HTTP status as ``code``) if the request was rejected.
+
+    Attributes:
+        protocols (list):
+            Protocols the driver can write.
+    """
+
+    protocols = ['line', 'json']
+
+    def setup(self):
+        """Waits until the server is reachable, and prepares it to receive
+        data."""
+        raise NotImplementedError
+
+    def connect(self):
+        """Returns a new client, for use by a single thread."""
+        raise NotImplementedError
+
+
+class InfluxDBV1Driver(InfluxDBDriver):
+    """
+    Driver for the InfluxDB 1.x ``/write`` API, using
+    :class:`influxdb.InfluxDBClient`. The database is created if it doesn't
+    exist.
+
+    Args:
+        host (str):
+            host for InfluxDB instance.
+        database (str):
+            database name within InfluxDB to publish to.
+        port (int, optional):
+            port for InfluxDB instance, defaults to 8086.
+        gzip (bool, optional):
+            compress influxdb requests with gzip.
+        timeout (float, optional):
+            Timeout (sec) of write requests.
+    """
+
+    def __init__(self, host, database, port=8086, gzip=False, timeout=30.):
+        self.host = host
+        self.db = database
+        self.port = port
+        self.gzip = gzip
+        self.timeout = timeout
+
+    def setup(self):
+        client = InfluxDBClient(host=self.host, port=self.port, gzip=self.gzip)
+
+        db_list = None
+        # ConnectionError here is indicative of InfluxDB being down
+        while db_list is None:
+            try:
+                db_list = client.get_list_database()
+            except RequestsConnectionError:
+                LOG.error("Connection error, attempting to reconnect to DB.")
+                client = InfluxDBClient(host=self.host, port=self.port, gzip=self.gzip)
+                time.sleep(1)
+        db_names = [x['name'] for x in db_list]
+
+        if self.db not in db_names:
+            print(f"{self.db} DB doesn't exist, creating DB")
+            client.create_database(self.db)
+
+    def connect(self):
+        return InfluxDBClient(host=self.host, port=self.port, gzip=self.gzip,
+                              database=self.db, timeout=self.timeout)
+
+
+class InfluxDBV2Driver(InfluxDBDriver):
+    """
+    Driver for the InfluxDB 2.x ``/api/v2/write`` API, which authenticates
+    with a token and writes to a bucket of an organization. Only the line
+    protocol is supported. The bucket must already exist.
+
+    Request bodies are streamed in chunks of about ``chunk_bytes`` of line
+    protocol, compressed with gzip as they are sent if ``gzip`` is True, so
+    the full body is never built in memory.
+
+    Args:
+        host (str):
+            host for InfluxDB instance.
+        org (str):
+            Organization the bucket belongs to.
+        bucket (str):
+            Bucket to write to.
+        token (str):
+            API token with write access to the bucket.
+        port (int, optional):
+            port for InfluxDB instance, defaults to 8086.
+        gzip (bool, optional):
+            compress requests with gzip.
+        ssl (bool, optional):
+            Use https.
+        chunk_bytes (int, optional):
+            Size (bytes) of line protocol in each chunk of a request.
+        timeout (float, optional):
+            Timeout (sec) of write requests.
+    """
+
+    protocols = ['line']
+
+    def __init__(self, host, org, bucket, token, port=8086, gzip=True,
+                 ssl=False, chunk_bytes=65536, timeout=30.):
+        self.url = '{}://{}:{}'.format('https' if ssl else 'http', host, port)
+        self.org = org
+        self.bucket = bucket
+        self.token = token
+        self.gzip = gzip
+        self.chunk_bytes = chunk_bytes
+        self.timeout = timeout
+
+    def setup(self):
+        # The /ping endpoint doesn't need authentication
+        while True:
+            try:
+                requests.get(self.url + '/ping', timeout=self.timeout)
+                return
+            except RequestsConnectionError:
+                LOG.error("Connection error, attempting to reconnect to DB.")
+                time.sleep(1)
+
+    def connect(self):
+        return _InfluxDBV2Client(self)
+
+
+class _InfluxDBV2Client:
+    """Writes to the InfluxDB 2.x API through a pooled requests Session."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Token ' + driver.token,
+            'Content-Type': 'text/plain; charset=utf-8',
+        })
+        if driver.gzip:
+            self.session.headers['Content-Encoding'] = 'gzip'
+        self.params = {'org': driver.org, 'bucket': driver.bucket,
+                       'precision': 'ns'}
+
+    def _body(self, points):
+        """Yields the request body in chunks."""
+        compressor = None
+        if self.driver.gzip:
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+        def encode(lines, last=False):
+            chunk = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if last:
+                    chunk += compressor.flush()
+            return chunk
+
+        lines = []
+        size = 0
+        for line in points:
+            lines.append(line)
+            size += len(line) + 1
+            if size >= self.driver.chunk_bytes:
+                chunk = encode(lines)
+                # An empty chunk would end the request body
+                if chunk:
+                    yield chunk
+                lines = []
+                size = 0
+        chunk = encode(lines, last=True)
+        if chunk:
+            yield chunk
+
+    def write_points(self, points, protocol='line'):
+        if protocol != 'line':
+            raise ValueError("The InfluxDB v2 driver only supports the line "
+                             "protocol")
+        response = self.session.post(self.driver.url + '/api/v2/write',
+                                     params=self.params,
+                                     data=self._body(points),
+                                     timeout=self.driver.timeout)
+        if response.status_code == 204:
+            return True
+        # Rate limiting and unavailability are worth retrying
+        if response.status_code >= 500 or response.status_code == 429:
+            raise InfluxDBServerError(response.content)
+        raise InfluxDBClientError(response.content, response.status_code)
+
+
+class WritePipeline:
+    """
+    Writes chunks of points to InfluxDB in the background, so the Publisher
+    doesn't block on (or lose data to) a slow or unavailable database.
+
+    Chunks passed to :meth:`submit` are queued in memory and written by
+    ``n_writers`` threads, each with its own client (and so its own pool of
+    HTTP connections). If a write fails because InfluxDB can't be reached
+    or returns a server error, the chunk is put back at the front of the
+    queue and writes are retried with exponential backoff, from
+    ``min_backoff`` up to ``max_backoff`` seconds. Chunks rejected by the
+    server as invalid are dropped.
+
+    At most ``max_pending_points`` points are held in memory. Beyond that,
+    new chunks are written to an on-disk ring of line protocol chunks in
+    ``spill_dir``, if set, and otherwise the oldest chunks are dropped. Once
+    anything has been spilled, new chunks are spilled too until the ring is
+    empty, so chunks are still written in order. Chunks left in
+    ``spill_dir`` by a previous run are written first.
+
+    The size of chunks is up to the submitter, but ``batch_bytes`` suggests
+    a budget for each request. It adapts to how the server copes: it grows
+    while requests take less than half of ``target_latency``, and is
+    halved when they take longer than that or time out. A chunk rejected
+    as too large (HTTP 413) is split in two and retried.
+
+    Args:
+        connect (callable):
+            Returns a new client, with a ``write_points(points, protocol)``
+            method, writing to the right database.
+        protocol (str, optional):
+            Protocol of the points, 'line' or 'json'.
+        n_writers (int, optional):
+            Number of concurrent writer threads.
+        max_pending_points (int, optional):
+            Maximum number of points held in memory.
+        spill_dir (path, optional):
+            Directory for the spill ring. If None, nothing is spilled.
+        spill_max_bytes (int, optional):
+            Maximum size of the spill ring. The oldest chunks are discarded
+            beyond this.
+        min_backoff (float, optional):
+            Time (sec) to wait before the first retry.
+        max_backoff (float, optional):
+            Longest time (sec) to wait between retries.
+        batch_bytes (int, optional):
+            Initial size (bytes) budget of each request.
+        min_batch_bytes (int, optional):
+            Smallest size budget of each request.
+        max_batch_bytes (int, optional):
+            Largest size budget of each request.
+        target_latency (float, optional):
+            Time (sec) requests should take.
+
+    Attributes:
+        written_points (int):
+            Number of points written.
+        dropped_points (int):
+            Number of points discarded.
+        failed_requests (int):
+            Number of writes that failed.
+        backoff (float):
+            Current time (sec) between retries, or 0 if writes are
+            succeeding.
+        batch_bytes (float):
+            Current size (bytes) budget of each request.
+    """
+
+    #: Upper edges (sec) of the request latency histogram buckets. The last
+    #: bucket counts anything slower.
+    LATENCY_BUCKETS = [0.01, 0.03, 0.1, 0.3, 1., 3., 10., 30.]
+
+    #: Time (sec) over which write rates are averaged.
+    RATE_WINDOW = 10.
+
+    def __init__(self, connect, protocol='line', n_writers=2,
+                 max_pending_points=1000000, spill_dir=None,
+                 spill_max_bytes=1e9, min_backoff=1., max_backoff=60.,
+                 batch_bytes=1e6, min_batch_bytes=64e3, max_batch_bytes=8e6,
+                 target_latency=1.):
+        self.connect = connect
+        self.protocol = protocol
+        self.max_pending_points = max_pending_points
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.batch_bytes = batch_bytes
+        self.min_batch_bytes = min_batch_bytes
+        self.max_batch_bytes = max_batch_bytes
+        self.target_latency = target_latency
+
+        self._spill = None
+        if spill_dir is not None:
+            self._spill = _SpillRing(spill_dir, spill_max_bytes)
+
+        self._chunks = deque()
+        self._pending_points = 0
+        self._in_flight = 0
+        self._retry_at = 0.
+        self._closing = False
+        self._cond = threading.Condition()
+
+        self.written_points = 0
+        self.dropped_points = 0
+        self.failed_requests = 0
+        self.backoff = 0.
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.last_latency = None
+        self.max_latency = 0.
+        # (time, points, bytes) of recent writes, for rates
+        self._recent = deque()
+
+        self._threads = [
+            threading.Thread(target=self._writer, daemon=True,
+                             name=f'influx-writer-{i}')
+            for i in range(n_writers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _drop(self, n, reason):
+        self.dropped_points += n
+        LOG.error("Dropped {n} points: {r}", n=n, r=reason)
+
+    def submit(self, points):
+        """Queues a chunk of points to be written."""
+        if not points:
+            return
+        with self._cond:
+            if self._spill is not None:
+                if len(self._spill) or \
+                        self._pending_points + len(points) > self.max_pending_points:
+                    dropped = self._spill.push(points, len(points))
+                    if dropped:
+                        self._drop(dropped, "spill directory is full")
+                    self._cond.notify()
+                    return
+            else:
+                while (self._chunks and self._pending_points + len(points)
+                       > self.max_pending_points):
+                    old = self._chunks.popleft()
+                    self._pending_points -= len(old)
+                    self._drop(len(old), "retry queue is full")
+
+            self._chunks.append(points)
+            self._pending_points += len(points)
+            self._cond.notify()
+
+    def _has_chunk(self):
+        return bool(self._chunks) or (self._spill is not None
+                                      and len(self._spill) > 0)
+
+    def _next_chunk(self):
+        """Waits for a chunk to write, and for any backoff to pass. Returns
+        None once the pipeline is closed."""
+        with self._cond:
+            while True:
+                if self._closing:
+                    return None
+                if self._has_chunk():
+                    wait = self._retry_at - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+            if self._chunks:
+                points = self._chunks.popleft()
+                self._pending_points -= len(points)
+            else:
+                points, _ = self._spill.peek()
+                self._spill.pop_discard()
+            self._in_flight += 1
+            return points
+
+    def _record_latency(self, latency):
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        for i, edge in enumerate(self.LATENCY_BUCKETS):
+            if latency <= edge:
+                break
+        else:
+            i = len(self.LATENCY_BUCKETS)
+        self.latency_counts[i] += 1
+
+    def _shrink(self):
+        self.batch_bytes = max(self.min_batch_bytes, self.batch_bytes / 2)
+
+    def _split(self, points):
+        """Splits a chunk that was too large in two, and requeues them."""
+        with self._cond:
+            self._in_flight -= 1
+            self.failed_requests += 1
+            self._shrink()
+            half = len(points) // 2
+            self._chunks.appendleft(points[half:])
+            self._chunks.appendleft(points[:half])
+            self._pending_points += len(points)
+            self._cond.notify_all()
+
+    def _retry(self, points, split=False):
+        """Puts a chunk back at the front of the queue and backs off. If
+        split is True, the batch size shrinks and the chunk is requeued in
+        two halves."""
+        with self._cond:
+            self._in_flight -= 1
+            self.failed_requests += 1
+            if split:
+                self._shrink()
+            if split and len(points) > 1:
+                half = len(points) // 2
+                self._chunks.appendleft(points[half:])
+                self._chunks.appendleft(points[:half])
+            else:
+                self._chunks.appendleft(points)
+            self._pending_points += len(points)
+            self.backoff = min(self.max_backoff,
+                               max(self.min_backoff, 2 * self.backoff))
+            self._retry_at = time.time() + self.backoff
+            self._cond.notify_all()
+
+    def _done(self, points, latency=None):
+        """Notes that a chunk is finished with, and if it was written (and
+        so latency is given) adapts the batch size."""
+        with self._cond:
+            self._in_flight -= 1
+            if latency is not None:
+                self.written_points += len(points)
+                self.backoff = 0.
+                self._retry_at = 0.
+                self._record_latency(latency)
+                self._recent.append((time.time(), len(points),
+                                     points_bytes(points)))
+                if latency > self.target_latency:
+                    self._shrink()
+                elif latency < self.target_latency / 2:
+                    self.batch_bytes = min(self.max_batch_bytes,
+                                           self.batch_bytes * 1.25)
+            self._cond.notify_all()
+
+    def _writer(self):
+        client = self.connect()
+        while True:
+            points = self._next_chunk()
+            if points is None:
+                return
+            t0 = time.time()
+            try:
+                client.write_points(points, protocol=self.protocol)
+            except (RequestsConnectionError, RequestsTimeout,
+                    InfluxDBServerError) as err:
+                LOG.error("InfluxDB write failed, retrying in {t} s: {e}",
+                          t=max(self.min_backoff, 2 * self.backoff), e=err)
+                # A chunk that timed out may be too large to write in time,
+                # so it's split as well as the batch size shrinking
+                self._retry(points,
+                            split=isinstance(err, RequestsTimeout))
+                client = self.connect()
+            except InfluxDBClientError as err:
+                if err.code == 413 and len(points) > 1:
+                    LOG.warn("Request too large, splitting {n} points",
+                             n=len(points))
+                    self._split(points)
+                    continue
+                LOG.error("InfluxDB Client Error: {e}", e=err)
+                self._done(points)
+                self._drop(len(points), "rejected by InfluxDB")
+            except Exception as err:
+                # Anything else is unexpected, and likely to fail again, so
+                # drop the chunk rather than let it kill the writer
+                LOG.error("Unexpected error writing to InfluxDB: {e!r}",
+                          e=err)
+                self._done(points)
+                self._drop(len(points), "unexpected error")
+            else:
+                self._done(points, latency=time.time() - t0)
+
+    def pending(self):
+        """Returns the number of chunks waiting to be written, or being
+        written."""
+        with self._cond:
+            n = len(self._chunks) + self._in_flight
+            if self._spill is not None:
+                n += len(self._spill)
+            return n
+
+    def status(self):
+        """Returns a dict describing the pipeline, suitable for
+        session.data."""
+        with self._cond:
+            now = time.time()
+            while self._recent and self._recent[0][0] < now - self.RATE_WINDOW:
+                self._recent.popleft()
+            status = {
+                'pending_chunks': len(self._chunks) + self._in_flight,
+                'pending_points': self._pending_points,
+                'written_points': self.written_points,
+                'dropped_points': self.dropped_points,
+                'failed_requests': self.failed_requests,
+                'backoff': self.backoff,
+                'batch_bytes': int(self.batch_bytes),
+                'points_per_sec': sum(r[1] for r in self._recent) / self.RATE_WINDOW,
+                'bytes_per_sec': sum(r[2] for r in self._recent) / self.RATE_WINDOW,
+                'latency': {
+                    'buckets': self.LATENCY_BUCKETS,
+                    'counts': list(self.latency_counts),
+                    'last': self.last_latency,
+                    'max': self.max_latency,
+                },
+            }
+            if self._spill is not None:
+                status['spilled_chunks'] = len(self._spill)
+                status['spilled_bytes'] = self._spill.bytes
+            return status
+
+    def close(self, timeout=10.):
+        """
+        Waits up to ``timeout`` seconds for pending chunks to be written,
+        then stops the writers. Chunks still in memory are spilled to disk,
+        to be written on the next run, if a spill directory is set, and
+        are otherwise lost.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._has_chunk() or self._in_flight:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+            self._closing = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+        with self._cond:
+            if self._chunks and self._spill is not None:
+                # These are older than anything already spilled, so will be
+                # written out of order, but are not lost.
+                for points in self._chunks:
+                    self._spill.push(points, len(points))
+            elif self._chunks:
+                self._drop(self._pending_points, "publisher closed")
+            self._chunks.clear()
+            self._pending_points = 0
+
+
+class Downsampler:
+    """
+    Downsamples feeds before they are formatted for InfluxDB, for feeds that
+    ask for it in their ``agg_params``:
+
+    - ``influx_downsample`` (float): Length (sec) of the windows, aligned
+      to multiples of the length since the epoch.
+    - ``influx_stats`` (list): Statistics to compute in each window, from
+      'min', 'mean', 'max' and 'last'. Defaults to all four. Unknown names
+      are logged, once per feed, and ignored.
+
+    Each numeric field is replaced by a field for each statistic, named
+    ``<field>_<stat>``, with one point per window, timestamped at the
+    start of the window. Other fields (strings and bools) keep only the
+    last value in each window, as ``<field>_last``.
+
+    Windows often span several messages, so the samples of the latest
+    window of each block are held back until a sample from a later window
+    arrives, or until the window has been over for another window length
+    (see :meth:`flush`).
+
+    This class should only be accessed by a single thread.
+    """
+
+    STATS = ['min', 'mean', 'max', 'last']
+
+    def __init__(self):
+        # (address, block_name) -> (feed, block of held back samples)
+        self._held = {}
+        # Addresses of feeds already warned about unknown stats
+        self._warned = set()
+
+    def _stats(self, feed):
+        """Returns the valid stats requested by a feed."""
+        stats = feed['agg_params'].get('influx_stats', self.STATS)
+        unknown = [s for s in stats if s not in self.STATS]
+        if unknown:
+            if feed['address'] not in self._warned:
+                self._warned.add(feed['address'])
+                LOG.error("Ignoring unknown influx_stats {u} of {f}, "
+                          "expected some of {s}",
+                          u=unknown, f=feed['address'], s=self.STATS)
+            stats = [s for s in stats if s in self.STATS]
+        return stats
+
+    @staticmethod
+    def _windows(block, window, stats):
+        """Computes stats over windows of a block's samples. Returns the
+        block of complete windows and the block of samples in the last,
+        possibly incomplete, window."""
+        times = np.asarray(block['timestamps'], dtype=np.float64)
+        idx = np.floor(times / window)
+        starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+        split = starts[-1]
+        ends = np.r_[starts[1:], len(times)]
+        # Only complete windows, the last one is held back
+        starts, ends = starts[:-1], ends[:-1]
+        counts = ends - starts
+
+        data = {}
+        held = {}
+        for key, values in block['data'].items():
+            values = np.asarray(values)
+            held[key] = values[split:]
+            if not len(starts):
+                continue
+            if values.dtype.kind in 'iuf':
+                for stat in stats:
+                    if stat == 'min':
+                        v = np.minimum.reduceat(values[:split], starts)
+                    elif stat == 'max':
+                        v = np.maximum.reduceat(values[:split], starts)
+                    elif stat == 'mean':
+                        v = np.add.reduceat(values[:split], starts) / counts
+                    elif stat == 'last':
+                        v = values[ends - 1]
+                    else:
+                        raise ValueError(f"Unknown statistic: {stat}")
+                    data[f'{key}_{stat}'] = v.tolist()
+            else:
+                data[f'{key}_last'] = values[ends - 1].tolist()
+
+        out = {'block_name': block['block_name'],
+               'timestamps': (idx[starts] * window).tolist(),
+               'data': data}
+        held = {'block_name': block['block_name'],
+                'timestamps': times[split:],
+                'data': held}
+        return out, held
+
+    @classmethod
+    def _complete(cls, block, window, stats):
+        """Computes stats over held back samples, which are all in one
+        window."""
+        # A sample past the end of the window completes it
+        end = (np.floor(block['timestamps'][-1] / window) + 1) * window
+        block = dict(block, timestamps=np.r_[block['timestamps'], end],
+                     data={k: np.r_[v, v[-1:]]
+                           for k, v in block['data'].items()})
+        return cls._windows(block, window, stats)[0]
+
+    @staticmethod
+    def _concat(a, b):
+        """Concatenates the samples of two blocks."""
+        return {'block_name': b['block_name'],
+                'timestamps': np.concatenate([a['timestamps'], b['timestamps']]),
+                'data': {k: np.concatenate([a['data'][k], np.asarray(v)])
+                         if k in a['data'] else v
+                         for k, v in b['data'].items()}}
+
+    def process(self, data, feed):
+        """
+        Downsamples decoded data from a feed, if the feed asks for it.
+
+        Returns:
+            dict: The downsampled data, which may be empty, or the data
+            unchanged if the feed isn't downsampled.
+        """
+        window = feed['agg_params'].get('influx_downsample')
+        if not window:
+            return data
+        stats = self._stats(feed)
+
+        out = {}
+        for key, block in data.items():
+            block = dict(block, timestamps=expand_timestamps(
+                block['timestamps'], as_array=True))
+            if not len(block['timestamps']):
+                continue
+            hkey = (feed['address'], block['block_name'])
+            if hkey in self._held:
+                held = self._held.pop(hkey)[1]
+                if set(held['data']) == set(block['data']):
+                    block = self._concat(held, block)
+                else:
+                    # The fields changed, so the held window is finished
+                    out[key + '_held'] = self._complete(held, window, stats)
+            windows, held = self._windows(block, window, stats)
+            self._held[hkey] = (feed, held)
+            if len(windows['timestamps']):
+                out[key] = windows
+        return out
+
+    def flush(self, now=None):
+        """
+        Computes stats over held back samples whose window ended more than
+        a window length before ``now``, or all of them if ``now`` is None.
+
+        Returns:
+            list: (data, feed) pairs of the downsampled data.
+        """
+        flushed = []
+        for hkey, (feed, block) in list(self._held.items()):
+            window = feed['agg_params']['influx_downsample']
+            end = (np.floor(block['timestamps'][-1] / window) + 1) * window
+            if now is not None and now < end + window:
+                continue
+            del self._held[hkey]
+            stats = self._stats(feed)
+            flushed.append(({hkey[1]: self._complete(block, window, stats)},
+                            feed))
+        return flushed
+
+
 class Publisher:
     """
     Data publisher. This manages data to be published to the InfluxDB.
@@ -51,6 +909,27 @@ class Publisher:
             Protocol for writing data. Either 'line' or 'json'.
         gzip (bool, optional):
             compress influxdb requsts with gzip
+        n_writers (int, optional):
+            Number of concurrent writer threads, see :class:`WritePipeline`.
+        max_pending_points (int, optional):
+            Maximum number of points held in memory waiting to be written.
+        spill_dir (path, optional):
+            Directory to spill points to when InfluxDB can't keep up. If
+            None, points are dropped instead.
+        spill_max_bytes (int, optional):
+            Maximum size of the spilled points.
+        max_backoff (float, optional):
+            Longest time (sec) to wait between retries of failed writes.
+        batch_bytes (int, optional):
+            Initial size (bytes) of each write request. This adapts to the
+            server's response, see :class:`WritePipeline`.
+        max_batch_bytes (int, optional):
+            Largest size (bytes) of each write request.
+        target_latency (float, optional):
+            Time (sec) write requests should take.
+        driver (InfluxDBDriver, optional):
+            Driver for the InfluxDB write API. Defaults to an
+            :class:`InfluxDBV1Driver` for host, port and database.
 
     Attributes:
         host (str):
@@ -61,12 +940,19 @@ class Publisher:
             database name within InfluxDB to publish to (from database arg)
         incoming_data:
             data to be published
-        client:
-            InfluxDB client connection
+        driver (InfluxDBDriver):
+            Driver for the InfluxDB write API.
+        writer (WritePipeline):
+            Pipeline writing points to InfluxDB in the background.
+        downsampler (Downsampler):
+            Downsamples feeds that ask for it in their agg_params.
 
     """
 
-    def __init__(self, host, database, incoming_data, port=8086, protocol='line', gzip=False):
+    def __init__(self, host, database, incoming_data, port=8086, protocol='line', gzip=False,
+                 n_writers=2, max_pending_points=1000000, spill_dir=None,
+                 spill_max_bytes=1e9, max_backoff=60., batch_bytes=1e6,
+                 max_batch_bytes=8e6, target_latency=1., driver=None):
         self.host = host
         self.port = port
         self.db = database
@@ -77,72 +963,74 @@ class Publisher:
         print(f"gzip encoding enabled: {gzip}")
         print(f"data protocol: {protocol}")
 
-        self.client = InfluxDBClient(host=self.host, port=self.port, gzip=gzip)
-
-        db_list = None
-        # ConnectionError here is indicative of InfluxDB being down
-        while db_list is None:
-            try:
-                db_list = self.client.get_list_database()
-            except RequestsConnectionError:
-                LOG.error("Connection error, attempting to reconnect to DB.")
-                self.client = InfluxDBClient(host=self.host, port=self.port, gzip=gzip)
-                time.sleep(1)
-        db_names = [x['name'] for x in db_list]
+        if driver is None:
+            driver = InfluxDBV1Driver(host, database, port=port, gzip=gzip)
+        if protocol not in driver.protocols:
+            raise ValueError(f"Protocol '{protocol}' not supported by "
+                             f"{type(driver).__name__}")
+        self.driver = driver
+        self.driver.setup()
 
-        if self.db not in db_names:
-            print(f"{self.db} DB doesn't exist, creating DB")
-            self.client.create_database(self.db)
+        self.downsampler = Downsampler()
+        self._batch = []
+        self._batch_bytes = 0
 
-        self.client.switch_database(self.db)
+        self.writer = WritePipeline(self.driver.connect,
+                                    protocol=protocol,
+                                    n_writers=n_writers,
+                                    max_pending_points=max_pending_points,
+                                    spill_dir=spill_dir,
+                                    spill_max_bytes=spill_max_bytes,
+                                    max_backoff=max_backoff,
+                                    batch_bytes=batch_bytes,
+                                    max_batch_bytes=max_batch_bytes,
+                                    target_latency=target_latency)
 
     def process_incoming_data(self):
         """
-        Takes all data from the incoming_data queue, and writes them to the
-        InfluxDB.
+        Takes all data from the incoming_data queue, and passes them to the
+        writer to be written to the InfluxDB. Points are passed on in
+        batches as the queue is drained, each about the writer's
+        ``batch_bytes``.
         """
-        payload = []
         LOG.debug("Pulling data from queue.")
         while not self.incoming_data.empty():
             data, feed = self.incoming_data.get()
             if feed['agg_params'].get('exclude_influx', False):
                 continue
 
-            # Formatted for writing to InfluxDB
-            payload.extend(self.format_data(data, feed, protocol=self.protocol))
+            try:
+                data = decode_feed_data(data)
+            except ValueError as e:
+                LOG.error("Could not decode data from {f}: {e}",
+                          f=feed['address'], e=e)
+                continue
+
+            self._add_points(self.downsampler.process(data, feed), feed)
 
-        # Skip trying to write if payload is empty
-        if not payload:
-            return
+        for data, feed in self.downsampler.flush(time.time()):
+            self._add_points(data, feed)
+        self._submit_batch()
 
-        try:
-            LOG.debug("payload: {p}", p=payload)
-            self.client.write_points(payload,
-                                     batch_size=10000,
-                                     protocol=self.protocol,
-                                     )
-            LOG.debug("wrote payload to influx")
-        except RequestsConnectionError:
-            LOG.error("InfluxDB unavailable, attempting to reconnect.")
-            self.client = InfluxDBClient(host=self.host, port=self.port, gzip=self.gzip)
-            self.client.switch_database(self.db)
-        except InfluxDBClientError as err:
-            LOG.error("InfluxDB Client Error: {e}", e=err)
-        except InfluxDBServerError as err:
-            LOG.error("InfluxDB Server Error: {e}", e=err)
+    def _add_points(self, data, feed):
+        """Formats data for writing to InfluxDB, and adds it to the current
+        batch, which is submitted once it reaches the writer's
+        batch_bytes."""
+        points = self.format_data(data, feed, protocol=self.protocol)
+        self._batch.extend(points)
+        self._batch_bytes += points_bytes(points)
+        if self._batch_bytes >= self.writer.batch_bytes:
+            self._submit_batch()
+
+    def _submit_batch(self):
+        self.writer.submit(self._batch)
+        self._batch = []
+        self._batch_bytes = 0
 
     @staticmethod
     def _format_field_line(field_key, field_value):
         """Format key-value pair for InfluxDB line protocol."""
-        # Strings must be in quotes for line protocol
-        if isinstance(field_value, str):
-            line = f'{field_key}="{field_value}"'
-        else:
-            line = f"{field_key}={field_value}"
-        # Don't append 'i' to bool, which is a subclass of int
-        if isinstance(field_value, int) and not isinstance(field_value, bool):
-            line += "i"
-        return line
+        return f"{_escape_tag(field_key)}={_format_field_value(field_value)}"
 
     @staticmethod
     def format_data(data, feed, protocol):
@@ -169,6 +1057,9 @@ class Publisher:
             list: Data ready to publish to influxdb, in the specified protocol.
 
         """
+        if protocol == 'line':
+            return format_lines(data, feed)
+
         measurement = feed['agent_address']
         feed_tag = feed['feed_name']
 
@@ -177,8 +1068,8 @@ class Publisher:
         # Reshape data for query
         for bk, bv in data.items():
             grouped_data_points = []
-            times = bv['timestamps']
-            num_points = len(bv['timestamps'])
+            times = expand_timestamps(bv['timestamps'])
+            num_points = len(times)
             for i in range(num_points):
                 grouped_dict = {}
                 for data_key, data_value in bv['data'].items():
@@ -186,17 +1077,7 @@ class Publisher:
                 grouped_data_points.append(grouped_dict)
 
             for fields, time_ in zip(grouped_data_points, times):
-                if protocol == 'line':
-                    fields_line = []
-                    for mk, mv in fields.items():
-                        f_line = Publisher._format_field_line(mk, mv)
-                        fields_line.append(f_line)
-
-                    measurement_line = ','.join(fields_line)
-                    t_line = timestamp2influxtime(time_, protocol='line')
-                    line = f"{measurement},feed={feed_tag} {measurement_line} {t_line}"
-                    json_body.append(line)
-                elif protocol == 'json':
+                if protocol == 'json':
                     json_body.append(
                         {
                             "measurement": measurement,
@@ -221,4 +1102,7 @@ class Publisher:
 
     def close(self):
         """Flushes all remaining data and closes InfluxDB connection."""
-        pass
+        for data, feed in self.downsampler.flush():
+            self._add_points(data, feed)
+        self._submit_batch()
+        self.writer.close()
@@ -26,6 +26,8 @@ class RegisteredAgent:
                 Dictionary of operation codes for each of the agent's
                 operations. For details on what the operation codes mean, see
                 docs from the ``ocs_agent`` module
+            shard (dict):
+                Shard assignment published by a sharded aggregator, or None.
     """
 
     def __init__(self, feed):
@@ -35,6 +37,7 @@ class RegisteredAgent:
         self.op_codes = {}
         self.agent_class = feed.get('agent_class')
         self.agent_address = feed['agent_address']
+        self.shard = None
 
     def refresh(self, op_codes=None):
         self.expired = False
@@ -51,7 +54,7 @@ class RegisteredAgent:
             self.op_codes[k] = OpCode.EXPIRED.value
 
     def encoded(self):
-        return {
+        encoded = {
             'expired': self.expired,
             'time_expired': self.time_expired,
             'last_updated': self.last_updated,
@@ -59,6 +62,9 @@ class RegisteredAgent:
             'agent_class': self.agent_class,
             'agent_address': self.agent_address,
         }
+        if self.shard is not None:
+            encoded['shard'] = self.shard
+        return encoded
 
 
 class Registry:
@@ -101,6 +107,10 @@ class Registry:
             self._register_heartbeat, 'observatory..feeds.heartbeat',
             options={'match': 'wildcard'}
         )
+        self.agent.subscribe_on_start(
+            self._register_shard, 'observatory..feeds.aggregator_shard',
+            options={'match': 'wildcard'}
+        )
 
         agg_params = {
             'frame_length': 60,
@@ -124,6 +134,18 @@ class Registry:
         if publish:
             self._publish_agent_ops(reg_agent)
 
+    def _register_shard(self, _data):
+        """
+            Function that is called whenever a sharded aggregator publishes
+            its shard assignment. The assignment is reported with the agent
+            in the "main" process's session.data.
+        """
+        shard, feed = _data
+        addr = feed['agent_address']
+        if addr not in self.registered_agents:
+            self.registered_agents[addr] = RegisteredAgent(feed)
+        self.registered_agents[addr].shard = shard
+
     def _publish_agent_ops(self, reg_agent):
         """Publish a registered agent's OpCodes.
 
@@ -179,7 +201,13 @@ class Registry:
                       "record": 3
                     },
                     "agent_class": "AggregatorAgent",
-                    "agent_address": "observatory.aggregator"
+                    "agent_address": "observatory.aggregator",
+                    "shard": {
+                      "name": "shard-0",
+                      "index": 0,
+                      "count": 2,
+                      "patterns": None
+                    }
                   },
                   "observatory.fake-hk-agent-01": {
                     "expired": False,
@@ -195,6 +223,9 @@ class Registry:
                   }
                 }
 
+            Aggregators run in sharding mode also report their shard
+            assignment, as in the "shard" entry above.
+
         """
 
         session.set_status('starting')
@@ -34,7 +34,7 @@ def _build_file_list(target):
         a = os.walk(target)
         for root, _, _file in a:
             for g3 in _file:
-                if g3[-2:] == "g3":
+                if g3.endswith((".g3", ".g3.gz", ".g3.bz2")):
                     _file_list.append(os.path.join(root, g3))
 
     return _file_list
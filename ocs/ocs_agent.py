@@ -15,7 +15,7 @@ from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 from autobahn.twisted.util import sleep as dsleep
 from autobahn.wamp.exception import ApplicationError, TransportLost
 from autobahn.exception import Disconnected
-from .ocs_twisted import in_reactor_context
+from .ocs_twisted import in_reactor_context, ReactorCallQueue
 
 import json
 import math
@@ -210,6 +210,10 @@ class OCSAgent(ApplicationSession):
 
         self.realm_joined = True
 
+        # Send any feed data that failed to publish while disconnected
+        for feed in list(self.feeds.values()):
+            feed.flush_buffer()
+
     def onLeave(self, details):
         self.log.info('session left: {}'.format(details))
         if self.heartbeat_call is not None:
@@ -505,6 +509,35 @@ class OCSAgent(ApplicationSession):
                 Defaults to 0.
             max_messages (int, optional):
                 Max number of messages stored. Defaults to 20.
+            flush_samples (int, optional):
+                Publish the buffer early once it holds this many samples.
+                Defaults to 0 (no limit).
+            flush_bytes (int, optional):
+                Publish the buffer early once its estimated size reaches
+                this many bytes. Defaults to 0 (no limit).
+            columnar (bool, optional):
+                Buffer recorded data in typed numpy buffers rather than
+                lists. See ``ocs.ocs_feed.Feed``. Defaults to False.
+            encoding (str, optional):
+                Encoding of recorded data sent over WAMP, 'list' or
+                'packed'. See ``ocs.ocs_feed.Feed``. Defaults to 'list'.
+            compact_timestamps (bool, optional):
+                Send compacted timestamps. See ``ocs.ocs_feed.Feed``.
+                Defaults to False.
+            max_samples (int, optional):
+                Maximum number of samples a recorded feed holds in memory,
+                including data that failed to publish. Defaults to 0
+                (unbounded, failed publishes are dropped).
+            overflow_policy (str, optional):
+                Policy when max_samples is reached; 'drop_oldest',
+                'drop_newest', 'block' or 'spill'. See
+                ``ocs.ocs_feed.Feed``.
+            spill_dir (path, optional):
+                Base directory for the on-disk ring used by the 'spill'
+                policy. See ``ocs.ocs_feed.Feed``.
+            spill_max_bytes (int, optional):
+                Maximum size of the spill ring. See ``ocs.ocs_feed.Feed``.
+                Defaults to 100 MB.
 
         Returns:
             The Feed object (which is also cached in self.feeds).
@@ -999,6 +1032,9 @@ class OpSession:
         self.success = None
         self.status = None
 
+        # Calls from worker threads are handed to the reactor through this.
+        self._reactor_calls = ReactorCallQueue()
+
         # This has to be the last call since it depends on init...
         self.set_status(status, log_status=log_status, timestamp=self.start_time)
 
@@ -1178,9 +1214,9 @@ class OpSession:
         if timestamp is None:
             timestamp = time.time()
         if not in_reactor_context():
-            return reactor.callFromThread(self.set_status, status,
-                                          timestamp=timestamp,
-                                          log_status=log_status)
+            return self._reactor_calls.call(self.set_status, status,
+                                            timestamp=timestamp,
+                                            log_status=log_status)
         # Sanity check the status value.
         from_index = SESSION_STATUS_CODES.index(self.status)  # current status valid?
         to_index = SESSION_STATUS_CODES.index(status)        # new status valid?
@@ -1209,8 +1245,8 @@ class OpSession:
         if timestamp is None:
             timestamp = time.time()
         if not in_reactor_context():
-            return reactor.callFromThread(self.add_message, message,
-                                          timestamp=timestamp)
+            return self._reactor_calls.call(self.add_message, message,
+                                            timestamp=timestamp)
         self.messages.append((timestamp, message))
         self.app.publish_status('Message', self)
         # Make the app log this message, too.  The op_name and
@@ -1,10 +1,37 @@
 from ocs.ocs_agent import in_reactor_context
+from ocs.ocs_twisted import ReactorCallQueue
 from twisted.internet import reactor
 from autobahn.wamp.exception import TransportLost
+from collections import deque
+import itertools
+import numpy as np
+import threading
+import msgpack
+import txaio
+import queue
 import time
+import os
 import re
 
 
+# Field name rules, see Feed.verify_data_field_string.
+# Complement (^) the set, matching any unlisted characters
+_INVALID_FIELD_CHARS = re.compile('[^a-zA-Z0-9_]')
+# Similar to _INVALID_FIELD_CHARS, search for non letter characters
+# Leading ^ matches the start of string, so following numbers are valid
+_NON_LETTER_START = re.compile('^[^a-zA-Z]')
+
+_VALID_DATA_TYPES = (float, int, str, bool)
+
+
+def _as_list(values):
+    """Convert numpy arrays (and scalars) to python lists (and scalars), which
+    a list based Block can serialize."""
+    if isinstance(values, (np.ndarray, np.generic)):
+        return values.tolist()
+    return values
+
+
 class Block:
     def __init__(self, name, keys):
         """
@@ -35,10 +62,10 @@ class Block:
         if d['data'].keys() != self.data.keys():
             raise Exception("Block structure does not match: {}".format(self.name))
 
-        self.timestamps.append(d['timestamp'])
+        self.timestamps.append(_as_list(d['timestamp']))
 
         for k in self.data:
-            self.data[k].append(d['data'][k])
+            self.data[k].append(_as_list(d['data'][k]))
 
     def extend(self, block):
         """
@@ -47,9 +74,9 @@ class Block:
         if block['data'].keys() != self.data.keys():
             raise Exception("Block structure does not match: {}".format(self.name))
 
-        self.timestamps.extend(block['timestamps'])
+        self.timestamps.extend(_as_list(block['timestamps']))
         for k in self.data:
-            self.data[k].extend(block['data'][k])
+            self.data[k].extend(_as_list(block['data'][k]))
 
     def encoded(self):
         n = len(self.timestamps)
@@ -61,6 +88,797 @@ class Block:
         }
 
 
+# Typed buffer dtype for each numpy dtype kind that ColumnarBlock can store
+# without falling back to a list.
+_COLUMN_DTYPES = {
+    'b': np.dtype(np.bool_),
+    'i': np.dtype(np.int64),
+    'u': np.dtype(np.int64),
+    'f': np.dtype(np.float64),
+}
+
+
+class _Column:
+    """
+    Growable, typed buffer holding a single ColumnarBlock column.
+
+    Capacity doubles when the buffer is full, so extending by n samples costs
+    amortized O(n). The dtype is fixed by the first data added (or by the
+    ``dtype`` argument). Data that can't be held in that buffer (strings,
+    mixed types) is moved to a plain list instead, which is what the list
+    based Block would have stored.
+
+    Args:
+        dtype (numpy.dtype, optional):
+            Force the buffer to this dtype, casting numeric input.
+        initial_size (int, optional):
+            Capacity of the first allocated buffer.
+    """
+
+    def __init__(self, dtype=None, initial_size=16):
+        self._dtype = dtype
+        self._buf = None
+        self._list = None
+        self._n = 0
+        self._capacity_hint = initial_size
+
+    def __len__(self):
+        if self._list is not None:
+            return len(self._list)
+        return self._n
+
+    def values(self):
+        """Returns a view of the filled part of the buffer, or the fallback
+        list."""
+        if self._list is not None:
+            return self._list
+        if self._buf is None:
+            return np.empty(0, dtype=self._dtype or np.float64)
+        return self._buf[:self._n]
+
+    def tolist(self):
+        """Returns column contents as a list of python objects."""
+        if self._list is not None:
+            return self._list
+        return self.values().tolist()
+
+    def clear(self):
+        """Empties the column. A new buffer is allocated on the next extend,
+        so views returned by values() stay valid, but it starts out at the
+        size this one reached."""
+        if self._buf is not None:
+            self._capacity_hint = max(self._capacity_hint, self._n)
+        self._buf = None
+        self._list = None
+        self._n = 0
+
+    def _to_list(self):
+        self._list = self.values().tolist()
+        self._buf = None
+        self._n = 0
+
+    def extend(self, values):
+        if self._list is None:
+            arr = np.asarray(values)
+            if arr.size == 0:
+                return
+            dtype = self._dtype
+            if dtype is None:
+                dtype = _COLUMN_DTYPES.get(arr.dtype.kind)
+                if self._buf is not None and dtype != self._buf.dtype:
+                    dtype = None
+            if (dtype is not None and arr.ndim == 1
+                    and arr.dtype.kind in _COLUMN_DTYPES
+                    and np.can_cast(arr.dtype, dtype)):
+                self._extend_buffer(arr, dtype)
+                return
+            self._to_list()
+
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        self._list.extend(values)
+
+    def _extend_buffer(self, arr, dtype):
+        n_new = self._n + len(arr)
+        if self._buf is None:
+            self._buf = np.empty(max(self._capacity_hint, n_new), dtype=dtype)
+        elif n_new > len(self._buf):
+            buf = np.empty(max(2 * len(self._buf), n_new), dtype=dtype)
+            buf[:self._n] = self._buf[:self._n]
+            self._buf = buf
+        self._buf[self._n:n_new] = arr
+        self._n = n_new
+
+
+class ColumnarBlock:
+    """
+    Block with the same interface as :class:`Block`, but which stores the
+    timestamps and each field in a growable, typed numpy buffer rather than a
+    list of python objects.
+
+    NumPy arrays passed to extend() are copied into the buffers in one go,
+    with no per-sample conversion, and data is only converted to lists when
+    the block is encoded for publishing. The ``timestamps`` and ``data``
+    attributes return numpy arrays (views of the buffers), except for fields
+    holding strings or mixed types, which are stored as lists.
+    """
+
+    def __init__(self, name, keys):
+        self.name = name
+        self._timestamps = _Column(dtype=np.dtype(np.float64))
+        self._columns = {k: _Column() for k in keys}
+
+    @property
+    def timestamps(self):
+        return self._timestamps.values()
+
+    @property
+    def data(self):
+        return {k: c.values() for k, c in self._columns.items()}
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def empty(self):
+        """ Returns true if block is empty"""
+        return len(self._timestamps) == 0
+
+    def clear(self):
+        """
+        Empties block's buffers
+        """
+        self._timestamps.clear()
+        for c in self._columns.values():
+            c.clear()
+
+    def append(self, d):
+        """
+        Adds a single data point to the block
+        """
+        if d['data'].keys() != self._columns.keys():
+            raise Exception("Block structure does not match: {}".format(self.name))
+
+        self._timestamps.extend((d['timestamp'],))
+        for k, c in self._columns.items():
+            c.extend((d['data'][k],))
+
+    def extend(self, block):
+        """
+        Extends the data block by an encoded block. Values may be lists or
+        numpy arrays.
+        """
+        if block['data'].keys() != self._columns.keys():
+            raise Exception("Block structure does not match: {}".format(self.name))
+
+        self._timestamps.extend(block['timestamps'])
+        for k, c in self._columns.items():
+            c.extend(block['data'][k])
+
+    def encoded(self):
+        n = len(self._timestamps)
+        assert (all([n == len(c) for c in self._columns.values()]))
+        return {
+            'block_name': self.name,
+            'data': {k: c.tolist() for k, c in self._columns.items()},
+            'timestamps': self._timestamps.tolist(),
+        }
+
+
+#: Version of the packed block format written by :func:`pack_block`.
+PACKED_VERSION = 1
+
+#: Resolution (seconds) of compacted timestamps.
+TIMESTAMP_RESOLUTION = 1e-6
+
+
+def compact_timestamps(timestamps, resolution=TIMESTAMP_RESOLUTION):
+    """Compact a run of timestamps for publishing.
+
+    Evenly sampled timestamps, reproduced by ``t0 + i * dt`` to within half
+    of ``resolution``, are described by ``{'t0': t0, 'dt': dt, 'n': n}``.
+    Anything else is delta encoded as ``{'t0': t0, 'resolution': resolution,
+    'deltas': [...]}``, where the deltas are integer multiples of resolution
+    between successive samples, which are much smaller to serialize than full
+    floats. Either way the timestamps are reproduced to within half of
+    ``resolution``. See :func:`expand_timestamps`.
+
+    Args:
+        timestamps (list or numpy.ndarray):
+            Timestamps to compact. Must not be empty.
+        resolution (float, optional):
+            Precision (in seconds) to keep.
+
+    Returns:
+        dict: Compacted timestamps.
+
+    """
+    ts = np.asarray(timestamps, dtype=np.float64)
+    t0 = float(ts[0])
+    n = len(ts)
+    dt = float(ts[-1] - t0) / (n - 1) if n > 1 else 0.
+    offsets = ts - t0
+    if np.all(np.abs(offsets - np.arange(n) * dt) <= resolution / 2):
+        return {'t0': t0, 'dt': dt, 'n': n}
+
+    # Quantize offsets from t0 rather than the deltas themselves, so the
+    # rounding error doesn't accumulate along the run.
+    steps = np.round(offsets / resolution).astype(np.int64)
+    return {'t0': t0, 'resolution': resolution,
+            'deltas': np.diff(steps).tolist()}
+
+
+def expand_timestamps(timestamps, as_array=False):
+    """Expand timestamps compacted by :func:`compact_timestamps`. Timestamps
+    that aren't compacted are returned unchanged.
+
+    Args:
+        timestamps (dict, list or numpy.ndarray):
+            Timestamps as found in a published block.
+        as_array (bool, optional):
+            If True, expanded timestamps are returned as a numpy array,
+            otherwise as a list.
+
+    """
+    if not isinstance(timestamps, dict):
+        return timestamps
+
+    if 'dt' in timestamps:
+        ts = timestamps['t0'] + np.arange(timestamps['n']) * timestamps['dt']
+    else:
+        steps = np.zeros(len(timestamps['deltas']) + 1, dtype=np.int64)
+        np.cumsum(timestamps['deltas'], out=steps[1:])
+        ts = timestamps['t0'] + steps * timestamps['resolution']
+
+    return ts if as_array else ts.tolist()
+
+
+def _pack_column(values):
+    """Pack a column of uniformly numeric (or bool) values as a dtype string
+    and a little-endian buffer. Anything else is returned as a list."""
+    if isinstance(values, np.ndarray):
+        arr = values
+    elif len(set(map(type, values))) == 1:
+        arr = np.asarray(values)
+    else:
+        return list(values)
+
+    dtype = _COLUMN_DTYPES.get(arr.dtype.kind)
+    if dtype is None or arr.ndim != 1 or not np.can_cast(arr.dtype, dtype):
+        return arr.tolist() if isinstance(values, np.ndarray) else values
+    dtype = dtype.newbyteorder('<')
+    return {'dtype': dtype.str, 'buf': arr.astype(dtype, copy=False).tobytes()}
+
+
+def pack_block(name, timestamps, data, compact=False):
+    """Encode a block for publishing in the 'packed' feed encoding.
+
+    Timestamps and numeric fields are stored as little-endian arrays (float64,
+    int64 or bool) inside a msgpack envelope, rather than as lists. Fields of
+    strings or mixed types are kept as lists. The result is tagged with
+    ``PACKED_VERSION`` so subscribers can tell which format they received.
+
+    Args:
+        name (str):
+            Block name.
+        timestamps (list or numpy.ndarray):
+            Sample timestamps.
+        data (dict):
+            Field values, each a list or numpy array.
+        compact (bool, optional):
+            If True, timestamps are stored as compacted by
+            :func:`compact_timestamps`.
+
+    Returns:
+        dict: ``{'block_name': name, 'packed': PACKED_VERSION, 'payload':
+        bytes}``
+
+    """
+    if compact:
+        timestamps = compact_timestamps(timestamps)
+    else:
+        timestamps = np.asarray(timestamps, dtype='<f8').tobytes()
+    payload = {
+        'timestamps': timestamps,
+        'data': {k: _pack_column(v) for k, v in data.items()},
+    }
+    return {
+        'block_name': name,
+        'packed': PACKED_VERSION,
+        'payload': msgpack.packb(payload),
+    }
+
+
+def unpack_block(block, as_arrays=False):
+    """Decode a block published in the 'packed' feed encoding. Blocks that
+    are not packed are returned unchanged, so this can be applied to any
+    recorded feed data.
+
+    Args:
+        block (dict):
+            Block as received from a feed.
+        as_arrays (bool, optional):
+            If True, timestamps and numeric fields are returned as (read-only)
+            numpy arrays. Otherwise they are converted to lists.
+
+    Returns:
+        dict: Block in the standard ``{'block_name', 'timestamps', 'data'}``
+        structure. Compacted timestamps are left compacted, to be expanded
+        where they are used with :func:`expand_timestamps`.
+
+    Raises:
+        ValueError: If the block was packed with a newer, unsupported, format
+            version.
+
+    """
+    version = block.get('packed')
+    if version is None:
+        return block
+    if version > PACKED_VERSION:
+        raise ValueError(f"Packed block format version {version} is not "
+                         f"supported (max {PACKED_VERSION}). Please update ocs.")
+
+    payload = msgpack.unpackb(block['payload'])
+    timestamps = payload['timestamps']
+    if isinstance(timestamps, bytes):
+        timestamps = np.frombuffer(timestamps, dtype='<f8')
+        if not as_arrays:
+            timestamps = timestamps.tolist()
+    data = {}
+    for k, v in payload['data'].items():
+        if isinstance(v, dict):
+            v = np.frombuffer(v['buf'], dtype=v['dtype'])
+            if not as_arrays:
+                v = v.tolist()
+        data[k] = v
+
+    return {
+        'block_name': block['block_name'],
+        'timestamps': timestamps,
+        'data': data,
+    }
+
+
+def decode_feed_data(data, as_arrays=False):
+    """Decode the data dict of a recorded feed message, unpacking any packed
+    blocks. See :func:`unpack_block`."""
+    return {k: unpack_block(b, as_arrays=as_arrays) for k, b in data.items()}
+
+
+class _SpillRing:
+    """
+    On-disk FIFO of encoded feed payloads, used by Feed when publishing fails
+    and ``overflow_policy='spill'``. Each payload is written to its own
+    msgpack file, named by a sequence number, in ``directory``. Files already present
+    in ``directory`` (for example, from before an Agent restart) are picked
+    up and replayed first. If the ring grows beyond ``max_bytes`` the oldest
+    files are discarded.
+
+    This class should only be accessed via a single thread.
+
+    Args:
+        directory (path):
+            Directory to store payload files in. Created if needed.
+        max_bytes (int):
+            Maximum total size of the payload files.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._files = deque()  # (path, n_samples, size), oldest first
+        self.samples = 0
+        self.bytes = 0
+        self._next_seq = 0
+        for fname in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(fname)
+            if ext != '.msgpack':
+                continue
+            try:
+                seq, n = map(int, stem.split('_'))
+            except ValueError:
+                txaio.make_logger().warn(
+                    "Ignoring unexpected file in spill directory: {f}",
+                    f=os.path.join(directory, fname))
+                continue
+            path = os.path.join(directory, fname)
+            self._add(path, n, os.path.getsize(path))
+            self._next_seq = seq + 1
+
+    def __len__(self):
+        return len(self._files)
+
+    def _add(self, path, n, size):
+        self._files.append((path, n, size))
+        self.samples += n
+        self.bytes += size
+
+    def push(self, payload, n):
+        """Writes a payload with n samples to the end of the ring.
+
+        Returns:
+            int: Number of samples discarded to stay within max_bytes.
+        """
+        name = '{:012d}_{}.msgpack'.format(self._next_seq, n)
+        self._next_seq += 1
+        path = os.path.join(self.directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(msgpack.packb(payload))
+        os.replace(tmp, path)
+        self._add(path, n, os.path.getsize(path))
+
+        dropped = 0
+        while self.bytes > self.max_bytes and len(self._files) > 1:
+            dropped += self.pop_discard()
+        return dropped
+
+    def peek(self):
+        """Returns (payload, n_samples) for the oldest payload."""
+        path, n, _ = self._files[0]
+        with open(path, 'rb') as f:
+            return msgpack.unpackb(f.read()), n
+
+    def pop_discard(self):
+        """Removes the oldest payload, returning its number of samples."""
+        path, n, size = self._files.popleft()
+        self.samples -= n
+        self.bytes -= size
+        os.remove(path)
+        return n
+
+    def peek_many(self, max_bytes):
+        """Reads the oldest payloads, up to about max_bytes of files (and at
+        least one), without removing them.
+
+        Returns:
+            list: (path, payload, n_samples) of each payload read.
+        """
+        out = []
+        size = 0
+        for path, n, file_size in self._files:
+            if out and size + file_size > max_bytes:
+                break
+            with open(path, 'rb') as f:
+                out.append((path, msgpack.unpackb(f.read()), n))
+            size += file_size
+        return out
+
+    def discard(self, path):
+        """Removes the payload in ``path``, if it's still in the ring (it
+        may have been discarded to stay within max_bytes)."""
+        for i, (p, n, size) in enumerate(self._files):
+            if p == path:
+                del self._files[i]
+                self.samples -= n
+                self.bytes -= size
+                os.remove(path)
+                return
+
+
+def _message_bytes(data):
+    """Estimate the size of a feed message's data, as in Feed: 8 bytes per
+    value, including timestamps. Packed blocks count their payload size."""
+    size = 0
+    for block in data.values():
+        if 'payload' in block:
+            size += len(block['payload'])
+            continue
+        fields = block.get('data', {})
+        n = len(next(iter(fields.values()))) if fields else 0
+        size += 8 * n * (len(fields) + 1)
+    return size
+
+
+class FeedQueue:
+    """
+    Bounded, thread-safe queue of (data, feed) messages received from
+    recorded feeds, for subscribers such as the HK Aggregator and the
+    InfluxDB Publisher. It is used like a :class:`queue.Queue` (``put``,
+    ``get``, ``get_nowait``, ``empty`` and ``qsize``), but once it holds
+    ``max_messages`` messages, or an estimated ``max_bytes`` of data, it
+    applies ``policy`` rather than growing without limit. The policies are:
+
+    - 'drop_oldest': discard the oldest queued messages.
+    - 'coalesce': replace the latest queued message from the same feed with
+      the new one, so that a slow consumer gets the freshest data from every
+      feed rather than a backlog from the busiest ones. If the feed has
+      nothing queued, the oldest message is discarded.
+    - 'spill': write new messages to an on-disk ring in ``spill_dir`` until
+      the consumer catches up. Messages are still returned in order. So that
+      a slow disk doesn't hold up ``put`` (usually called from the reactor
+      thread), messages to be spilled are staged in memory and written out
+      by a helper thread, and ``get`` reads them back without holding up
+      ``put``. Staged messages count towards ``spill_max_bytes`` (by
+      their estimated size), and any still staged when the process exits
+      are lost.
+
+    Anything put on the queue that isn't a (data, feed) pair, such as a None
+    used to wake up the consumer, is always queued in memory and not
+    counted.
+
+    Args:
+        max_messages (int, optional):
+            Maximum number of messages held in memory. If 0, no limit.
+        max_bytes (int, optional):
+            Maximum estimated size of the messages held in memory, counting
+            8 bytes per value. If 0, no limit.
+        policy (str, optional):
+            One of 'drop_oldest', 'coalesce' or 'spill'.
+        spill_dir (path, optional):
+            Directory for the spill ring; required for the 'spill' policy.
+            Messages found there on startup are returned first.
+        spill_max_bytes (int, optional):
+            Maximum size of the spill ring. The oldest messages are
+            discarded beyond this. Defaults to 1 GB.
+
+    Attributes:
+        dropped (int):
+            Total number of messages discarded.
+        high_water (int):
+            Largest number of messages held in memory.
+        high_water_bytes (int):
+            Largest estimated size of the messages held in memory.
+    """
+
+    POLICIES = ['drop_oldest', 'coalesce', 'spill']
+
+    def __init__(self, max_messages=0, max_bytes=0, policy='drop_oldest',
+                 spill_dir=None, spill_max_bytes=1e9):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Invalid policy '{policy}', must be one of "
+                             f"{self.POLICIES}")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        self.log = txaio.make_logger()
+        self._queue = deque()  # (item, address, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._feeds = {}
+
+        self.dropped = 0
+        self.high_water = 0
+        self.high_water_bytes = 0
+
+        self._spill = None
+        if policy == 'spill':
+            if spill_dir is None:
+                raise ValueError("spill_dir must be set for the 'spill' "
+                                 "policy")
+            self._spill = _SpillRing(spill_dir, spill_max_bytes)
+            # Serializes access to the ring, which is done without holding
+            # self._lock
+            self._spill_lock = threading.Lock()
+            # Messages waiting to be written to the ring, and the number
+            # being written
+            self._staged = deque()  # (item, address, size)
+            self._staged_bytes = 0
+            self._in_transit = 0
+            self._staged_cond = threading.Condition(self._lock)
+            threading.Thread(target=self._write_spill, name='feedqueue-spill',
+                             daemon=True).start()
+
+    def _feed_stats(self, address):
+        stats = self._feeds.get(address)
+        if stats is None:
+            stats = {'queued': 0, 'dropped': 0, 'high_water': 0}
+            self._feeds[address] = stats
+        return stats
+
+    def _full(self, size):
+        if not self._queue:
+            return False
+        if self.max_messages and len(self._queue) >= self.max_messages:
+            return True
+        return bool(self.max_bytes) and self._bytes + size > self.max_bytes
+
+    def _append(self, item, address, size):
+        self._queue.append((item, address, size))
+        self._bytes += size
+        self.high_water = max(self.high_water, len(self._queue))
+        self.high_water_bytes = max(self.high_water_bytes, self._bytes)
+        if address is not None:
+            stats = self._feed_stats(address)
+            stats['queued'] += 1
+            stats['high_water'] = max(stats['high_water'], stats['queued'])
+
+    def _remove(self, address, size):
+        self._bytes -= size
+        if address is not None:
+            self._feeds[address]['queued'] -= 1
+
+    def _drop(self, address, n=1):
+        self.dropped += n
+        if address is not None:
+            self._feed_stats(address)['dropped'] += n
+
+    def _drop_oldest(self):
+        # Keep wake up items, which aren't counted
+        for i, (item, address, size) in enumerate(self._queue):
+            if address is not None:
+                del self._queue[i]
+                self._remove(address, size)
+                self._drop(address)
+                return True
+        return False
+
+    def _coalesce(self, item, address, size):
+        for i in range(len(self._queue) - 1, -1, -1):
+            if self._queue[i][1] == address:
+                self._remove(address, self._queue[i][2])
+                self._drop(address)
+                del self._queue[i]
+                self._queue.insert(i, (item, address, size))
+                self._bytes += size
+                self._feeds[address]['queued'] += 1
+                return True
+        return False
+
+    def put(self, item):
+        """Adds an item to the queue, applying the policy if it's full."""
+        with self._cond:
+            try:
+                data, feed = item
+                address = feed['address']
+            except (TypeError, ValueError):
+                self._queue.append((item, None, 0))
+                self._cond.notify()
+                return
+            size = _message_bytes(data)
+
+            if self._spill is not None:
+                if (len(self._spill) or self._staged or self._in_transit
+                        or self._full(size)):
+                    self._stage(item, address, size)
+                    self._cond.notify()
+                    return
+            elif self._full(size):
+                if self.policy == 'coalesce' and \
+                        self._coalesce(item, address, size):
+                    self._cond.notify()
+                    return
+                while self._full(size) and self._drop_oldest():
+                    pass
+
+            self._append(item, address, size)
+            self._cond.notify()
+
+    def _stage(self, item, address, size):
+        """Stages a message for the spill writer. Must hold self._lock."""
+        while self._staged and (self._staged_bytes + size
+                                + self._spill.bytes > self._spill.max_bytes):
+            _, old_address, old_size = self._staged.popleft()
+            self._staged_bytes -= old_size
+            self._drop(old_address)
+        self._staged.append((item, address, size))
+        self._staged_bytes += size
+        self._staged_cond.notify()
+
+    def _write_spill(self):
+        """Writes staged messages to the spill ring. Runs in its own
+        thread."""
+        while True:
+            with self._lock:
+                self._staged_cond.wait_for(lambda: self._staged)
+                item, _, size = self._staged.popleft()
+                self._staged_bytes -= size
+                self._in_transit += 1
+            try:
+                with self._spill_lock:
+                    # The ring discards its oldest messages if it's full
+                    dropped = self._spill.push(list(item), 1)
+            except Exception as e:
+                self.log.error("Could not spill message to disk: {e}", e=e)
+                dropped = 1
+            with self._lock:
+                self._in_transit -= 1
+                self._drop(None, dropped)
+                self._cond.notify_all()
+
+    def _ready(self):
+        """True if an item can be returned straight away. Staged messages
+        can only be taken once the ring and the spill writer are done with
+        older messages."""
+        if self._queue:
+            return True
+        if self._spill is None:
+            return False
+        return bool(len(self._spill)
+                    or (self._staged and not self._in_transit))
+
+    def _empty(self):
+        if self._queue:
+            return False
+        if self._spill is None:
+            return True
+        return not (len(self._spill) or self._staged or self._in_transit)
+
+    def _read_spill(self):
+        """Reads the oldest message from the spill ring, without holding
+        self._lock. Returns None if another consumer got to it first."""
+        with self._spill_lock:
+            if not len(self._spill):
+                return None
+            (data, feed), _ = self._spill.peek()
+            self._spill.pop_discard()
+            return data, feed
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the oldest item. See :meth:`queue.Queue.get`.
+
+        Raises:
+            queue.Empty: If no item is available.
+        """
+        while True:
+            with self._cond:
+                if block:
+                    if not self._cond.wait_for(self._ready, timeout=timeout):
+                        raise queue.Empty
+                elif self._empty():
+                    raise queue.Empty
+                elif not self._ready():
+                    # Only messages being spilled, wait for them
+                    self._cond.wait_for(self._ready)
+                if self._queue:
+                    item, address, size = self._queue.popleft()
+                    self._remove(address, size)
+                    return item
+                if not len(self._spill):
+                    item, _, size = self._staged.popleft()
+                    self._staged_bytes -= size
+                    return item
+            item = self._read_spill()
+            if item is not None:
+                return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        with self._cond:
+            return self._empty()
+
+    def qsize(self):
+        with self._cond:
+            n = len(self._queue)
+            if self._spill is not None:
+                n += len(self._spill) + len(self._staged) + self._in_transit
+            return n
+
+    def stats(self):
+        """Returns a dict describing the queue, suitable for session.data.
+
+        Example::
+
+            {"depth": 12, "bytes": 48096, "high_water": 310,
+             "high_water_bytes": 1240640, "dropped": 25,
+             "feeds": {"observatory.LSSIM.feeds.temperatures":
+                         {"queued": 12, "dropped": 25, "high_water": 200}}}
+
+        When spilling, "spilled" and "spilled_bytes" give the number of
+        messages and bytes in the spill ring, and "staged" the number of
+        messages waiting to be written to it.
+        """
+        with self._cond:
+            stats = {
+                'depth': len(self._queue),
+                'bytes': self._bytes,
+                'high_water': self.high_water,
+                'high_water_bytes': self.high_water_bytes,
+                'dropped': self.dropped,
+                'feeds': {k: dict(v) for k, v in self._feeds.items()},
+            }
+            if self._spill is not None:
+                stats['spilled'] = len(self._spill)
+                stats['spilled_bytes'] = self._spill.bytes
+                stats['staged'] = len(self._staged) + self._in_transit
+            return stats
+
+
 class Feed:
     """
     Manages publishing to a specific feed and storing of messages.
@@ -86,6 +904,12 @@ class Feed:
                 **exclude_influx** (bool):
                     If True, the InfluxPublisher will not write the feed to
                     Influx.
+                **influx_downsample** (float):
+                    If set, the InfluxPublisher writes statistics over
+                    windows of this many seconds rather than every sample.
+                **influx_stats** (list):
+                    Statistics written for downsampled feeds, from 'min',
+                    'mean', 'max' and 'last'. Defaults to all four.
 
         buffer_time (int, optional):
             Specifies time that messages should be buffered in seconds.
@@ -93,10 +917,78 @@ class Feed:
             Defaults to 0.
         max_messages (int, optional):
             Max number of messages stored. Defaults to 20.
+        flush_samples (int, optional):
+            Publish the buffer early once it holds this many samples (summed
+            over all blocks). If 0, there is no sample limit. Defaults to 0.
+        flush_bytes (int, optional):
+            Publish the buffer early once its estimated size reaches this
+            many bytes. The estimate counts 8 bytes per value, including
+            timestamps. If 0, there is no size limit. Defaults to 0.
+        columnar (bool, optional):
+            If True, recorded data is buffered in :class:`ColumnarBlock`
+            objects, which store samples in typed numpy buffers and accept
+            numpy arrays without per-sample conversion. Recommended for high
+            rate feeds. Defaults to False.
+        encoding (str, optional):
+            Encoding of recorded data sent over WAMP. 'list' sends each block
+            as lists. 'packed' sends timestamps and numeric fields as packed
+            little-endian arrays in a versioned msgpack envelope (see
+            :func:`pack_block`), which is much cheaper to serialize, route and
+            decode for high rate feeds. Subscribers need to decode packed
+            blocks with :func:`decode_feed_data`. Defaults to 'list'.
+        compact_timestamps (bool, optional):
+            If True, published timestamps are compacted: evenly sampled runs
+            are sent as (t0, dt, n), others as integer deltas, with a
+            resolution of 1 us (see :func:`compact_timestamps`). Subscribers
+            expand them with :func:`expand_timestamps`. Defaults to False.
+        max_samples (int, optional):
+            Maximum number of samples a recorded feed holds in memory, counting
+            both buffered data and data from publishes that failed (for
+            instance while the crossbar server is unreachable). Failed
+            publishes are kept and retried, in order, on the next flush and
+            when the Agent reconnects. When the limit would be exceeded
+            ``overflow_policy`` applies. If 0, data that fails to publish is
+            dropped (and logged) and buffering is unbounded. Defaults to 0.
+        overflow_policy (str, optional):
+            What to do when ``max_samples`` would be exceeded. One of
+            'drop_oldest' (discard the oldest unpublished data),
+            'drop_newest' (discard the incoming message), 'block' (block
+            publishing worker threads until there is room; nothing is
+            discarded, so messages already queued, or published from the
+            reactor thread, may exceed the limit) or 'spill' (move
+            unpublished data to an on-disk ring in ``spill_dir``). Defaults
+            to 'drop_oldest'.
+        spill_dir (path, optional):
+            Base directory for the spill ring; required for the 'spill'
+            policy. Each feed uses a subdirectory named after its address.
+            Data found there on startup is replayed. The ring is only
+            accessed from a helper thread, so disk I/O doesn't hold up the
+            reactor, and is replayed in batches of about
+            ``SPILL_REPLAY_BYTES``, each published from its own reactor
+            call.
+        spill_max_bytes (int, optional):
+            Maximum size of the spill ring. The oldest data is discarded
+            beyond this. Defaults to 100 MB.
+
+    Attributes:
+        staging (ReactorCallQueue):
+            Queue through which messages published from worker threads are
+            handed to the reactor thread. Use ``staging.stats()`` for the
+            queue depth and drain latency.
+        dropped_samples (int):
+            Number of samples discarded because of overflow or failed
+            publishes.
     """
 
+    OVERFLOW_POLICIES = ['drop_oldest', 'drop_newest', 'block', 'spill']
+    ENCODINGS = ['list', 'packed']
+    SPILL_REPLAY_BYTES = 1e6
+
     def __init__(self, agent, feed_name, record=False, agg_params={},
-                 buffer_time=0, max_messages=0):
+                 buffer_time=0, max_messages=0, flush_samples=0, flush_bytes=0,
+                 columnar=False, encoding='list', compact_timestamps=False,
+                 max_samples=0, overflow_policy='drop_oldest',
+                 spill_dir=None, spill_max_bytes=100e6):
 
         self.agent = agent
         self.feed_name = feed_name
@@ -105,12 +997,61 @@ class Feed:
 
         self.buffer_time = buffer_time
         self.buffer_start_time = None
+        self.flush_samples = flush_samples
+        self.flush_bytes = flush_bytes
+        # Flushes the buffer buffer_time after it was started, if no
+        # message arrives to do it first.
+        self._flush_call = None
 
+        self.columnar = columnar
         self.blocks = {}
+        # Field names already verified, by block_name
+        self._verified_fields = {}
+        self.staging = ReactorCallQueue()
 
         self.agent_address = self.agent.agent_address
         self.address = "{}.feeds.{}".format(self.agent_address, self.feed_name)
 
+        if encoding not in self.ENCODINGS:
+            raise ValueError(f"Invalid encoding '{encoding}', must be one of "
+                             f"{self.ENCODINGS}")
+        self.encoding = encoding
+        self.compact_timestamps = compact_timestamps
+
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow_policy '{overflow_policy}', "
+                             f"must be one of {self.OVERFLOW_POLICIES}")
+        self.max_samples = max_samples
+        self.overflow_policy = overflow_policy
+        self.dropped_samples = 0
+        self._buffered_samples = 0
+        self._buffered_bytes = 0
+        self._pending = deque()  # (payload, n_samples) of failed publishes
+        self._pending_samples = 0
+        self._space = threading.Condition()
+
+        self._spill = None
+        if overflow_policy == 'spill':
+            if spill_dir is None:
+                raise ValueError("spill_dir must be set when "
+                                 "overflow_policy='spill'")
+            self._spill = _SpillRing(os.path.join(spill_dir, self.address),
+                                     spill_max_bytes)
+            # State of the spill I/O, only touched by the reactor thread:
+            # payloads waiting to be written, and being written, to the
+            # ring; payloads read back from the ring but not yet published,
+            # as (path, payload, n); paths of published payloads to remove;
+            # and the number of payloads in the ring not yet read back.
+            self._to_spill = deque()
+            self._spilling = []
+            self._replaying = deque()
+            self._replayed_paths = []
+            self._ring_unread = len(self._spill)
+            self._spill_busy = False
+            self._spill_jobs = queue.Queue()
+            threading.Thread(target=self._run_spill_io, name='feed-spill',
+                             daemon=True).start()
+
     def encoded(self):
         return {
             "agent_address": self.agent_address,
@@ -119,28 +1060,225 @@ class Feed:
             "address": self.address,
             "record": self.record,
             "session_id": self.agent.agent_session_id,
-            "agent_class": self.agent.class_name
+            "agent_class": self.agent.class_name,
+            "encoding": self.encoding,
         }
 
+    def buffer_occupancy(self):
+        """Number of samples held in memory: buffered, plus those from
+        publishes that failed and are waiting to be retried."""
+        return self._buffered_samples + self._pending_samples
+
+    def buffer_status(self):
+        """Returns a dict describing buffer occupancy, suitable for
+        session.data."""
+        status = {
+            'buffered_samples': self._buffered_samples,
+            'pending_samples': self._pending_samples,
+            'max_samples': self.max_samples,
+            'dropped_samples': self.dropped_samples,
+        }
+        if self._spill is not None:
+            status['spilled_samples'] = self._spill.samples
+            status['spilled_bytes'] = self._spill.bytes
+            status['spill_queue_samples'] = sum(
+                n for _, n in itertools.chain(self._to_spill, self._spilling))
+        return status
+
+    def _drop(self, n, reason):
+        self.dropped_samples += n
+        self.agent.log.error('Feed {address} discarded {n} samples: {reason}',
+                             address=self.address, n=n, reason=reason)
+
+    def _notify_space(self):
+        if self.overflow_policy == 'block':
+            with self._space:
+                self._space.notify_all()
+
+    def _send(self, payload):
+        """Publish one payload. Returns False if the transport is down."""
+        try:
+            self.agent.publish(self.address, (payload, self.encoded()))
+        except TransportLost:
+            self.agent.log.error('Could not publish to Feed. TransportLost. '
+                                 + 'crossbar server likely unreachable.')
+            return False
+        return True
+
+    def replay(self):
+        """Publishes data from earlier failed publishes, oldest first, until
+        everything is sent or a publish fails. This is called on every flush,
+        and by the OCSAgent when it (re)joins the realm."""
+        if not in_reactor_context():
+            return self.staging.call(self.replay)
+
+        if self._spill is not None:
+            while self._replaying:
+                path, payload, n = self._replaying[0]
+                if not self._send(payload):
+                    return False
+                self._replaying.popleft()
+                self._replayed_paths.append(path)
+            # Reads the next batch, and removes what was published
+            self._kick_spill_io()
+            if self._ring_unread or self._to_spill or self._spilling:
+                # Older data is still on disk, or on its way there
+                return False
+
+        while self._pending:
+            payload, n = self._pending[0]
+            if not self._send(payload):
+                if not self.max_samples:
+                    self._pending.clear()
+                    self._pending_samples = 0
+                    self._drop(n, 'publish failed')
+                return False
+            self._pending.popleft()
+            self._pending_samples -= n
+            self._notify_space()
+
+        return True
+
+    def _stash(self, payload, n):
+        """Queue a payload to be published, in order, after anything
+        already waiting."""
+        self._pending.append((payload, n))
+        self._pending_samples += n
+
+    def _spill_pending(self):
+        """Moves the pending payloads to the spill ring. They are newer than
+        anything already in the ring, so the order is preserved."""
+        while self._pending:
+            payload, n = self._pending.popleft()
+            self._pending_samples -= n
+            self._to_spill.append((payload, n))
+        self._kick_spill_io()
+
+    def _kick_spill_io(self):
+        """Hands the spill I/O that's due to the helper thread: writing
+        payloads to the ring, removing published ones, and, once the last
+        batch read has been published, reading the next one. Only one batch
+        of I/O runs at a time."""
+        if self._spill_busy:
+            return
+        read = not self._replaying and self._ring_unread > 0
+        if not (self._to_spill or self._replayed_paths or read):
+            return
+        self._spilling = list(self._to_spill)
+        self._to_spill.clear()
+        self._spill_jobs.put((self._spilling, self._replayed_paths, read))
+        self._replayed_paths = []
+        self._spill_busy = True
+
+    def _run_spill_io(self):
+        """Does the spill ring I/O. Runs in its own thread, and is the only
+        user of the ring once the Feed is constructed."""
+        while True:
+            writes, removes, read = self._spill_jobs.get()
+            dropped = 0
+            batch = []
+            try:
+                for path in removes:
+                    self._spill.discard(path)
+                for i, (payload, n) in enumerate(writes):
+                    try:
+                        dropped += self._spill.push(payload, n)
+                    except Exception as e:
+                        self.agent.log.error('Feed {address} could not '
+                                             'spill data: {e}',
+                                             address=self.address, e=e)
+                        dropped += n
+                if read:
+                    batch = self._spill.peek_many(self.SPILL_REPLAY_BYTES)
+            except Exception as e:
+                self.agent.log.error('Feed {address} spill ring error: {e}',
+                                     address=self.address, e=e)
+            unread = len(self._spill) - len(batch)
+            self.staging.call(self._spill_io_done, dropped, batch, unread)
+
+    def _spill_io_done(self, dropped, batch, unread):
+        """Reactor side of a batch of spill I/O finishing."""
+        self._spill_busy = False
+        self._spilling = []
+        if dropped:
+            self._drop(dropped, 'spill ring full')
+        self._replaying.extend(batch)
+        self._ring_unread = unread
+        # Publishes the batch read, and starts on the next one
+        if self.replay():
+            self._notify_space()
+
     def flush_buffer(self):
-        """Publishes all messages in buffer and empties it."""
+        """Publishes all messages in buffer and empties it. Data that fails to
+        publish is kept, subject to ``max_samples``, and retried on the next
+        flush."""
 
         if not in_reactor_context():
-            return reactor.callFromThread(self.flush_buffer)
-        if self.buffer_start_time is None:
+            return self.staging.call(self.flush_buffer)
+        if not self.record:
             return
 
-        if self.record:
-            try:
-                self.agent.publish(self.address, (
-                    {k: b.encoded() for k, b in self.blocks.items() if b.timestamps},
-                    self.encoded()
-                ))
-            except TransportLost:
-                self.agent.log.error('Could not publish to Feed. TransportLost. '
-                                     + 'crossbar server likely unreachable.')
+        if self.buffer_start_time is not None:
+            payload = {k: self._encode_block(b)
+                       for k, b in self.blocks.items() if not b.empty()}
+            n = self._buffered_samples
             for k, b in self.blocks.items():
                 b.clear()
+            self._buffered_samples = 0
+            self._buffered_bytes = 0
+            self.buffer_start_time = None
+            if self._flush_call is not None and self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+            if payload:
+                self._stash(payload, n)
+
+        self.replay()
+        self._notify_space()
+
+    def _encode_block(self, block):
+        if self.encoding == 'packed':
+            return pack_block(block.name, block.timestamps, block.data,
+                              compact=self.compact_timestamps)
+        encoded = block.encoded()
+        if self.compact_timestamps:
+            encoded['timestamps'] = compact_timestamps(block.timestamps)
+        return encoded
+
+    def _flush_stale_buffer(self):
+        """Timer callback, publishing a buffer that no new message has
+        flushed within buffer_time."""
+        self._flush_call = None
+        self.flush_buffer()
+
+    def _make_room(self, n):
+        """Apply the overflow policy so n more samples can be buffered.
+        Returns False if the incoming samples should be discarded."""
+        # Publishing may be all that's needed
+        self.flush_buffer()
+        if self.buffer_occupancy() + n <= self.max_samples:
+            return True
+
+        if self.overflow_policy == 'drop_oldest':
+            while self._pending and self.buffer_occupancy() + n > self.max_samples:
+                _, n_old = self._pending.popleft()
+                self._pending_samples -= n_old
+                self._drop(n_old, 'buffer full, dropping oldest data')
+            return self.buffer_occupancy() + n <= self.max_samples
+
+        if self.overflow_policy == 'spill':
+            self._spill_pending()
+            return True
+
+        # With 'block' the limit is enforced on the publishing threads.
+        return self.overflow_policy == 'block'
+
+    def _wait_for_space(self):
+        """Block the calling (worker) thread while the buffer is full."""
+        with self._space:
+            self._space.wait_for(
+                lambda: self.buffer_occupancy() < self.max_samples)
 
     def publish_message(self, message, timestamp=None):
         """
@@ -194,6 +1332,10 @@ class Feed:
            'timestamp'.  These data can be buffered, too, if
            self.sample_time > 0.
 
+           The lists may also be 1-d numpy arrays. The arrays are not
+           copied when handed to the reactor thread, so they should not
+           be modified after publishing.
+
         """
         current_time = time.time()
 
@@ -201,39 +1343,59 @@ class Feed:
             timestamp = current_time
 
         if not in_reactor_context():
+            if (self.record and self.max_samples
+                    and self.overflow_policy == 'block'):
+                self._wait_for_space()
             # Take a copy, for thread-safety.
             message = message.copy()
-            return reactor.callFromThread(self.publish_message, message,
-                                          timestamp=timestamp)
+            return self.staging.call(self.publish_message, message,
+                                     timestamp=timestamp)
 
         if self.record:
-            # check message contents
-            for k, v in message['data'].items():
-                Feed.verify_data_field_string(k)
-                Feed.verify_message_data_type(v)
+            self.verify_message(message)
 
             # Data is stored in Block objects
             block_name = message['block_name']
             try:
                 b = self.blocks[block_name]
             except KeyError:
-                b = Block(block_name, message['data'].keys())
+                block_class = ColumnarBlock if self.columnar else Block
+                b = block_class(block_name, message['data'].keys())
                 self.blocks[block_name] = b
 
             if 'timestamp' in message:
-                b.append(message)
+                n = 1
             elif 'timestamps' in message:
-                b.extend(message)
+                n = len(message['timestamps'])
             else:
                 raise RuntimeError('Invalid message when record=True.  keys=%s' %
                                    message.keys())
 
+            if (self.max_samples
+                    and self.buffer_occupancy() + n > self.max_samples):
+                if not self._make_room(n):
+                    self._drop(n, 'buffer full, dropping newest data')
+                    return
+
+            if 'timestamp' in message:
+                b.append(message)
+            else:
+                b.extend(message)
+            self._buffered_samples += n
+            self._buffered_bytes += 8 * n * (len(message['data']) + 1)
+
             if self.buffer_start_time is None:
                 self.buffer_start_time = current_time
-
-            if (current_time - self.buffer_start_time) >= self.buffer_time:
+                if self.buffer_time > 0:
+                    self._flush_call = reactor.callLater(
+                        self.buffer_time, self._flush_stale_buffer)
+
+            if ((current_time - self.buffer_start_time) >= self.buffer_time
+                    or (self.flush_samples
+                        and self._buffered_samples >= self.flush_samples)
+                    or (self.flush_bytes
+                        and self._buffered_bytes >= self.flush_bytes)):
                 self.flush_buffer()
-                self.buffer_start_time = None
 
         else:
             # Publish message immediately
@@ -243,6 +1405,33 @@ class Feed:
                 self.agent.log.error('Could not publish to Feed. TransportLost. '
                                      + 'crossbar server likely unreachable.')
 
+    def verify_message(self, message):
+        """Check the field names and data types of a recorded message.
+
+        Field names are verified the first time a block is published with a
+        given set of fields, and the result is cached, so later messages with
+        the same block structure only pay for the data type check. Numpy
+        arrays are checked on their dtype, without looking at each sample.
+
+        Args:
+            message (dict):
+                Message passed to Feed.publish_message.
+
+        Raises:
+            ValueError: If a field name is invalid.
+            TypeError: If the message contains unsupported data types.
+
+        """
+        data = message['data']
+        block_name = message.get('block_name')
+        if self._verified_fields.get(block_name) != data.keys():
+            for k in data:
+                Feed.verify_data_field_string(k)
+            self._verified_fields[block_name] = frozenset(data)
+
+        for v in data.values():
+            Feed.verify_message_data_type(v)
+
     @staticmethod
     def verify_message_data_type(value):
         """Aggregated Feeds can only store certain types of data. Here we check
@@ -250,17 +1439,24 @@ class Feed:
         supported types.
 
         Args:
-            value (list, float, int, bool):
+            value (list, numpy.ndarray, float, int, bool):
                 'data' dictionary value published (see Feed.publish_message for details).
 
         """
-        valid_types = (float, int, str, bool)
-
-        # multi-sample check
-        if isinstance(value, list):
-            if not all(isinstance(x, valid_types) for x in value):
-                type_set = set([type(x) for x in value])
-                invalid_types = type_set.difference(valid_types)
+        valid_types = _VALID_DATA_TYPES
+
+        # multi-sample check for arrays, done on the dtype
+        if isinstance(value, np.ndarray):
+            if value.ndim != 1 or value.dtype.kind not in 'biufU':
+                raise TypeError("message 'data' block contains invalid data "
+                                + f"array: dtype={value.dtype}, ndim={value.ndim}")
+
+        # multi-sample check, on the set of types present
+        elif isinstance(value, list):
+            type_set = set(map(type, value))
+            invalid_types = {t for t in type_set
+                             if not issubclass(t, valid_types)}
+            if invalid_types:
                 raise TypeError("message 'data' block contains invalid data"
                                 + f"types: {invalid_types}")
 
@@ -299,15 +1495,8 @@ class Feed:
             raise ValueError("Empty field name encountered, please enter "
                              + "a valid field name.")
 
-        # Complement (^) the set, matching any unlisted characters
-        check_invalid = re.compile('[^a-zA-Z0-9_]')
-
-        # Similar to check_invalid, search for non letter characters
-        # Leading ^ matches the start of string, so following numbers are valid
-        check_start = re.compile('^[^a-zA-Z]')
-
         # check for invalid characters
-        result = check_invalid.search(field)
+        result = _INVALID_FIELD_CHARS.search(field)
         if result:
             raise ValueError(f"message 'data' block contains the key {field} "
                              f"with the invalid character '{result.group(0)}'. "
@@ -315,7 +1504,7 @@ class Feed:
 
         # check for non-letter start, even after underscores
         stripped_key = field.strip("_")
-        if check_start.search(stripped_key):
+        if _NON_LETTER_START.search(stripped_key):
             raise ValueError(f"message 'data' block contains the key {field}, "
                              + "which does not start with a letter (after any "
                              + "number of leading underscores.)")
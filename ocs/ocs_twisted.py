@@ -1,8 +1,11 @@
 import threading
+from collections import deque
 from contextlib import contextmanager
 import time
 from autobahn.twisted.util import sleep as dsleep
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
 
 
 class TimeoutLock:
@@ -135,6 +138,108 @@ def in_reactor_context():
                        'currentThread.name="%s"' % t.name)
 
 
+class ReactorCallQueue:
+    """
+    Staging queue for calls that worker threads need to run in the reactor
+    thread. Calls are appended to a deque without taking a lock, and the
+    reactor runs everything that has accumulated in a single scheduled call,
+    so only the first call after each drain costs a
+    ``reactor.callFromThread`` wakeup. Calls run in the order they were
+    queued.
+
+    A drain runs at most ``max_batch`` calls before handing control back to
+    the reactor. Any remaining calls are drained on the next reactor
+    iteration, so a burst of data does not starve other events.
+
+    Args:
+        max_batch (int, optional):
+            Maximum number of calls run per drain. Defaults to 1000.
+
+    Attributes:
+        max_depth (int):
+            Largest number of calls seen waiting in the queue.
+        calls (int):
+            Total number of calls queued.
+        drains (int):
+            Number of times the queue has been drained.
+        last_drain_latency (float):
+            Time (seconds) between the first call of the last drained batch
+            being queued and the drain starting.
+        max_drain_latency (float):
+            Largest drain latency seen.
+    """
+
+    def __init__(self, max_batch=1000):
+        self.max_batch = max_batch
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._scheduled_at = None
+
+        self.max_depth = 0
+        self.calls = 0
+        self.drains = 0
+        self.last_drain_latency = None
+        self.max_drain_latency = 0.
+
+    def __len__(self):
+        return len(self._queue)
+
+    def call(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` to be run in the reactor thread.
+        May be called from any thread."""
+        self._queue.append((func, args, kwargs))
+        self.calls += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+            self._scheduled_at = time.time()
+        reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        # Clear the flag before popping anything, so calls queued from here
+        # on schedule a new drain rather than getting stranded.
+        with self._lock:
+            self._scheduled = False
+            scheduled_at = self._scheduled_at
+
+        latency = time.time() - scheduled_at
+        self.last_drain_latency = latency
+        self.max_drain_latency = max(self.max_drain_latency, latency)
+        self.drains += 1
+
+        for _ in range(self.max_batch):
+            try:
+                func, args, kwargs = self._queue.popleft()
+            except IndexError:
+                return
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                log.err(None, 'Error running call queued from thread')
+
+        if self._queue:
+            with self._lock:
+                if self._scheduled:
+                    return
+                self._scheduled = True
+                self._scheduled_at = time.time()
+            reactor.callLater(0, self._drain)
+
+    def stats(self):
+        """Returns a dict of queue metrics, suitable for session.data."""
+        return {
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'calls': self.calls,
+            'drains': self.drains,
+            'last_drain_latency': self.last_drain_latency,
+            'max_drain_latency': self.max_drain_latency,
+        }
+
+
 class Pacemaker:
     """
     The Pacemaker is a class to help Agents maintain a regular sampling rate
@@ -48,6 +48,7 @@ setup(name='ocs',
           'PyYAML',
           'influxdb',
           'numpy',
+          'msgpack',
       ],
       extras_require={
           "so3g": ["so3g"],
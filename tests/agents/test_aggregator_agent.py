@@ -1,3 +1,4 @@
+import copy
 from unittest import mock
 
 from agents.util import (
@@ -8,15 +9,39 @@ from agents.util import (
 
 # depends on spt3g
 from ocs.agents.aggregator.agent import AggregatorAgent
+from ocs.ocs_feed import pack_block
 
 args = mock.MagicMock()
 args.time_per_file = 3
+args.max_file_bytes = None
+args.max_file_frames = None
+args.align_files = False
+args.durability = 'flush'
+args.flush_bytes = None
+args.flush_interval = None
+args.no_file_index = False
+args.journal = False
+args.journal_sync = 1.
+args.compression = 'none'
+args.queue_max_messages = 0
+args.queue_max_bytes = 0
+args.queue_policy = 'drop_oldest'
+args.queue_spill_dir = None
+args.queue_spill_max_bytes = int(1e9)
+args.shard_count = 1
+args.shard_index = 0
+args.shard_patterns = None
 args.data_dir = '/tmp/data'
 # start idle so we can use a tmpdir for data_dir
 args.initial_state = 'idle'
 
 agent = create_agent_fixture(AggregatorAgent, {'args': args})
 
+shard_args = copy.copy(args)
+shard_args.shard_patterns = ['observatory.test-agent1.feeds.*']
+shard_args.shard_index = 1
+sharded_agent = create_agent_fixture(AggregatorAgent, {'args': shard_args})
+
 
 class TestRecord:
     def test_aggregator_agent_record_no_data(self, agent, tmpdir):
@@ -51,6 +76,25 @@ class TestRecord:
         assert 'observatory.test-agent1.feeds.test_feed' in session.data['providers']
         assert session.data['providers']['observatory.test-agent1.feeds.test_feed']['stale'] is False
         assert session.data['providers']['observatory.test-agent1.feeds.test_feed']['last_block_received'] == 'temps'
+        assert session.data['incoming_queue']['feeds']['observatory.test-agent1.feeds.test_feed']['high_water'] == 1
+
+    def test_aggregator_agent_record_packed_data(self, agent, tmpdir):
+        agent.data_dir = tmpdir
+        agent.aggregate = True
+
+        session = create_session('record')
+
+        data, feed = generate_data_for_queue()
+        data = {k: pack_block(b['block_name'], b['timestamps'], b['data'])
+                for k, b in data.items()}
+        feed['encoding'] = 'packed'
+        agent._enqueue_incoming_data((data, feed))
+
+        params = {'test_mode': True}
+        res = agent.record(session, params)
+
+        assert res[0] is True
+        assert session.data['providers']['observatory.test-agent1.feeds.test_feed']['last_block_received'] == 'temps'
 
 
 def test_aggregator_agent_enqueue_data_no_aggregate(agent):
@@ -62,12 +106,44 @@ def test_aggregator_agent_enqueue_data_no_aggregate(agent):
     assert agent.incoming_data.empty()
 
 
+class TestShard:
+    def test_aggregator_agent_shard_data_dir(self, sharded_agent):
+        assert sharded_agent.data_dir == '/tmp/data/shard-1'
+
+    def test_aggregator_agent_shard_filters_feeds(self, sharded_agent):
+        sharded_agent.aggregate = True
+
+        data, feed = generate_data_for_queue()
+        sharded_agent._enqueue_incoming_data((data, feed))
+        assert sharded_agent.incoming_data.qsize() == 1
+
+        feed = dict(feed, address='observatory.test-agent2.feeds.test_feed')
+        sharded_agent._enqueue_incoming_data((data, feed))
+        assert sharded_agent.incoming_data.qsize() == 1
+
+    def test_aggregator_agent_shard_record(self, sharded_agent, tmpdir):
+        sharded_agent.data_dir = tmpdir
+        sharded_agent.agent.publish_to_feed = mock.MagicMock()
+
+        session = create_session('record')
+        res = sharded_agent.record(session, {'test_mode': True})
+
+        assert res[0] is True
+        shard = {'name': 'shard-1', 'index': 1, 'count': None,
+                 'patterns': ['observatory.test-agent1.feeds.*']}
+        assert session.data['shard'] == shard
+        sharded_agent.agent.publish_to_feed.assert_called_once_with(
+            'aggregator_shard', shard)
+
+
 class TestStopRecord:
     def test_aggregator_agent_stop_record_while_running(self, agent):
         session = create_session('record')
         agent.aggregate = True
         res = agent._stop_record(session, params=None)
         assert res[0] is True
+        # record process is woken up
+        assert agent.incoming_data.get_nowait() is None
 
     def test_aggregator_agent_stop_record_while_stopping(self, agent):
         session = create_session('record')
@@ -2,6 +2,8 @@ from ocs.agents.influxdb_publisher.agent import InfluxDBAgent
 
 from unittest import mock
 
+import pytest
+
 from agents.util import (
     create_agent_fixture,
     create_session,
@@ -17,6 +19,23 @@ args.port = 8086
 args.database = 'ocs_feeds'
 args.protocol = 'line'
 args.gzip = False
+args.driver = 'v1'
+args.org = None
+args.bucket = None
+args.token = None
+args.writers = 2
+args.max_pending_points = 1000000
+args.spill_dir = None
+args.spill_max_bytes = int(1e9)
+args.max_backoff = 60.
+args.batch_bytes = int(1e6)
+args.max_batch_bytes = int(8e6)
+args.target_latency = 1.
+args.queue_max_messages = 0
+args.queue_max_bytes = 0
+args.queue_policy = 'drop_oldest'
+args.queue_spill_dir = None
+args.queue_spill_max_bytes = int(1e9)
 
 agent = create_agent_fixture(InfluxDBAgent, {'args': args})
 
@@ -49,6 +68,25 @@ class TestRecord:
         res = agent.record(session, params)
 
         assert res[0] is True
+        queue_stats = session.data['incoming_queue']
+        assert queue_stats['depth'] == 0
+        assert queue_stats['feeds']['observatory.test-agent1.feeds.test_feed'] \
+            == {'queued': 0, 'dropped': 0, 'high_water': 1}
+        assert session.data['writer']['written_points'] == 2
+
+
+def test_influxdb_publisher_v2_driver_args(agent):
+    """The v2 driver needs both a token and an organization."""
+    with mock.patch.multiple(agent.args, driver='v2', token='token',
+                             org=None), \
+            mock.patch('ocs.agents.influxdb_publisher.agent.environ', {}):
+        with pytest.raises(ValueError, match='organization'):
+            agent._make_driver()
+        agent.args.org = 'my-org'
+        assert agent._make_driver().org == 'my-org'
+        agent.args.token = None
+        with pytest.raises(ValueError, match='token'):
+            agent._make_driver()
 
 
 def test_influxdb_publisher_enqueue_data_no_aggregate(agent, tmpdir):
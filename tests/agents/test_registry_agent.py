@@ -70,6 +70,28 @@ class TestMain:
         expected_op_codes = {'operation1': 7, 'operation2': 7}
         assert session.data['observatory.test_agent']['op_codes'] == expected_op_codes
 
+    @pytest_twisted.inlineCallbacks
+    def test_registry_main_shard(self, agent):
+        session = create_session('main')
+
+        shard = {'name': 'shard-0', 'index': 0, 'count': 2, 'patterns': None}
+        feed = {"agent_address": "observatory.aggregator-0",
+                "agent_class": "AggregatorAgent",
+                "agg_params": {},
+                "feed_name": "aggregator_shard",
+                "address": "observatory.aggregator-0.feeds.aggregator_shard",
+                "record": False,
+                "session_id": str(time.time())}
+        agent._register_shard([shard, feed])
+
+        params = {'test_mode': True}
+        res = yield agent.main(session, params)
+
+        assert res[0] is True
+        assert session.data['observatory.aggregator-0']['shard'] == shard
+        assert session.data['observatory.aggregator-0']['agent_class'] == \
+            'AggregatorAgent'
+
 
 class TestStopMain:
     @pytest_twisted.inlineCallbacks
@@ -1,13 +1,21 @@
 import os
+import queue
+import threading
 import time
+import numpy as np
 import pytest
 
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import so3g
 from spt3g import core
 
-from ocs.agents.aggregator.drivers import Provider, g3_cast, make_filename
+from ocs.agents.aggregator.drivers import (
+    FILE_EXTENSIONS, Aggregator, G3FileRotator, Provider, ShardAssignment,
+    fill_frame, g3_cast, make_filename, read_file_index)
+from ocs.ocs_feed import compact_timestamps
+
+from agents.util import generate_data_for_queue
 
 
 def test_passing_float_in_provider_to_frame():
@@ -175,6 +183,25 @@ def test_sparsely_sampled_block():
     assert 'test2' in c['block_names']
 
 
+def test_compact_timestamps_in_provider_save_to_block():
+    """Compacted timestamps should be expanded when saved."""
+    provider = Provider('test_provider', 'test_sessid', 3, 1)
+    t0 = time.time()
+    data = {'test': {'block_name': 'test',
+                     'timestamps': compact_timestamps([t0, t0 + 1, t0 + 2]),
+                     'data': {'key1': [1, 2, 3]},
+                     }
+            }
+    compacted = data['test']['timestamps']
+    provider.save_to_block(data)
+
+    assert len(provider.blocks['test'].timestamps) == 3
+    assert abs(provider.blocks['test'].timestamps[2] - (t0 + 2)) < 1e-6
+    assert abs(provider.frame_start_time - t0) < 1e-6
+    # The caller's data is left as it was
+    assert data['test']['timestamps'] is compacted
+
+
 # This is perhaps another problem, I'm passing irregular length data sets and
 # it's not raising any sort of alarm. How does this get handled?
 def test_data_type_in_provider_save_to_block():
@@ -313,6 +340,38 @@ def test_reducing_to_duplicate_field_names():
     assert 'aninvalidkey_01' in provider.blocks['test'].data.keys()
 
 
+def test_field_renames_cached_per_schema():
+    """Renames should be worked out and logged once per block structure,
+    and reused for later data."""
+    provider = Provider('test_provider', 'test_sessid', 3, 1)
+    provider.log = MagicMock()
+
+    def make_data():
+        return {'test': {'block_name': 'test',
+                         'timestamps': [time.time()],
+                         'data': {'an.invalid.key#': [1],
+                                  'an.invalid.key%': [2],
+                                  'valid': [3]},
+                         }
+                }
+
+    for _ in range(3):
+        provider.save_to_block(make_data())
+
+    assert provider.log.error.call_count == 2
+    assert len(provider._field_name_maps) == 1
+    data = provider.blocks['test'].data
+    assert list(data['aninvalidkey']) == [1, 1, 1]
+    assert list(data['aninvalidkey_01']) == [2, 2, 2]
+    assert list(data['valid']) == [3, 3, 3]
+
+    # Valid structures are cached as not needing renames
+    provider.save_to_block({'other': {'block_name': 'other',
+                                      'timestamps': [time.time()],
+                                      'data': {'key': [1]}}})
+    assert provider._field_name_maps[('other', frozenset(['key']))] is None
+
+
 def test_space_replacement_in_field_names():
     """Invalid data field names should get caught by the Feed, however, we
     check for them in the Aggregator as well.
@@ -403,6 +462,50 @@ def test_g3_cast():
             g3_cast(x)
 
 
+def test_g3_cast_arrays():
+    """numpy arrays should be cast straight to G3Vectors, and timestamps
+    should match those from the list path exactly."""
+    correct_tests = [
+        (np.array([1, 2, 3, 4]), core.G3VectorInt),
+        (np.array([1., 2., 3.]), core.G3VectorDouble),
+        (np.array(["a", "b", "c"]), core.G3VectorString),
+        (np.array([True, False]), core.G3VectorBool),
+    ]
+    for x, t in correct_tests:
+        cast = g3_cast(x)
+        assert isinstance(cast, t)
+        assert list(cast) == x.tolist()
+
+    ts = time.time() + np.random.uniform(0, 3600, 100)
+    from_array = g3_cast(ts, time=True)
+    from_list = g3_cast(ts.tolist(), time=True)
+    assert isinstance(from_array, core.G3VectorTime)
+    assert [t.time for t in from_array] == \
+        [core.G3Time(t * core.G3Units.s).time for t in ts]
+    assert [t.time for t in from_list] == [t.time for t in from_array]
+
+    incorrect_tests = [
+        np.zeros((2, 2)), np.array([1 + 1j]), np.array([{'foo': 'bar'}])
+    ]
+    for x in incorrect_tests:
+        with pytest.raises(TypeError):
+            g3_cast(x)
+
+    with pytest.raises(TypeError):
+        g3_cast(np.array(['a']), time=True)
+
+
+def test_g3_cast_uint64_arrays():
+    """uint64 arrays are cast to G3VectorInt if they fit, and rejected
+    rather than wrapped around if they don't."""
+    cast = g3_cast(np.array([0, 2**63 - 1], dtype=np.uint64))
+    assert isinstance(cast, core.G3VectorInt)
+    assert list(cast) == [0, 2**63 - 1]
+
+    with pytest.raises(OverflowError):
+        g3_cast(np.array([1, 2**63], dtype=np.uint64))
+
+
 def test_make_filename_directory_creation(tmpdir):
     """make_filename() should be able to create directories to store the .g3
     files in.
@@ -436,3 +539,529 @@ def test_make_filename_directory_creation_permissions(tmpdir):
     with pytest.raises(PermissionError) as e_info:
         make_filename(test_dir)
     assert str(e_info.value) == 'mocked permission error'
+
+
+def test_aggregator_pipeline_writes_frames(tmpdir):
+    """Frames queued by the Aggregator should be built and written by the
+    pipeline threads, and all be on disk once it is closed.
+
+    """
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir))
+
+    data, feed = generate_data_for_queue()
+    incoming.put((data, feed))
+    agg.run()
+    agg.close()
+
+    status = agg.pipeline_status()
+    assert status['ingest']['count'] == 1
+    assert status['build']['count'] == 1
+    assert status['build']['queue_depth'] == 0
+    assert status['write']['queue_depth'] == 0
+
+    frames = list(core.G3File(agg.writer.current_file))
+    data_frames = [f for f in frames if 'block_names' in f]
+    assert len(data_frames) == 1
+    assert list(data_frames[0]['block_names']) == ['temps']
+    # Status and data frames all make it to disk
+    assert status['write']['count'] == len(frames) - 1
+
+    # Closing twice is harmless
+    agg.close()
+
+
+def test_provider_frame_data_survives_clear():
+    """Block data handed off for frame building should not be affected by
+    the provider clearing its blocks."""
+    provider = Provider('test_provider', 'test_sessid', 3, 1)
+    provider.save_to_block({'test': {'block_name': 'test',
+                                     'timestamps': [time.time()],
+                                     'data': {'key1': [1.]}}})
+
+    sess = so3g.hk.HKSessionHelper(description="testing")
+    sess.start_time = time.time()
+    sess.session_id = 'test_sessid'
+
+    frame, blocks = provider.frame_data(hksess=sess, clear=True)
+    assert provider.empty()
+    assert blocks[0][0] == 'test'
+    assert list(blocks[0][2]['key1']) == [1.]
+
+    frame = fill_frame(frame, blocks)
+    assert list(frame['block_names']) == ['test']
+
+
+def test_aggregator_run_waits_for_data(tmpdir):
+    """run() should return as soon as data arrives, rather than waiting out
+    its timeout, and drain everything queued."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir))
+
+    data, feed = generate_data_for_queue()
+    threading.Timer(0.1, incoming.put, args=((data, feed),)).start()
+
+    t0 = time.time()
+    agg.run(timeout=10)
+    assert time.time() - t0 < 5
+    assert len(agg.providers) == 1
+    agg.close()
+
+
+def test_aggregator_run_wakes_on_deadline(tmpdir):
+    """With no timeout, run() should wait no longer than the next provider
+    deadline, and should wake up immediately on a None in the queue."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir))
+    assert agg.next_deadline() is None
+
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['frame_length'] = 0.2
+    incoming.put((data, feed))
+    agg.run()
+
+    prov = list(agg.providers.values())[0]
+    assert agg.next_deadline() == prov.frame_start_time + 0.2
+
+    agg.run(timeout=None)
+    assert prov.empty()
+
+    incoming.put(None)
+    agg.run(timeout=None)
+    agg.close()
+
+
+def test_aggregator_deadline_schedule(tmpdir):
+    """Providers should be checked when their deadlines come due, with the
+    scheduling lag reported in session.data."""
+    incoming = queue.Queue()
+    session = MagicMock()
+    agg = Aggregator(incoming, 3600, str(tmpdir), session=session)
+
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['fresh_time'] = 0.2
+    incoming.put((data, feed))
+    agg.run()
+    prov = list(agg.providers.values())[0]
+
+    # New data with a later frame deadline keeps the earlier entry
+    frame_deadline = prov.frame_start_time + prov.frame_length
+    assert agg.next_deadline() <= prov.last_refresh + 0.2
+    assert agg.next_deadline() < frame_deadline
+
+    # Waits for the stale deadline, and removes the provider
+    t0 = time.time()
+    while agg.providers and time.time() - t0 < 5:
+        agg.run(timeout=None)
+    assert time.time() - t0 < 5
+    assert agg.providers == {}
+    assert agg.next_deadline() is None
+
+    sched = session.data['scheduling']
+    assert sched['last_lag'] >= 0
+    assert sched['max_lag'] >= sched['last_lag']
+    assert sched['scheduled'] == 0
+    agg.close()
+
+
+def test_aggregator_reschedules_refreshed_provider(tmpdir):
+    """A provider that is refreshed before its stale deadline should be
+    rescheduled, not removed, when the old deadline passes."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir))
+
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['fresh_time'] = 0.3
+    incoming.put((data, feed))
+    agg.run()
+    prov = list(agg.providers.values())[0]
+    first_deadline = agg.next_deadline()
+
+    time.sleep(0.1)
+    prov.refresh()
+    agg.run(timeout=None)
+
+    assert prov.prov_id in agg.providers
+    assert agg.next_deadline() == prov.last_refresh + 0.3
+    assert agg.next_deadline() > first_deadline
+    agg.close()
+
+
+def test_make_filename_align_and_collision(tmpdir):
+    """Aligned filenames should be named by the start of the period, and
+    existing files should never be overwritten."""
+    test_dir = os.path.join(tmpdir, 'data')
+    fname = make_filename(test_dir, align=3600)
+    start = int(os.path.basename(fname)[:-3])
+    assert start % 3600 == 0
+    assert time.time() - start < 3600
+
+    open(fname, 'w').close()
+    fname2 = make_filename(test_dir, align=3600)
+    assert fname2 == fname[:-3] + '_1.g3'
+
+
+def _hk_frames(n_data):
+    sess = so3g.hk.HKSessionHelper(description="testing")
+    sess.start_time = time.time()
+    sess.session_id = 'test_sessid'
+    prov_id = sess.add_provider('test_provider')
+
+    frames = [sess.session_frame(), sess.status_frame()]
+    for i in range(n_data):
+        provider = Provider('test_provider', 'test_sessid', prov_id, 1)
+        provider.save_to_block({'test': {'block_name': 'test',
+                                         'timestamps': [time.time()],
+                                         'data': {'key1': [float(i)]}}})
+        frames.append(provider.to_frame(hksess=sess))
+    return frames
+
+
+def _rotated_files(tmpdir, **kwargs):
+    files = []
+
+    def filename():
+        files.append(os.path.join(tmpdir, '%i.g3' % len(files)))
+        return files[-1]
+
+    rotator = G3FileRotator(3600, filename, **kwargs)
+    rotator.Process(_hk_frames(6))
+    rotator.close_file()
+    return rotator, [list(core.G3File(f)) for f in files]
+
+
+def test_file_rotator_max_frames(tmpdir):
+    """Files should be rotated once they hold max_frames, with the session
+    and status frames written at the start of each new file."""
+    _, files = _rotated_files(tmpdir, max_frames=4)
+    types = [[f['hkagg_type'] for f in frames] for frames in files]
+    s, st, d = (so3g.HKFrameType.session, so3g.HKFrameType.status,
+                so3g.HKFrameType.data)
+    assert types == [[s, st, d, d], [s, st, d, d], [s, st, d, d]]
+
+
+def test_file_rotator_max_bytes(tmpdir):
+    """Files should be rotated once they reach max_bytes, and the byte count
+    should match the file size on disk."""
+    rotator, files = _rotated_files(tmpdir, max_bytes=1)
+    # Every frame fills a file, so each data frame gets its own file
+    assert len(files) == 8
+    for frames in files[2:]:
+        assert len(frames) == 3
+        assert frames[-1]['hkagg_type'] == so3g.HKFrameType.data
+    assert rotator.file_bytes == os.path.getsize(rotator.current_file)
+
+
+def test_file_rotator_align(tmpdir):
+    """Aligned rotation should happen on the next multiple of time_per_file,
+    and rotate before writing a frame that arrives after it."""
+    files = []
+
+    def filename():
+        files.append(os.path.join(tmpdir, '%i.g3' % len(files)))
+        return files[-1]
+
+    rotator = G3FileRotator(3600, filename, align=True)
+    frames = _hk_frames(2)
+    rotator.Process(frames[:3])
+    assert rotator.rotate_time % 3600 == 0
+    assert 0 < rotator.rotate_time - time.time() <= 3600
+
+    rotator.rotate_time = time.time() - 1
+    rotator.Process(frames[3:])
+    rotator.close_file()
+    assert len(files) == 2
+    assert len(list(core.G3File(files[1]))) == 3
+
+
+def _written_aggregator(tmpdir, **kwargs):
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir), **kwargs)
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['frame_length'] = 0
+    incoming.put((data, feed))
+    agg.run()
+    return agg
+
+
+@pytest.mark.parametrize('durability', ['none', 'flush', 'fsync'])
+def test_aggregator_durability(tmpdir, durability):
+    """All durability modes should get data on disk by close, but only
+    'flush' and 'fsync' flush while running."""
+    agg = _written_aggregator(tmpdir, durability=durability)
+    # Wait for the writer to catch up
+    t0 = time.time()
+    while agg.stats['write'].count < 2 and time.time() - t0 < 5:
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+    if durability == 'none':
+        assert agg.stats['flush'].count == 0
+    else:
+        assert agg.stats['flush'].count >= 1
+        assert agg.writer.unflushed_bytes == 0
+    agg.close()
+    assert len(list(core.G3File(agg.writer.current_file))) == 3
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_rotator_flush_readable(tmpdir, compression):
+    """Flushed frames should be readable from an open file. Compressed files
+    can't be flushed, but flushing shouldn't break them."""
+    filename = os.path.join(str(tmpdir), 'test' + FILE_EXTENSIONS[compression])
+    rotator = G3FileRotator(3600, lambda: filename, fsync=True)
+    rotator.Process(_hk_frames(3))
+    rotator.flush()
+    assert rotator.unflushed_bytes == 0
+    if compression is None:
+        assert len(list(core.G3File(filename))) == 5
+    rotator.close_file()
+    assert len(list(core.G3File(filename))) == 5
+
+
+def test_aggregator_compression_durability(tmpdir):
+    """Compressed files are only written out on close."""
+    agg = _written_aggregator(tmpdir, compression='gzip', durability='fsync')
+    assert agg.durability == 'none'
+    agg.close()
+    assert len(list(core.G3File(agg.writer.current_file))) == 3
+
+
+def test_aggregator_flush_interval(tmpdir):
+    """With a flush interval, the writer should not flush straight away,
+    but should flush on its own once the interval has passed."""
+    agg = _written_aggregator(tmpdir, flush_interval=0.3)
+    time.sleep(0.1)
+    assert agg.stats['flush'].count == 0
+    assert agg.writer.unflushed_bytes > 0
+
+    t0 = time.time()
+    while agg.stats['flush'].count == 0 and time.time() - t0 < 5:
+        time.sleep(0.01)
+    assert agg.stats['flush'].count == 1
+    assert agg.writer.unflushed_bytes == 0
+    agg.close()
+
+
+def test_aggregator_invalid_durability(tmpdir):
+    with pytest.raises(ValueError):
+        Aggregator(queue.Queue(), 3600, str(tmpdir), durability='maybe')
+
+
+def test_file_index(tmpdir):
+    """The file index should give the offset and size of each data frame,
+    and a summary of the fields and time spans once the file is closed."""
+    files = []
+
+    def filename():
+        files.append(os.path.join(tmpdir, '%i.g3' % len(files)))
+        return files[-1]
+
+    rotator = G3FileRotator(3600, filename, index=True)
+    frames = _hk_frames(3)
+    rotator.Process(frames)
+    rotator.flush()
+
+    # Index is readable while the file is still being written
+    index, summary = read_file_index(files[0])
+    assert len(index) == 3
+    assert summary is None
+
+    rotator.close_file()
+    index, summary = read_file_index(files[0] + '.idx')
+    assert summary['frames'] == 3
+
+    prov = summary['providers']['test_provider']
+    block = prov['blocks']['test']
+    assert block['fields'] == ['key1']
+    assert block['start'] <= block['end']
+
+    # Offsets point straight at the data frames
+    with open(files[0], 'rb') as f:
+        raw = f.read()
+    for record, frame in zip(index, frames[2:]):
+        assert record['address'] == 'test_provider'
+        assert record['blocks'][0]['name'] == 'test'
+        chunk = raw[record['offset']:record['offset'] + record['size']]
+        assert chunk == frame.__getstate__()[1]
+
+
+def test_aggregator_writes_file_index(tmpdir):
+    agg = _written_aggregator(tmpdir)
+    agg.close()
+    index, summary = read_file_index(agg.writer.current_file)
+    assert len(index) == 1
+    assert 'observatory.test-agent1.feeds.test_feed' in summary['providers']
+
+    agg = _written_aggregator(tmpdir.mkdir('noindex'), file_index=False)
+    agg.close()
+    assert not os.path.exists(agg.writer.current_file + '.idx')
+
+
+def test_aggregator_journal_replay(tmpdir):
+    """Data that hadn't been written to a frame when the aggregator died
+    should be replayed from the journal by the next Aggregator."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir), journal=True)
+    data, feed = generate_data_for_queue()
+    incoming.put((data, feed))
+    agg.run()
+    agg._sync_journal()
+    assert not list(agg.providers.values())[0].empty()
+    # Aggregator dies without close()
+
+    agg2 = Aggregator(queue.Queue(), 3600, str(tmpdir), journal=True)
+    prov = list(agg2.providers.values())[0]
+    assert prov.address == feed['address']
+    assert list(prov.blocks['temps'].data['field_0']) == [1, 2]
+
+    agg2.close()
+    frames = list(core.G3File(agg2.writer.current_file))
+    assert [f for f in frames if 'block_names' in f]
+    # Clean close leaves no journal behind
+    assert os.listdir(os.path.join(tmpdir, '.journal')) == []
+
+
+def test_aggregator_journal_checkpoint(tmpdir):
+    """Data already written to disk shouldn't be replayed, and fully
+    checkpointed journal segments should be removed."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir), journal=True)
+    agg.journal.segment_time = 0
+
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['frame_length'] = 0
+    incoming.put((data, feed))
+    agg.run()
+
+    # Wait for the writer to flush the frame
+    t0 = time.time()
+    while not agg._written and time.time() - t0 < 5:
+        time.sleep(0.01)
+    agg._sync_journal()
+    # Journal moves on to a new segment, and the old one is removed
+    agg._sync_journal()
+    assert len(os.listdir(os.path.join(tmpdir, '.journal'))) == 1
+
+    agg2 = Aggregator(queue.Queue(), 3600, str(tmpdir), journal=True)
+    assert agg2.providers == {}
+    agg2.close()
+
+
+def test_aggregator_journal_compact_timestamps(tmpdir):
+    """Journaled messages should be left as they were received, so feeds
+    with compacted timestamps can be journaled."""
+    incoming = queue.Queue()
+    agg = Aggregator(incoming, 3600, str(tmpdir), journal=True)
+    data, feed = generate_data_for_queue()
+    data['temps']['timestamps'] = compact_timestamps(
+        data['temps']['timestamps'])
+    incoming.put((data, feed))
+    agg.run()
+    agg._sync_journal()
+    assert agg._stage_error is None
+    agg.run()
+
+    # Replays like any other message
+    agg2 = Aggregator(queue.Queue(), 3600, str(tmpdir), journal=True)
+    prov = list(agg2.providers.values())[0]
+    assert len(prov.blocks['temps'].timestamps) == 2
+    agg2.close()
+
+
+def test_aggregator_journal_durability_none(tmpdir):
+    """With durability 'none', frames aren't checkpointed in the journal
+    until their file is closed."""
+    agg = _written_aggregator(tmpdir, journal=True, durability='none')
+    t0 = time.time()
+    while agg.stats['write'].count < 2 and time.time() - t0 < 5:
+        time.sleep(0.01)
+    agg._sync_journal()
+    assert not agg._written
+    assert agg._pending_written
+
+    agg.writer.rotate_time = 0
+    data, feed = generate_data_for_queue()
+    feed['agg_params']['frame_length'] = 0
+    agg.incoming_data.put((data, feed))
+    agg.run()
+    # The first frame's file is closed, the second's isn't
+    t0 = time.time()
+    while len(agg._pending_written) != 1 and time.time() - t0 < 5:
+        time.sleep(0.01)
+    assert len(agg._pending_written) == 1
+    agg.close()
+
+
+def test_aggregator_no_journal(tmpdir):
+    """The journal is off by default."""
+    agg = _written_aggregator(tmpdir)
+    agg.close()
+    assert not os.path.exists(os.path.join(tmpdir, '.journal'))
+
+
+def test_aggregator_journal_thread(tmpdir):
+    """The journal is written by its own thread, not the ingest thread."""
+    agg = _written_aggregator(tmpdir, journal=True)
+    agg._sync_journal()
+    appended = []
+    append = agg.journal.append
+
+    def record_thread(*args):
+        appended.append(threading.current_thread().name)
+        return append(*args)
+
+    agg.journal.append = record_thread
+    data, feed = generate_data_for_queue()
+    agg.incoming_data.put((data, feed))
+    agg.run()
+    agg._sync_journal()
+    assert appended == ['agg-journal']
+    assert agg.pipeline_status()['journal']['count'] == 2
+    agg.close()
+
+
+@pytest.mark.parametrize('compression,ext', [(None, '.g3'),
+                                             ('gzip', '.g3.gz'),
+                                             ('bz2', '.g3.bz2')])
+def test_aggregator_compression(tmpdir, compression, ext):
+    """Compressed files should get a matching extension and be readable."""
+    assert make_filename(str(tmpdir), compression=compression).endswith(ext)
+
+    agg = _written_aggregator(tmpdir, compression=compression)
+    agg.close()
+    assert agg.writer.current_file.endswith(ext)
+    frames = list(core.G3File(agg.writer.current_file))
+    assert len([f for f in frames if 'block_names' in f]) == 1
+
+
+def test_aggregator_invalid_compression(tmpdir):
+    with pytest.raises(ValueError):
+        make_filename(str(tmpdir), compression='lzma')
+    with pytest.raises(ValueError):
+        Aggregator(queue.Queue(), 3600, str(tmpdir), compression='lzma')
+
+
+def test_shard_assignment_hash():
+    """Each address should belong to exactly one of the hash shards."""
+    shards = [ShardAssignment(i, count=3) for i in range(3)]
+    addresses = ['observatory.agent%i.feeds.temps' % i for i in range(30)]
+    for addr in addresses:
+        assert sum(s.accepts(addr) for s in shards) == 1
+    # Deterministic, so a restarted instance takes the same providers
+    again = ShardAssignment(1, count=3)
+    assert ([again.accepts(a) for a in addresses]
+            == [shards[1].accepts(a) for a in addresses])
+
+
+def test_shard_assignment_patterns():
+    shard = ShardAssignment(0, patterns=['observatory.LS*.feeds.*'])
+    assert shard.accepts('observatory.LS240.feeds.temperatures')
+    assert not shard.accepts('observatory.bluefors.feeds.bluefors')
+    assert shard.encoded() == {'name': 'shard-0', 'index': 0, 'count': None,
+                               'patterns': ['observatory.LS*.feeds.*']}
+
+
+def test_shard_assignment_invalid_index():
+    with pytest.raises(ValueError):
+        ShardAssignment(3, count=3)
@@ -1,6 +1,21 @@
+import os
+import queue
+import time
+from unittest.mock import MagicMock
+
+import numpy as np
 import pytest
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout as RequestsTimeout
+
+from ocs.agents.influxdb_publisher import drivers
+from ocs.agents.influxdb_publisher.drivers import (
+    Downsampler, InfluxDBV1Driver, InfluxDBV2Driver, Publisher, WritePipeline,
+    format_lines, points_bytes, timestamp2influxtime)
+from ocs.ocs_feed import compact_timestamps, expand_timestamps
 
-from ocs.agents.influxdb_publisher.drivers import Publisher, timestamp2influxtime
+from util import InfluxDBStandIn
 
 
 @pytest.mark.parametrize("t,protocol,expected",
@@ -27,3 +42,470 @@ def test_format_data():
 
     expected = 'test_address,feed=test_feed key1=1i,key2=2.3,key3="test" 1615394417359038720'
     assert Publisher.format_data(data, feed, 'line')[0] == expected
+
+
+def test_format_data_compact_timestamps():
+    """Compacted timestamps should be expanded when formatting."""
+    feed = {'agent_address': 'test_address',
+            'feed_name': 'test_feed'}
+    data = {'test': {'block_name': 'test',
+                     'timestamps': compact_timestamps([1615394417., 1615394418.]),
+                     'data': {'key1': [1, 2]},
+                     }
+            }
+
+    lines = Publisher.format_data(data, feed, 'line')
+    assert lines == ['test_address,feed=test_feed key1=1i 1615394417000000000',
+                     'test_address,feed=test_feed key1=2i 1615394418000000000']
+
+
+def _format_points(data, feed):
+    """Line protocol formatted one point at a time, as format_data used to."""
+    lines = []
+    for block in data.values():
+        for i, t in enumerate(expand_timestamps(block['timestamps'])):
+            fields = ','.join(Publisher._format_field_line(k, v[i])
+                              for k, v in block['data'].items())
+            lines.append(f"{drivers._escape_measurement(feed['agent_address'])},"
+                         f"feed={drivers._escape_tag(feed['feed_name'])} "
+                         f"{fields} {timestamp2influxtime(t, 'line')}")
+    return lines
+
+
+def test_format_lines_matches_points():
+    """The columnar formatter should give the same lines as formatting each
+    point, for every type of field."""
+    feed = {'agent_address': 'observatory.test-agent1',
+            'feed_name': 'test_feed'}
+    t = 1615394417.3590388 + np.arange(50) * 0.01
+    data = {'a': {'block_name': 'a',
+                  'timestamps': t.tolist(),
+                  'data': {'floats': np.random.normal(size=50).tolist(),
+                           'ints': list(range(50)),
+                           'bools': [True, False] * 25,
+                           'strs': ['s%d' % i for i in range(50)],
+                           'mixed': [1, 2.5] * 25}},
+            'b': {'block_name': 'b',
+                  'timestamps': compact_timestamps(t),
+                  'data': {'key1': [1e20, 1e-7] * 25}}}
+
+    assert format_lines(data, feed) == _format_points(data, feed)
+
+
+def test_format_lines_arrays():
+    """Numpy columns should be formatted like lists."""
+    feed = {'agent_address': 'test_address',
+            'feed_name': 'test_feed'}
+    data = {'test': {'block_name': 'test',
+                     'timestamps': np.array([1615394417.3590388]),
+                     'data': {'key1': np.array([1]),
+                              'key2': np.array([2.3]),
+                              'key3': np.array([True])}}}
+
+    assert format_lines(data, feed) == \
+        ['test_address,feed=test_feed key1=1i,key2=2.3,key3=True '
+         '1615394417359038720']
+
+
+def test_format_lines_escaping():
+    """Measurement, tag, field keys and string values should be escaped."""
+    feed = {'agent_address': 'observatory.my agent,1',
+            'feed_name': 'feed=1 %s'}
+    data = {'test': {'block_name': 'test',
+                     'timestamps': [1615394417.3590388],
+                     'data': {'key 1,a=b': [1.5],
+                              'key2': ['say "hi" \\ 100%']}}}
+
+    expected = (r'observatory.my\ agent\,1,feed=feed\=1\ %s '
+                r'key\ 1\,a\=b=1.5,key2="say \"hi\" \\ 100%" '
+                '1615394417359038720')
+    assert format_lines(data, feed) == [expected]
+    assert _format_points(data, feed) == [expected]
+
+
+def test_format_lines_template_cache():
+    """Templates should be made once per feed and field set."""
+    drivers._LINE_TEMPLATES.clear()
+    feed = {'agent_address': 'test_address',
+            'feed_name': 'test_feed'}
+    for i in range(3):
+        format_lines({'test': {'block_name': 'test', 'timestamps': [i],
+                               'data': {'key1': [i], 'key2': [0.5]}}}, feed)
+    assert len(drivers._LINE_TEMPLATES) == 1
+
+    # A new field set, or new field types, need a new template
+    format_lines({'test': {'block_name': 'test', 'timestamps': [0],
+                           'data': {'key1': [1]}}}, feed)
+    format_lines({'test': {'block_name': 'test', 'timestamps': [0],
+                           'data': {'key1': [1.], 'key2': [0.5]}}}, feed)
+    assert len(drivers._LINE_TEMPLATES) == 3
+
+
+class _FakeClient:
+    """Stands in for InfluxDBClient, failing the first ``failures`` writes
+    with ``error``."""
+
+    def __init__(self, written, failures=0, error=RequestsConnectionError):
+        self.written = written
+        self.failures = failures
+        self.error = error
+
+    def write_points(self, points, protocol):
+        if self.failures:
+            self.failures -= 1
+            raise self.error("unavailable")
+        self.written.extend(points)
+
+
+def _chunks(n, size=10):
+    return [['line%d_%d' % (i, j) for j in range(size)] for i in range(n)]
+
+
+def test_write_pipeline():
+    written = []
+    writer = WritePipeline(lambda: _FakeClient(written), n_writers=3)
+    for chunk in _chunks(20):
+        writer.submit(chunk)
+    writer.close()
+
+    assert sorted(written) == sorted(sum(_chunks(20), []))
+    assert writer.status()['written_points'] == 200
+
+
+def test_write_pipeline_retry():
+    """Failed writes should be retried, with backoff, until they succeed."""
+    written = []
+    client = _FakeClient(written, failures=3)
+    writer = WritePipeline(lambda: client, n_writers=1, min_backoff=0.01)
+    chunks = _chunks(3)
+    for chunk in chunks:
+        writer.submit(chunk)
+    writer.close()
+
+    assert written == sum(chunks, [])
+    status = writer.status()
+    assert status['failed_requests'] == 3
+    assert status['dropped_points'] == 0
+    assert status['backoff'] == 0
+
+
+def test_write_pipeline_client_error():
+    """Points rejected by InfluxDB are dropped, not retried."""
+    written = []
+    client = _FakeClient(written, failures=1, error=InfluxDBClientError)
+    writer = WritePipeline(lambda: client, n_writers=1)
+    for chunk in _chunks(2):
+        writer.submit(chunk)
+    writer.close()
+
+    assert written == _chunks(2)[1]
+    assert writer.status()['dropped_points'] == 10
+
+
+def test_write_pipeline_unexpected_error():
+    """An unexpected error drops the chunk, but not the writer."""
+    written = []
+    client = _FakeClient(written, failures=1, error=ValueError)
+    writer = WritePipeline(lambda: client, n_writers=1)
+    for chunk in _chunks(2):
+        writer.submit(chunk)
+    t0 = time.time()
+    writer.close()
+
+    assert time.time() - t0 < 5
+    assert written == _chunks(2)[1]
+    status = writer.status()
+    assert status['dropped_points'] == 10
+    assert status['pending_chunks'] == 0
+
+
+def test_write_pipeline_drop_oldest():
+    written = []
+    client = _FakeClient(written, failures=1000)
+    writer = WritePipeline(lambda: client, n_writers=1,
+                           max_pending_points=30, min_backoff=10)
+    for chunk in _chunks(5):
+        writer.submit(chunk)
+    writer.close(timeout=0)
+
+    assert writer.dropped_points == 50
+    assert written == []
+
+
+def test_write_pipeline_spill(tmpdir):
+    """Chunks beyond max_pending_points, or not written when the pipeline is
+    closed, should be spilled and written in order by the next pipeline."""
+    down = _FakeClient([], failures=1000)
+    writer = WritePipeline(lambda: down, n_writers=1, max_pending_points=20,
+                           spill_dir=str(tmpdir), min_backoff=10)
+    chunks = _chunks(5)
+    for chunk in chunks:
+        writer.submit(chunk)
+    assert writer.status()['spilled_chunks'] >= 3
+    writer.close(timeout=0)
+    assert writer.dropped_points == 0
+
+    written = []
+    writer = WritePipeline(lambda: _FakeClient(written), n_writers=1,
+                           spill_dir=str(tmpdir))
+    writer.close()
+    assert sorted(written) == sorted(sum(chunks, []))
+    assert os.listdir(str(tmpdir)) == []
+
+
+class _SlowClient(_FakeClient):
+    """Takes ``latency`` seconds per write, and rejects requests of more
+    than ``max_points`` points as too large, or with ``error`` if set."""
+
+    def __init__(self, written, latency=0., max_points=None, error=None):
+        super().__init__(written)
+        self.latency = latency
+        self.max_points = max_points
+        self.error = error
+        self.requests = []
+
+    def write_points(self, points, protocol):
+        self.requests.append(len(points))
+        if self.max_points is not None and len(points) > self.max_points:
+            if self.error is not None:
+                raise self.error("Timed out")
+            raise InfluxDBClientError("Request Entity Too Large", code=413)
+        time.sleep(self.latency)
+        super().write_points(points, protocol)
+
+
+def test_write_pipeline_adapts_batch_bytes():
+    """The batch size should grow while requests are fast, and shrink when
+    they're slow."""
+    fast = _SlowClient([])
+    writer = WritePipeline(lambda: fast, n_writers=1, batch_bytes=1000,
+                           max_batch_bytes=2000, target_latency=0.1)
+    for chunk in _chunks(10):
+        writer.submit(chunk)
+    writer.close()
+    assert writer.batch_bytes == 2000
+
+    slow = _SlowClient([], latency=0.02)
+    writer = WritePipeline(lambda: slow, n_writers=1, batch_bytes=1000,
+                           min_batch_bytes=100, target_latency=0.01)
+    for chunk in _chunks(3):
+        writer.submit(chunk)
+    writer.close()
+    assert writer.batch_bytes == 125
+
+    status = writer.status()
+    assert status['latency']['counts'][1] == 3
+    assert status['latency']['max'] >= 0.02
+    assert status['points_per_sec'] == 30 / WritePipeline.RATE_WINDOW
+    assert status['bytes_per_sec'] == \
+        points_bytes(sum(_chunks(3), [])) / WritePipeline.RATE_WINDOW
+
+
+def test_write_pipeline_split_too_large():
+    """Requests rejected as too large should be split until they fit."""
+    written = []
+    client = _SlowClient(written, max_points=3)
+    writer = WritePipeline(lambda: client, n_writers=1)
+    writer.submit(_chunks(1)[0])
+    writer.close()
+
+    assert written == _chunks(1)[0]
+    assert client.requests == [10, 5, 2, 3, 5, 2, 3]
+    assert writer.dropped_points == 0
+
+
+def test_write_pipeline_split_timeout():
+    """Chunks that time out should be split until they can be written."""
+    written = []
+    client = _SlowClient(written, max_points=3, error=RequestsTimeout)
+    writer = WritePipeline(lambda: client, n_writers=1, min_backoff=0.001,
+                           max_backoff=0.001)
+    writer.submit(_chunks(1)[0])
+    writer.close()
+
+    assert written == _chunks(1)[0]
+    assert client.requests == [10, 5, 2, 3, 5, 2, 3]
+    assert writer.dropped_points == 0
+
+
+def test_process_incoming_data_batches():
+    """Points should be passed to the writer in batches of about
+    batch_bytes as the queue is drained."""
+    with InfluxDBStandIn() as server:
+        publisher = Publisher('127.0.0.1', 'ocs_feeds', queue.Queue(),
+                              port=server.port)
+    publisher.writer.close()
+    publisher.writer = MagicMock()
+    publisher.writer.batch_bytes = 1000
+
+    feed = {'agent_address': 'test_address', 'feed_name': 'test_feed',
+            'agg_params': {}, 'address': 'test_address.feeds.test_feed'}
+    for i in range(10):
+        data = {'test': {'block_name': 'test',
+                         'timestamps': [1615394417. + i],
+                         'data': {'key1': [1.] * 1, 'key2': ['x' * 200]}}}
+        publisher.incoming_data.put((data, feed))
+    publisher.process_incoming_data()
+
+    batches = [c.args[0] for c in publisher.writer.submit.call_args_list]
+    assert sum(len(b) for b in batches) == 10
+    assert len(batches) > 2
+    assert all(points_bytes(b[:-1]) < 1000 for b in batches)
+
+
+def _lines(n):
+    return ['test_address,feed=test_feed key1=%di %d' % (i, 1615394417000000000 + i)
+            for i in range(n)]
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_v2_driver(compress):
+    """The v2 driver should stream the body in chunks, compressed if asked,
+    and authenticate with the token."""
+    with InfluxDBStandIn() as server:
+        driver = InfluxDBV2Driver('127.0.0.1', 'obs', 'ocs_feeds', 'secret',
+                                  port=server.port, gzip=compress,
+                                  chunk_bytes=1000)
+        driver.setup()
+        client = driver.connect()
+        lines = _lines(500)
+        client.write_points(lines)
+
+    assert server.request_count == 1
+    assert server.lines() == lines
+    path, params, headers, body = server.requests[0]
+    assert path == '/api/v2/write'
+    assert params == {'org': 'obs', 'bucket': 'ocs_feeds', 'precision': 'ns'}
+    assert headers['Authorization'] == 'Token secret'
+    assert headers['Transfer-Encoding'] == 'chunked'
+    if compress:
+        assert headers['Content-Encoding'] == 'gzip'
+        assert server.bytes_received < len(body) / 4
+    else:
+        assert server.bytes_received == len(body)
+
+
+@pytest.mark.parametrize('status,error', [(413, InfluxDBClientError),
+                                          (400, InfluxDBClientError),
+                                          (503, InfluxDBServerError),
+                                          (429, InfluxDBServerError)])
+def test_v2_driver_errors(status, error):
+    with InfluxDBStandIn() as server:
+        server.statuses = [status]
+        client = InfluxDBV2Driver('127.0.0.1', 'obs', 'ocs_feeds', 'secret',
+                                  port=server.port).connect()
+        with pytest.raises(error):
+            client.write_points(_lines(1))
+        assert client.write_points(_lines(1))
+
+
+@pytest.mark.parametrize('driver', ['v1', 'v2'])
+def test_publisher_drivers(driver):
+    """The Publisher should write through either driver, retrying requests
+    the server fails."""
+    with InfluxDBStandIn() as server:
+        server.statuses = [503]
+        if driver == 'v2':
+            driver = InfluxDBV2Driver('127.0.0.1', 'obs', 'ocs_feeds',
+                                      'secret', port=server.port)
+        else:
+            driver = InfluxDBV1Driver('127.0.0.1', 'ocs_feeds',
+                                      port=server.port)
+        incoming = queue.Queue()
+        publisher = Publisher('127.0.0.1', 'ocs_feeds', incoming,
+                              port=server.port, driver=driver)
+        publisher.writer.min_backoff = 0.01
+
+        feed = {'agent_address': 'test_address', 'feed_name': 'test_feed',
+                'agg_params': {}, 'address': 'test_address.feeds.test_feed'}
+        data = {'test': {'block_name': 'test',
+                         'timestamps': [1615394417., 1615394418.],
+                         'data': {'key1': [1, 2]}}}
+        incoming.put((data, feed))
+        publisher.run()
+        publisher.close()
+
+    assert server.lines() == format_lines(data, feed)
+    assert server.request_count == 2
+    assert publisher.writer.failed_requests == 1
+
+
+def test_v2_driver_json():
+    driver = InfluxDBV2Driver('127.0.0.1', 'obs', 'ocs_feeds', 'secret')
+    with pytest.raises(ValueError):
+        Publisher('127.0.0.1', 'ocs_feeds', queue.Queue(), protocol='json',
+                  driver=driver)
+
+
+def _downsample_feed(**agg_params):
+    return {'agent_address': 'test_address', 'feed_name': 'test_feed',
+            'address': 'test_address.feeds.test_feed',
+            'agg_params': dict(influx_downsample=1., **agg_params)}
+
+
+def test_downsampler():
+    """Stats should be computed over whole windows, even when the windows
+    span several messages."""
+    feed = _downsample_feed()
+    t = 1615394400. + np.arange(40) * 0.1
+    x = np.random.normal(size=40)
+    n = np.arange(40)
+    downsampler = Downsampler()
+
+    out = []
+    # Messages of 0.7 s, so not aligned to the windows
+    for i in range(0, 40, 7):
+        data = {'test': {'block_name': 'test',
+                         'timestamps': t[i:i + 7].tolist(),
+                         'data': {'x': x[i:i + 7].tolist(),
+                                  'n': n[i:i + 7].tolist(),
+                                  's': ['s%d' % j for j in n[i:i + 7]]}}}
+        out.extend(downsampler.process(data, feed).values())
+    # The last window is held back until it's over
+    assert downsampler.flush(t[-1] + 1) == []
+    out.extend(d['test'] for d, _ in downsampler.flush(t[-1] + 2))
+
+    assert sum((b['timestamps'] for b in out), []) == \
+        [1615394400., 1615394401., 1615394402., 1615394403.]
+    for key, stat in [('x_min', np.min), ('x_mean', np.mean),
+                      ('x_max', np.max), ('n_last', lambda v: v[-1])]:
+        values = sum((b['data'][key] for b in out), [])
+        v = x if key[0] == 'x' else n
+        assert values == pytest.approx([stat(v[i:i + 10])
+                                        for i in range(0, 40, 10)])
+    assert sum((b['data']['s_last'] for b in out), []) == \
+        ['s9', 's19', 's29', 's39']
+    assert 's_min' not in out[0]['data']
+    assert isinstance(out[0]['data']['n_max'][0], int)
+
+
+def test_downsampler_stats():
+    feed = _downsample_feed(influx_stats=['mean'])
+    data = {'test': {'block_name': 'test',
+                     'timestamps': [1615394400.2, 1615394400.7, 1615394401.1],
+                     'data': {'x': [1., 2., 5.]}}}
+    out = Downsampler().process(data, feed)
+    assert out == {'test': {'block_name': 'test',
+                            'timestamps': [1615394400.],
+                            'data': {'x_mean': [1.5]}}}
+
+
+def test_downsampler_unknown_stats():
+    """Unknown stats are ignored, not filled with another statistic."""
+    feed = _downsample_feed(influx_stats=['median', 'max'])
+    data = {'test': {'block_name': 'test',
+                     'timestamps': [1615394400.2, 1615394400.7, 1615394401.1],
+                     'data': {'x': [1., 2., 5.]}}}
+    downsampler = Downsampler()
+    out = downsampler.process(data, feed)
+    assert out['test']['data'] == {'x_max': [2.]}
+    assert downsampler.flush()[0][0]['test']['data'] == {'x_max': [5.]}
+
+
+def test_downsampler_passthrough():
+    """Feeds that don't ask for downsampling are unchanged."""
+    feed = {'agent_address': 'test_address', 'feed_name': 'test_feed',
+            'address': 'test_address.feeds.test_feed', 'agg_params': {}}
+    data = {'test': {'block_name': 'test', 'timestamps': [1615394400.2],
+                     'data': {'x': [1.]}}}
+    assert Downsampler().process(data, feed) is data
@@ -1,7 +1,15 @@
+import json
+import os
+import queue
+import threading
 import time
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+import msgpack
+import numpy as np
 import pytest
+from autobahn.wamp.exception import TransportLost
+
 from ocs import ocs_feed
 
 
@@ -290,6 +298,355 @@ class TestPublishMessage:
         with pytest.raises(ValueError):
             test_feed.publish_message(test_message)
 
+    def test_field_names_verified_once(self):
+        """Field names should only be checked the first time a block
+        structure is seen.
+
+        """
+        mock_agent = MagicMock()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+        test_message = {
+            'block_name': 'test',
+            'timestamp': time.time(),
+            'data': {
+                'key1': 1.,
+                'key2': 10,
+            }
+        }
+
+        with patch.object(ocs_feed.Feed, 'verify_data_field_string',
+                          wraps=ocs_feed.Feed.verify_data_field_string) as m:
+            test_feed.publish_message(test_message)
+            test_feed.publish_message(test_message)
+            assert m.call_count == 2
+
+    def test_invalid_field_after_cached_block(self):
+        """A new block structure must be verified again, even if the block
+        name has been seen before.
+
+        """
+        mock_agent = MagicMock()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+        test_message = {
+            'block_name': 'test',
+            'timestamp': time.time(),
+            'data': {
+                'key1': 1.,
+            }
+        }
+        test_feed.publish_message(test_message)
+
+        test_message['data'] = {'invalid.key1': 1.}
+        with pytest.raises(ValueError):
+            test_feed.publish_message(test_message)
+
+    def test_invalid_type_after_cached_block(self):
+        """Data types are checked on every message."""
+        mock_agent = MagicMock()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+        test_message = {
+            'block_name': 'test',
+            'timestamps': [time.time(), time.time() + 1],
+            'data': {
+                'key1': [1., 2.],
+            }
+        }
+        test_feed.publish_message(test_message)
+
+        test_message['data'] = {'key1': [1., None]}
+        with pytest.raises(TypeError):
+            test_feed.publish_message(test_message)
+
+    @patch('ocs.ocs_feed.reactor', MagicMock())
+    @patch('ocs.ocs_twisted.reactor')
+    def test_publish_from_thread(self, mock_reactor):
+        """Messages published from a worker thread should be staged and
+        handed to the reactor in one call.
+
+        """
+        mock_agent = MagicMock()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  buffer_time=10)
+
+        def publish():
+            for i in range(5):
+                test_feed.publish_message({
+                    'block_name': 'test',
+                    'timestamp': float(i),
+                    'data': {'key1': i},
+                })
+
+        t = threading.Thread(target=publish, name='PoolThread-test-1')
+        t.start()
+        t.join()
+
+        assert mock_reactor.callFromThread.call_count == 1
+        assert test_feed.staging.stats()['depth'] == 5
+
+        drain = mock_reactor.callFromThread.call_args[0][0]
+        drain()
+        assert test_feed.blocks['test'].data['key1'] == [0, 1, 2, 3, 4]
+
+# ocs_feed.Feed buffering
+
+
+@patch('ocs.ocs_feed.reactor', MagicMock())
+def test_flush_samples():
+    """The buffer should be published once it holds flush_samples."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              buffer_time=100, flush_samples=3)
+
+    test_feed.publish_message(_sample(0))
+    test_feed.publish_message(_sample(1))
+    mock_agent.publish.assert_not_called()
+    test_feed.publish_message(_sample(2))
+    assert _published(mock_agent) == [0, 1, 2]
+
+
+@patch('ocs.ocs_feed.reactor', MagicMock())
+def test_flush_bytes():
+    """The buffer should be published once it reaches flush_bytes."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              buffer_time=100, flush_bytes=90)
+
+    test_feed.publish_message({'block_name': 'test',
+                               'timestamps': [0., 1.],
+                               'data': {'key1': [0, 1]}})
+    mock_agent.publish.assert_not_called()
+    test_feed.publish_message({'block_name': 'test',
+                               'timestamps': [2., 3., 4., 5.],
+                               'data': {'key1': [2, 3, 4, 5]}})
+    assert _published(mock_agent) == [0, 1, 2, 3, 4, 5]
+
+
+@patch('ocs.ocs_feed.reactor')
+def test_flush_timer(mock_reactor):
+    """A buffer should be published after buffer_time, even if no new
+    message arrives."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              buffer_time=5)
+
+    test_feed.publish_message(_sample(0))
+    mock_agent.publish.assert_not_called()
+    mock_reactor.callLater.assert_called_once()
+    delay, callback = mock_reactor.callLater.call_args[0]
+    assert delay == 5
+
+    callback()
+    assert _published(mock_agent) == [0]
+    assert test_feed.buffer_start_time is None
+
+
+def _sample(i, block_name='test'):
+    return {'block_name': block_name, 'timestamp': float(i),
+            'data': {'key1': i}}
+
+
+def _published(mock_agent):
+    """List of key1 values published through mock_agent, in order."""
+    values = []
+    for c in mock_agent.publish.call_args_list:
+        data, _ = c[0][1]
+        values.extend(data['test']['data']['key1'])
+    return values
+
+
+def _run_spill_io(feed, timeout=5):
+    """Runs the calls the feed's spill helper thread passes back to the
+    reactor, here, until the helper is idle."""
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if len(feed.staging):
+            feed.staging._drain()
+        elif not feed._spill_busy:
+            return
+        else:
+            time.sleep(0.001)
+
+
+class TestFeedBuffering:
+    """Test the behaviour of recorded feeds when publishing fails."""
+
+    def test_unbounded_drops_on_transport_lost(self):
+        mock_agent = MagicMock()
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+        test_feed.publish_message(_sample(0))
+        assert test_feed.buffer_occupancy() == 0
+        assert test_feed.dropped_samples == 1
+
+    def test_retry_after_transport_lost(self):
+        mock_agent = MagicMock()
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=10)
+
+        for i in range(3):
+            test_feed.publish_message(_sample(i))
+        assert test_feed.buffer_occupancy() == 3
+        assert test_feed.buffer_status()['pending_samples'] == 3
+
+        mock_agent.publish.reset_mock()
+        mock_agent.publish.side_effect = None
+        test_feed.publish_message(_sample(3))
+        assert _published(mock_agent) == [0, 1, 2, 3]
+        assert test_feed.buffer_occupancy() == 0
+        assert test_feed.dropped_samples == 0
+
+    def test_drop_oldest(self):
+        mock_agent = MagicMock()
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=3)
+
+        for i in range(5):
+            test_feed.publish_message(_sample(i))
+        assert test_feed.buffer_occupancy() == 3
+        assert test_feed.dropped_samples == 2
+
+        mock_agent.publish.reset_mock()
+        mock_agent.publish.side_effect = None
+        test_feed.flush_buffer()
+        assert _published(mock_agent) == [2, 3, 4]
+
+    def test_drop_newest(self):
+        mock_agent = MagicMock()
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=3,
+                                  overflow_policy='drop_newest')
+
+        for i in range(5):
+            test_feed.publish_message(_sample(i))
+        assert test_feed.buffer_occupancy() == 3
+        assert test_feed.dropped_samples == 2
+
+        mock_agent.publish.reset_mock()
+        mock_agent.publish.side_effect = None
+        test_feed.flush_buffer()
+        assert _published(mock_agent) == [0, 1, 2]
+
+    @patch('ocs.ocs_twisted.reactor')
+    def test_spill(self, mock_reactor, tmpdir):
+        mock_agent = MagicMock()
+        mock_agent.agent_address = 'observatory.test'
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=2, overflow_policy='spill',
+                                  spill_dir=str(tmpdir))
+
+        for i in range(5):
+            test_feed.publish_message(_sample(i))
+        _run_spill_io(test_feed)
+        # Data is only spilled once max_samples is reached
+        status = test_feed.buffer_status()
+        assert status['spilled_samples'] == 4
+        assert status['spill_queue_samples'] == 0
+        assert test_feed.buffer_occupancy() == 1
+        assert test_feed.dropped_samples == 0
+
+        # A new Feed (e.g. after an Agent restart) replays the spilled data,
+        # before data published since
+        mock_agent.publish.reset_mock()
+        mock_agent.publish.side_effect = None
+        new_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                 max_samples=2, overflow_policy='spill',
+                                 spill_dir=str(tmpdir))
+        assert new_feed.buffer_status()['spilled_samples'] == 4
+        new_feed.publish_message(_sample(5))
+        assert _published(mock_agent) == []
+        _run_spill_io(new_feed)
+        assert _published(mock_agent) == [0, 1, 2, 3, 5]
+        assert new_feed.buffer_status()['spilled_samples'] == 0
+        assert new_feed.buffer_occupancy() == 0
+
+    @patch('ocs.ocs_twisted.reactor')
+    def test_spill_io_thread(self, mock_reactor, tmpdir):
+        """The spill ring is only used from the helper thread, and is
+        replayed in batches."""
+        mock_agent = MagicMock()
+        mock_agent.agent_address = 'observatory.test'
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=1, overflow_policy='spill',
+                                  spill_dir=str(tmpdir))
+        test_feed.SPILL_REPLAY_BYTES = 1
+        threads = set()
+        ring = test_feed._spill
+        for name in ['push', 'peek_many', 'discard']:
+            def wrapped(*args, f=getattr(ring, name)):
+                threads.add(threading.current_thread().name)
+                return f(*args)
+            setattr(ring, name, wrapped)
+
+        for i in range(6):
+            test_feed.publish_message(_sample(i))
+        _run_spill_io(test_feed)
+        assert test_feed.buffer_status()['spilled_samples'] == 5
+
+        mock_agent.publish.reset_mock()
+        mock_agent.publish.side_effect = None
+        drains = test_feed.staging.drains
+        test_feed.flush_buffer()
+        _run_spill_io(test_feed)
+        assert _published(mock_agent) == [0, 1, 2, 3, 4, 5]
+        assert threads == {'feed-spill'}
+        # One payload read back, and published, per reactor call
+        assert test_feed.staging.drains - drains >= 5
+
+    @patch('ocs.ocs_twisted.reactor')
+    def test_spill_flush_keeps_memory(self, mock_reactor, tmpdir):
+        """A failed flush below max_samples leaves the data in memory."""
+        mock_agent = MagicMock()
+        mock_agent.agent_address = 'observatory.test'
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=10, overflow_policy='spill',
+                                  spill_dir=str(tmpdir))
+        for i in range(3):
+            test_feed.publish_message(_sample(i))
+            test_feed.flush_buffer()
+        _run_spill_io(test_feed)
+        assert test_feed.buffer_status()['spilled_samples'] == 0
+        assert test_feed.buffer_occupancy() == 3
+        spill_dir = os.path.join(str(tmpdir),
+                                 'observatory.test.feeds.test_feed')
+        assert os.listdir(spill_dir) == []
+
+    def test_spill_requires_dir(self):
+        with pytest.raises(ValueError):
+            ocs_feed.Feed(MagicMock(), 'test_feed', record=True,
+                          max_samples=2, overflow_policy='spill')
+
+    @patch('ocs.ocs_twisted.reactor')
+    def test_block(self, mock_reactor):
+        mock_agent = MagicMock()
+        mock_agent.publish.side_effect = TransportLost()
+        test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                                  max_samples=2, overflow_policy='block')
+        test_feed.publish_message(_sample(0))
+        test_feed.publish_message(_sample(1))
+        assert test_feed.buffer_occupancy() == 2
+
+        t = threading.Thread(target=test_feed.publish_message,
+                             args=(_sample(2),), name='PoolThread-test-1')
+        t.start()
+        t.join(timeout=0.2)
+        assert t.is_alive()
+
+        mock_agent.publish.side_effect = None
+        test_feed.flush_buffer()
+        t.join(timeout=5)
+        assert not t.is_alive()
+        assert test_feed.dropped_samples == 0
+
 # ocs_feed.Block
 
 
@@ -313,3 +670,389 @@ def test_block_append():
 
     assert test_block.data['key1'][0] == data_samples
     assert test_block.timestamps[0] == time_samples
+
+
+# ocs_feed.ColumnarBlock
+
+
+def test_columnar_block_extend():
+    """Lists and numpy arrays should both end up in typed buffers."""
+    test_block = ocs_feed.ColumnarBlock('test_block', ['key1', 'key2'])
+
+    test_block.extend({'timestamps': [1., 2.],
+                       'data': {'key1': [1, 2], 'key2': [0.5, 1.5]}})
+    test_block.extend({'timestamps': np.array([3., 4.]),
+                       'data': {'key1': np.array([3, 4]),
+                                'key2': np.array([2.5, 3.5])}})
+
+    assert test_block.timestamps.dtype == np.float64
+    assert test_block.data['key1'].dtype == np.int64
+    assert test_block.data['key2'].dtype == np.float64
+    assert len(test_block) == 4
+
+    encoded = test_block.encoded()
+    assert encoded['timestamps'] == [1., 2., 3., 4.]
+    assert encoded['data']['key1'] == [1, 2, 3, 4]
+    assert all(isinstance(x, int) for x in encoded['data']['key1'])
+
+
+def test_columnar_block_growth():
+    """Appending past the initial capacity should keep all samples."""
+    test_block = ocs_feed.ColumnarBlock('test_block', ['key1'])
+    for i in range(100):
+        test_block.append({'timestamp': float(i), 'data': {'key1': i * 0.5}})
+
+    assert len(test_block) == 100
+    assert test_block.encoded()['data']['key1'] == [i * 0.5 for i in range(100)]
+
+
+def test_columnar_block_clear():
+    """Clearing should not touch arrays already handed out."""
+    test_block = ocs_feed.ColumnarBlock('test_block', ['key1'])
+    test_block.extend({'timestamps': [1., 2.], 'data': {'key1': [1., 2.]}})
+    old = test_block.data['key1']
+    test_block.clear()
+    assert test_block.empty()
+
+    test_block.extend({'timestamps': [3.], 'data': {'key1': [3.]}})
+    assert list(old) == [1., 2.]
+    assert test_block.encoded()['data']['key1'] == [3.]
+
+
+def test_columnar_block_mixed_types():
+    """Strings and mixed types fall back to lists, like the list Block."""
+    test_block = ocs_feed.ColumnarBlock('test_block', ['key1', 'key2'])
+    test_block.extend({'timestamps': [1., 2.],
+                       'data': {'key1': ['a', 'b'], 'key2': [1, 2]}})
+    test_block.extend({'timestamps': [3.],
+                       'data': {'key1': ['c'], 'key2': [2.5]}})
+
+    encoded = test_block.encoded()
+    assert encoded['data']['key1'] == ['a', 'b', 'c']
+    assert encoded['data']['key2'] == [1, 2, 2.5]
+    assert isinstance(encoded['data']['key2'][0], int)
+
+
+def test_columnar_feed_publish_arrays():
+    """A columnar feed should accept numpy arrays and publish lists."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              columnar=True)
+
+    test_message = {
+        'block_name': 'test',
+        'timestamps': np.array([1., 2., 3.]),
+        'data': {
+            'key1': np.array([1., 2., 3.]),
+            'key2': np.array([True, False, True]),
+        }
+    }
+
+    test_feed.publish_message(test_message)
+
+    data, _ = mock_agent.publish.call_args[0][1]
+    assert data['test']['timestamps'] == [1., 2., 3.]
+    assert data['test']['data']['key2'] == [True, False, True]
+    assert test_feed.blocks['test'].empty()
+
+
+def test_feed_publish_arrays():
+    """A default (list based) feed should also accept numpy arrays, and
+    publish serializable python lists."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+    test_message = {
+        'block_name': 'test',
+        'timestamps': np.arange(3.),
+        'data': {
+            'x': np.arange(3),
+            'y': np.array([True, False, True]),
+        }
+    }
+
+    test_feed.publish_message(test_message)
+
+    data, _ = mock_agent.publish.call_args[0][1]
+    assert data['test']['timestamps'] == [0., 1., 2.]
+    assert data['test']['data'] == {'x': [0, 1, 2],
+                                    'y': [True, False, True]}
+    assert isinstance(data['test']['data']['x'][0], int)
+    assert isinstance(data['test']['data']['y'][0], bool)
+    json.dumps(data)
+    msgpack.packb(data)
+
+
+def test_invalid_array_dtype():
+    """Object arrays should be rejected on publish."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True)
+
+    test_message = {
+        'block_name': 'test',
+        'timestamps': np.array([1., 2.]),
+        'data': {
+            'key1': np.array([1., None]),
+        }
+    }
+
+    with pytest.raises(TypeError):
+        test_feed.publish_message(test_message)
+
+
+# ocs_feed packed encoding
+
+
+def test_pack_block_roundtrip():
+    """Numeric fields should be packed, and come back as the same values."""
+    data = {'key1': [1, 2, 3],
+            'key2': np.array([0.5, 1.5, 2.5]),
+            'key3': [True, False, True],
+            'key4': ['a', 'b', 'c']}
+    block = ocs_feed.pack_block('test', [1., 2., 3.], data)
+    assert isinstance(block['payload'], bytes)
+    assert block['packed'] == ocs_feed.PACKED_VERSION
+
+    unpacked = ocs_feed.unpack_block(block)
+    assert unpacked['block_name'] == 'test'
+    assert unpacked['timestamps'] == [1., 2., 3.]
+    assert unpacked['data'] == {'key1': [1, 2, 3],
+                                'key2': [0.5, 1.5, 2.5],
+                                'key3': [True, False, True],
+                                'key4': ['a', 'b', 'c']}
+    assert isinstance(unpacked['data']['key1'][0], int)
+
+    arrays = ocs_feed.unpack_block(block, as_arrays=True)
+    assert arrays['timestamps'].dtype == np.float64
+    assert arrays['data']['key1'].dtype == np.int64
+
+
+def test_pack_block_mixed_types():
+    """Mixed type fields are kept as lists, so the types are preserved."""
+    block = ocs_feed.pack_block('test', [1., 2.], {'key1': [1, 2.5]})
+    unpacked = ocs_feed.unpack_block(block)
+    assert unpacked['data']['key1'] == [1, 2.5]
+    assert isinstance(unpacked['data']['key1'][0], int)
+
+
+def test_unpack_block_passthrough_and_version():
+    block = {'block_name': 'test', 'timestamps': [1.], 'data': {'key1': [1]}}
+    assert ocs_feed.unpack_block(block) is block
+
+    block = ocs_feed.pack_block('test', [1.], {'key1': [1]})
+    block['packed'] = ocs_feed.PACKED_VERSION + 1
+    with pytest.raises(ValueError):
+        ocs_feed.unpack_block(block)
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_packed_feed(columnar):
+    """A packed feed should publish blocks that decode to the data."""
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              encoding='packed', columnar=columnar)
+
+    test_feed.publish_message({'block_name': 'test',
+                               'timestamps': [1., 2.],
+                               'data': {'key1': [1., 2.]}})
+
+    data, feed = mock_agent.publish.call_args[0][1]
+    assert feed['encoding'] == 'packed'
+    assert 'payload' in data['test']
+    decoded = ocs_feed.decode_feed_data(data)
+    assert decoded['test']['timestamps'] == [1., 2.]
+    assert decoded['test']['data']['key1'] == [1., 2.]
+
+
+# ocs_feed compacted timestamps
+
+
+def test_compact_timestamps_regular():
+    t = 1615394417.3590388 + np.arange(1000) / 200.
+    compact = ocs_feed.compact_timestamps(t)
+    assert set(compact) == {'t0', 'dt', 'n'}
+    assert compact['n'] == 1000
+
+    expanded = ocs_feed.expand_timestamps(compact)
+    assert isinstance(expanded, list)
+    assert np.max(np.abs(np.array(expanded) - t)) <= 0.5e-6
+
+
+def test_compact_timestamps_irregular():
+    t = 1615394417.3590388 + np.cumsum(np.random.uniform(0.5, 1.5, 1000))
+    compact = ocs_feed.compact_timestamps(t)
+    assert 'deltas' in compact
+    assert all(isinstance(d, int) for d in compact['deltas'])
+
+    expanded = ocs_feed.expand_timestamps(compact, as_array=True)
+    assert np.max(np.abs(expanded - t)) <= 0.5e-6
+
+
+def test_compact_timestamps_single_sample():
+    compact = ocs_feed.compact_timestamps([1615394417.3590388])
+    assert ocs_feed.expand_timestamps(compact) == [1615394417.3590388]
+
+
+def test_expand_timestamps_passthrough():
+    t = [1., 2., 3.]
+    assert ocs_feed.expand_timestamps(t) is t
+
+
+@pytest.mark.parametrize('encoding', ['list', 'packed'])
+def test_feed_compact_timestamps(encoding):
+    mock_agent = MagicMock()
+    test_feed = ocs_feed.Feed(mock_agent, 'test_feed', record=True,
+                              encoding=encoding, compact_timestamps=True)
+
+    t = 1615394417.3590388 + np.arange(10) / 10.
+    test_feed.publish_message({'block_name': 'test',
+                               'timestamps': t.tolist(),
+                               'data': {'key1': list(range(10))}})
+
+    data, _ = mock_agent.publish.call_args[0][1]
+    block = ocs_feed.decode_feed_data(data)['test']
+    assert isinstance(block['timestamps'], dict)
+    expanded = ocs_feed.expand_timestamps(block['timestamps'])
+    assert np.max(np.abs(np.array(expanded) - t)) <= 0.5e-6
+
+
+# ocs_feed.FeedQueue
+def _queue_message(address, n=1, value=0.):
+    data = {'b': {'block_name': 'b', 'timestamps': [1.] * n,
+                  'data': {'x': [value] * n}}}
+    return data, {'address': address}
+
+
+def _wait_for_spill(q, timeout=5):
+    t0 = time.time()
+    while q.stats()['staged'] and time.time() - t0 < timeout:
+        time.sleep(0.01)
+
+
+class TestFeedQueue:
+    def test_unbounded(self):
+        q = ocs_feed.FeedQueue()
+        for i in range(100):
+            q.put(_queue_message('a'))
+        assert q.qsize() == 100
+        assert q.stats()['dropped'] == 0
+        assert q.stats()['high_water'] == 100
+
+    def test_drop_oldest(self):
+        q = ocs_feed.FeedQueue(max_messages=3)
+        for i in range(5):
+            q.put(_queue_message('a', value=i))
+        q.put(_queue_message('b'))
+
+        assert [q.get_nowait()[0]['b']['data']['x'][0] for _ in range(3)] \
+            == [3., 4., 0.]
+        stats = q.stats()
+        assert stats['dropped'] == 3
+        assert stats['feeds']['a'] == {'queued': 0, 'dropped': 3,
+                                       'high_water': 3}
+        assert stats['feeds']['b']['dropped'] == 0
+        assert stats['high_water'] == 3
+
+    def test_max_bytes(self):
+        # 10 samples of 1 field and timestamps, estimated at 160 bytes
+        q = ocs_feed.FeedQueue(max_bytes=400)
+        for i in range(4):
+            q.put(_queue_message('a', n=10))
+        assert q.qsize() == 2
+        assert q.stats()['bytes'] == 320
+        assert q.stats()['high_water_bytes'] == 320
+
+    def test_coalesce(self):
+        q = ocs_feed.FeedQueue(max_messages=2, policy='coalesce')
+        q.put(_queue_message('a', value=0))
+        q.put(_queue_message('b', value=1))
+        q.put(_queue_message('a', value=2))
+        q.put(_queue_message('c', value=3))
+
+        # 'a' was replaced, and 'c' had nothing to replace so 'a' was dropped
+        assert [q.get_nowait()[0]['b']['data']['x'][0] for _ in range(2)] \
+            == [1., 3.]
+        assert q.stats()['feeds']['a']['dropped'] == 2
+
+    def test_spill(self, tmpdir):
+        q = ocs_feed.FeedQueue(max_messages=2, policy='spill',
+                               spill_dir=str(tmpdir))
+        for i in range(5):
+            q.put(_queue_message('a', value=i))
+        assert q.qsize() == 5
+        _wait_for_spill(q)
+        assert q.stats()['spilled'] == 3
+
+        assert [q.get_nowait()[0]['b']['data']['x'][0] for _ in range(5)] \
+            == [0., 1., 2., 3., 4.]
+        assert q.empty()
+        assert q.stats()['dropped'] == 0
+
+    def test_spill_requires_dir(self):
+        with pytest.raises(ValueError):
+            ocs_feed.FeedQueue(policy='spill')
+
+    def test_spill_ignores_unexpected_files(self, tmpdir):
+        """Files in the spill directory that the ring didn't write are
+        ignored."""
+        tmpdir.join('notes.msgpack').write('')
+        tmpdir.join('1_2_3.msgpack').write('')
+        q = ocs_feed.FeedQueue(max_messages=1, policy='spill',
+                               spill_dir=str(tmpdir))
+        assert q.empty()
+        q.put(_queue_message('a'))
+        assert q.get_nowait()[1]['address'] == 'a'
+
+    def test_spill_slow_disk(self, tmpdir):
+        """A slow spill disk shouldn't hold up put, and messages stay in
+        order while being written out."""
+        q = ocs_feed.FeedQueue(max_messages=1, policy='spill',
+                               spill_dir=str(tmpdir))
+        push = q._spill.push
+        peek = q._spill.peek
+
+        def slow(f):
+            def wrapped(*args):
+                time.sleep(0.05)
+                return f(*args)
+            return wrapped
+
+        q._spill.push = slow(push)
+        q._spill.peek = slow(peek)
+
+        t0 = time.time()
+        for i in range(5):
+            q.put(_queue_message('a', value=i))
+        assert time.time() - t0 < 0.05
+        assert q.qsize() == 5
+
+        # A put while the consumer reads from disk doesn't wait for it
+        put_times = []
+
+        def timed_put():
+            t0 = time.time()
+            q.put(_queue_message('a', value=5))
+            put_times.append(time.time() - t0)
+
+        threading.Timer(0.1, timed_put).start()
+        values = [q.get(timeout=1)[0]['b']['data']['x'][0] for _ in range(6)]
+        assert values == [0., 1., 2., 3., 4., 5.]
+        assert put_times[0] < 0.04
+        assert q.empty()
+        assert q.stats()['dropped'] == 0
+
+    def test_wake_item(self):
+        q = ocs_feed.FeedQueue(max_messages=1)
+        q.put(_queue_message('a'))
+        q.put(None)
+        q.put(_queue_message('a'))
+        assert q.get_nowait() is None
+        assert q.get_nowait()[1]['address'] == 'a'
+        assert q.stats()['dropped'] == 1
+
+    def test_get_timeout(self):
+        q = ocs_feed.FeedQueue()
+        with pytest.raises(queue.Empty):
+            q.get(timeout=0.01)
+        threading.Timer(0.01, q.put, args=[_queue_message('a')]).start()
+        assert q.get(timeout=1)[1]['address'] == 'a'
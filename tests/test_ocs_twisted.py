@@ -1,7 +1,9 @@
 import time
 import numpy as np
 import pytest
-from ocs.ocs_twisted import Pacemaker
+from unittest.mock import patch
+
+from ocs.ocs_twisted import Pacemaker, ReactorCallQueue
 
 
 def test_quantized():
@@ -50,3 +52,63 @@ def test_non_integer_quantization():
     """
     with pytest.raises(ValueError):
         Pacemaker(5.5, quantize=True)
+
+
+@patch('ocs.ocs_twisted.reactor')
+def test_reactor_call_queue_batches(mock_reactor):
+    """Many queued calls should only wake the reactor once, and run in
+    order when drained.
+
+    """
+    q = ReactorCallQueue()
+    results = []
+    for i in range(10):
+        q.call(results.append, i)
+
+    assert mock_reactor.callFromThread.call_count == 1
+    assert len(q) == 10
+
+    drain = mock_reactor.callFromThread.call_args[0][0]
+    drain()
+    assert results == list(range(10))
+
+    stats = q.stats()
+    assert stats['depth'] == 0
+    assert stats['max_depth'] == 10
+    assert stats['calls'] == 10
+    assert stats['drains'] == 1
+    assert stats['last_drain_latency'] >= 0
+
+    # Next call schedules a new drain
+    q.call(results.append, 10)
+    assert mock_reactor.callFromThread.call_count == 2
+
+
+@patch('ocs.ocs_twisted.reactor')
+def test_reactor_call_queue_max_batch(mock_reactor):
+    """Calls beyond max_batch should be left for a follow-up drain."""
+    q = ReactorCallQueue(max_batch=3)
+    results = []
+    for i in range(5):
+        q.call(results.append, i)
+
+    drain = mock_reactor.callFromThread.call_args[0][0]
+    drain()
+    assert results == [0, 1, 2]
+    mock_reactor.callLater.assert_called_once_with(0, drain)
+
+    drain()
+    assert results == [0, 1, 2, 3, 4]
+
+
+@patch('ocs.ocs_twisted.reactor')
+def test_reactor_call_queue_error(mock_reactor):
+    """A failing call should not prevent the rest from running."""
+    q = ReactorCallQueue()
+    results = []
+    q.call(lambda: 1 / 0)
+    q.call(results.append, 1)
+
+    drain = mock_reactor.callFromThread.call_args[0][0]
+    drain()
+    assert results == [1]
@@ -1,5 +1,10 @@
 from unittest.mock import MagicMock
+import gzip
+import http.server
+import json
 import os
+import threading
+import urllib.parse
 
 
 def fake_get_control_client(instance_id, **kwargs):
@@ -27,3 +32,102 @@ def fake_get_control_client(instance_id, **kwargs):
     client.get_api = MagicMock(return_value=api)
 
     return client
+
+
+class InfluxDBStandIn:
+    """Local HTTP server standing in for InfluxDB, for testing the InfluxDB
+    Publisher's drivers. It accepts writes to the v1 (``/write``) and v2
+    (``/api/v2/write``) APIs, including chunked and gzip encoded bodies,
+    answers ``/ping`` and the v1 ``/query`` calls used to set up the
+    database, and records what it receives.
+
+    Use as a context manager, which starts and stops the server.
+
+    Attributes:
+        port (int): Port the server is listening on.
+        requests (list): (path, query params, headers, decoded body) of each
+            accepted write request.
+        request_count (int): Number of write requests, including those
+            answered with an error.
+        bytes_received (int): Bytes of write request bodies, as sent.
+        statuses (list): Statuses to answer the next write requests with,
+            before going back to 204.
+    """
+
+    def __init__(self):
+        standin = self
+        self.requests = []
+        self.request_count = 0
+        self.bytes_received = 0
+        self.statuses = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=b''):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        chunk = self.rfile.read(size + 2)[:size]
+                        if size == 0:
+                            return body
+                        body += chunk
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/ping':
+                    self._reply(204)
+                elif url.path == '/query':
+                    result = {'results': [{'statement_id': 0, 'series': [{
+                        'name': 'databases', 'columns': ['name'],
+                        'values': [['ocs_feeds']]}]}]}
+                    self._reply(200, json.dumps(result).encode())
+                else:
+                    self._reply(404)
+
+            def do_POST(self):
+                url = urllib.parse.urlparse(self.path)
+                body = self._read_body()
+                if url.path == '/query':
+                    self._reply(200, b'{"results": [{"statement_id": 0}]}')
+                    return
+                standin.request_count += 1
+                standin.bytes_received += len(body)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                status = standin.statuses.pop(0) if standin.statuses else 204
+                if status == 204:
+                    standin.requests.append(
+                        (url.path, dict(urllib.parse.parse_qsl(url.query)),
+                         dict(self.headers), body.decode()))
+                self._reply(status)
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                       Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.01},
+                                        daemon=True)
+
+    def lines(self):
+        """Returns all line protocol lines written, in order received."""
+        return [line for r in self.requests for line in r[3].splitlines()]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()